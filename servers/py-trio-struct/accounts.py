@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+#
+# User and channel directory for the Internet Delay Chat server written
+# in Python Trio.  Run this to import config.py into the database.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+from __future__ import annotations
+from typing import Any, Optional, Protocol
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import sqlite3
+import sys
+
+import config
+import entities
+import metrics
+import minilog
+import utils
+
+
+class Directory(Protocol):
+    # users and channels are every user and channel that's in memory
+    # right now, by name.  Nothing else may hold on to a User or
+    # Channel that isn't in them, or the same name would end up with
+    # two objects.
+    @property
+    def users(self) -> dict[bytes, entities.User]: ...
+
+    @property
+    def channels(self) -> dict[bytes, entities.Channel]: ...
+
+    def user(self, username: bytes) -> Optional[entities.User]: ...
+
+    def channel(
+        self, channelname: bytes
+    ) -> Optional[entities.Channel]: ...
+
+    def load_channels_of(self, user: entities.User) -> None:
+        """
+        Make user.in_channels complete.  Call this once the user has a
+        connected client, which keeps those channels in memory.
+        """
+        ...
+
+    def set_password(
+        self, user: entities.User, password: bytes
+    ) -> None: ...
+
+    def close(self) -> None: ...
+
+
+def _make_user(
+    username: bytes, account: dict[str, Any]
+) -> entities.User:
+    return entities.User(
+        username=entities.intern_name(username),
+        password=account["password"],
+        options=entities.intern_flags(account["options"]),
+        permissions=entities.intern_flags(account["permissions"]),
+    )
+
+
+@dataclass
+class ConfigDirectory:
+    """
+    Every user and channel in config.py, all loaded up front.
+    """
+
+    users: dict[bytes, entities.User] = field(default_factory=dict)
+    channels: dict[bytes, entities.Channel] = field(
+        default_factory=dict
+    )
+
+    @classmethod
+    def from_config(
+        cls,
+        users: dict[bytes, dict[str, Any]],
+        channels: dict[bytes, dict[str, Any]],
+    ) -> ConfigDirectory:
+        d = cls()
+        for username, account in users.items():
+            user = _make_user(username, account)
+            d.users[user.username] = user
+        for channelname, info in channels.items():
+            channel = entities.Channel(
+                channelname=entities.intern_name(channelname),
+                guild=None,
+            )
+            d.channels[channel.channelname] = channel
+            for username in info["broadcast_to"]:
+                utils.join_channel(d.users[username], channel)
+        return d
+
+    def user(self, username: bytes) -> Optional[entities.User]:
+        return self.users.get(username)
+
+    def channel(self, channelname: bytes) -> Optional[entities.Channel]:
+        return self.channels.get(channelname)
+
+    def load_channels_of(self, user: entities.User) -> None:
+        pass
+
+    def set_password(
+        self, user: entities.User, password: bytes
+    ) -> None:
+        user.password = password
+
+    def close(self) -> None:
+        pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username BLOB PRIMARY KEY,
+    password BLOB NOT NULL,
+    bio BLOB NOT NULL DEFAULT x'',
+    options TEXT NOT NULL DEFAULT '',
+    permissions TEXT NOT NULL DEFAULT ''
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS channels (
+    channelname BLOB PRIMARY KEY
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS members (
+    channelname BLOB NOT NULL REFERENCES channels,
+    username BLOB NOT NULL REFERENCES users,
+    PRIMARY KEY (channelname, username)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS members_by_user
+    ON members (username, channelname);
+"""
+
+_USER_COLUMNS = "users.username, password, options, permissions"
+
+
+def _flags(text: str) -> list[str]:
+    return text.split()
+
+
+@dataclass
+class SqliteDirectory:
+    """
+    Users and channels in an SQLite database, read in when they're first
+    needed.  At most about cache_users users and cache_channels channels
+    stay in memory; past that the least recently used ones that nothing
+    is holding on to are dropped.  A user is held on to while connected
+    or in a channel that's in memory, and a channel while any member is
+    connected.
+
+    Lookups are primary key reads that are usually in the page cache,
+    so they're done right on the event loop.
+    """
+
+    path: str
+    cache_users: int = 100000
+    cache_channels: int = 10000
+    users: OrderedDict[bytes, entities.User] = field(
+        default_factory=OrderedDict
+    )
+    channels: OrderedDict[bytes, entities.Channel] = field(
+        default_factory=OrderedDict
+    )
+    db: Any = None
+
+    def __post_init__(self) -> None:
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        # Several workers may have it open at once.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(_SCHEMA)
+
+    def _user_from_row(self, row: tuple[Any, ...]) -> entities.User:
+        username, password, options, permissions = row
+        user = self.users[username] = entities.User(
+            username=entities.intern_name(username),
+            password=password,
+            options=entities.intern_flags(_flags(options)),
+            permissions=entities.intern_flags(_flags(permissions)),
+        )
+        metrics.account_loads.inc()
+        return user
+
+    def user(self, username: bytes) -> Optional[entities.User]:
+        user = self.users.get(username)
+        if user is not None:
+            self.users.move_to_end(username)
+            return user
+        row = self.db.execute(
+            f"SELECT {_USER_COLUMNS} FROM users WHERE username = ?",
+            (username,),
+        ).fetchone()
+        if row is None:
+            return None
+        user = self._user_from_row(row)
+        self._evict_users(keep=username)
+        return user
+
+    def channel(self, channelname: bytes) -> Optional[entities.Channel]:
+        channel = self.channels.get(channelname)
+        if channel is not None:
+            self.channels.move_to_end(channelname)
+            return channel
+        if (
+            self.db.execute(
+                "SELECT 1 FROM channels WHERE channelname = ?",
+                (channelname,),
+            ).fetchone()
+            is None
+        ):
+            return None
+        channel = self.channels[channelname] = entities.Channel(
+            channelname=entities.intern_name(channelname), guild=None
+        )
+        metrics.account_loads.inc()
+        for row in self.db.execute(
+            f"SELECT {_USER_COLUMNS} FROM members JOIN users"
+            " ON members.username = users.username"
+            " WHERE channelname = ?",
+            (channelname,),
+        ):
+            user = self.users.get(row[0])
+            if user is None:
+                user = self._user_from_row(row)
+            utils.join_channel(user, channel)
+        # Only now that they're members are the users safe from this.
+        self._evict_channels(keep=channelname)
+        self._evict_users()
+        return channel
+
+    def load_channels_of(self, user: entities.User) -> None:
+        for (channelname,) in self.db.execute(
+            "SELECT channelname FROM members WHERE username = ?",
+            (user.username,),
+        ).fetchall():
+            self.channel(channelname)
+
+    def set_password(
+        self, user: entities.User, password: bytes
+    ) -> None:
+        user.password = password
+        self.db.execute(
+            "UPDATE users SET password = ? WHERE username = ?",
+            (password, user.username),
+        )
+
+    def _evict_users(self, keep: Optional[bytes] = None) -> None:
+        # Users that are in use, and the one about to be returned, go
+        # to the back of the line, so each pass looks at every user at
+        # most once.  Evicting the one being returned would let the
+        # next lookup make a second User for the same name.
+        for _ in range(len(self.users)):
+            if len(self.users) <= self.cache_users:
+                break
+            username, user = next(iter(self.users.items()))
+            if (
+                username == keep
+                or user.connected_clients
+                or user.in_channels
+            ):
+                self.users.move_to_end(username)
+            else:
+                del self.users[username]
+
+    def _evict_channels(self, keep: Optional[bytes] = None) -> None:
+        for _ in range(len(self.channels)):
+            if len(self.channels) <= self.cache_channels:
+                break
+            channelname, channel = next(iter(self.channels.items()))
+            if channelname == keep or any(
+                u.connected_clients for u in channel.broadcast_to
+            ):
+                self.channels.move_to_end(channelname)
+                continue
+            del self.channels[channelname]
+            for u in channel.broadcast_to:
+                u.in_channels = tuple(
+                    c for c in u.in_channels if c is not channel
+                )
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+def import_config(
+    path: str,
+    users: dict[bytes, dict[str, Any]],
+    channels: dict[bytes, dict[str, Any]],
+) -> None:
+    """
+    Copy users and channels in config.py's format into the database at
+    path, replacing whatever's there under the same names.
+    """
+    db = sqlite3.connect(path)
+    db.executescript(_SCHEMA)
+    with db:
+        db.executemany(
+            "INSERT OR REPLACE INTO users"
+            " (username, password, bio, options, permissions)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    username,
+                    account["password"],
+                    account.get("bio", b""),
+                    " ".join(sorted(account.get("options", ()))),
+                    " ".join(sorted(account.get("permissions", ()))),
+                )
+                for username, account in users.items()
+            ),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO channels (channelname) VALUES (?)",
+            ((channelname,) for channelname in channels),
+        )
+        db.executemany(
+            "DELETE FROM members WHERE channelname = ?",
+            ((channelname,) for channelname in channels),
+        )
+        db.executemany(
+            "INSERT INTO members (channelname, username) VALUES (?, ?)",
+            (
+                (channelname, username)
+                for channelname, info in channels.items()
+                for username in info["broadcast_to"]
+            ),
+        )
+    db.close()
+    minilog.note(
+        "Imported %d users and %d channels into %s.",
+        len(users),
+        len(channels),
+        path,
+    )
+
+
+def open_directory() -> Directory:
+    if config.accounts.store == "sqlite":
+        return SqliteDirectory(
+            path=config.accounts.path,
+            cache_users=config.accounts.cache_users,
+            cache_channels=config.accounts.cache_channels,
+        )
+    elif config.accounts.store == "config":
+        return ConfigDirectory.from_config(
+            config.users, config.channels
+        )
+    else:
+        raise ValueError(
+            f"Unknown account store {config.accounts.store!r}"
+        )
+
+
+directory: Directory = ConfigDirectory()
+
+
+if __name__ == "__main__":
+    import_config(
+        sys.argv[1] if len(sys.argv) > 1 else config.accounts.path,
+        config.users,
+        config.channels,
+    )
+    minilog.flush()
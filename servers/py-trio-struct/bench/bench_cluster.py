@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+#
+# PRIVMSG throughput with 1, 2, 4... worker processes.  Every client
+# logs in as its own user and sends MESSAGES private messages to the
+# next user along, so with more than one worker most of them cross the
+# bus.  Throughput is delivered lines per second, counting the echo to
+# the sender.
+#
+#     python3 bench/bench_cluster.py [max workers]
+#
+# The load comes from this one process, so on a small machine the
+# clients, not the server, may be what tops out.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import os
+import sys
+import time
+
+import trio
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import harness  # noqa: E402
+
+CLIENTS = 100
+MESSAGES = 200
+BATCH = 20
+
+
+async def run(port: int) -> float:
+    clients = []
+    for i in range(CLIENTS):
+        c = await harness.Client.connect(port)
+        await c.login(i)
+        clients.append(c)
+    expected = 2 * MESSAGES
+
+    async def talk(i: int, c: harness.Client) -> None:
+        target = harness.username((i + 1) % CLIENTS)
+        line = b"PRIVMSG\tTARGET=%s\tMESSAGE=hello there\r\n" % target
+        for _ in range(MESSAGES // BATCH):
+            await c.send(line * BATCH)
+            await trio.sleep(0)
+
+    async def listen(c: harness.Client) -> None:
+        got = 0
+        while got < expected:
+            if (await c.readline()).startswith(b"PRIVMSG\t"):
+                got += 1
+
+    start = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        for i, c in enumerate(clients):
+            nursery.start_soon(talk, i, c)
+            nursery.start_soon(listen, c)
+    elapsed = time.perf_counter() - start
+    for c in clients:
+        await c.aclose()
+    return CLIENTS * expected / elapsed
+
+
+def main() -> None:
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    print(f"{os.cpu_count()} CPUs, {CLIENTS} clients")
+    print(f"{'workers':>8} {'lines/s':>10}")
+    workers = 1
+    while workers <= max_workers:
+        with harness.start_server(CLIENTS, workers=workers) as server:
+            rate = trio.run(run, server.port)
+        print(f"{workers:>8} {rate:10.0f}")
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
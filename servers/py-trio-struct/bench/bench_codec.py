@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# Lines per second through codec.decode_line / codec.encode_line,
+# compared with the regex-and-replace code that used to live in
+# utils.bytesToStd / utils.stdToBytes (copied below).
+#
+#     python3 bench/bench_codec.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Callable, Iterator, Optional
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import codec  # noqa: E402
+import exceptions  # noqa: E402
+
+N = 100000
+
+_esc_re = re.compile(rb"\\(.)")
+_idc_escapes = {
+    b"\\": b"\\\\",
+    b"r": b"\r",
+    b"n": b"\n",
+    b"t": b"\t",
+}
+
+
+def _get_idc_args(
+    command: bytes, kwdict: dict[str, Optional[bytes]]
+) -> Iterator[bytes]:
+    yield command.upper()
+    seen = set()
+    for key, value in kwdict.items():
+        if key != key.upper():
+            raise exceptions.IdiotError(
+                "Why are you using lowercase keys in the code?"
+            )
+        if key in seen:
+            raise exceptions.KeyCollisionError(
+                key.encode("ascii")
+                + b" was already seen in the arguments."
+            )
+        seen.add(key)
+        if value is not None:
+            for escape_char, char in _idc_escapes.items():
+                value = value.replace(char, b"\\" + escape_char)
+            yield key.encode("ascii") + b"=" + value
+
+
+def old_encode(command: bytes, **kwargs: Optional[bytes]) -> bytes:
+    return b"\t".join(_get_idc_args(command, kwargs)) + b"\r\n"
+
+
+def old_decode(msg: bytes) -> tuple[bytes, dict[str, bytes]]:
+    if msg.endswith(b"\n"):
+        msg = msg[:-1]
+    if msg.endswith(b"\r"):
+        msg = msg[:-1]
+    cmd = b""
+    args = {}
+    for arg in msg.split(b"\t"):
+        if b"=" in arg:
+            key, value = arg.split(b"=", 1)
+            key = key.upper()
+
+            try:
+                key_str = key.decode("ascii")
+            except UnicodeDecodeError:
+                raise exceptions.NonAlphaKeyError(
+                    b"Argument keys must be ASCII alphabet sequences.  (decode error)"
+                )
+            else:
+                if not key_str.isalpha():
+                    raise exceptions.NonAlphaKeyError(
+                        b"Argument keys must be ASCII alphabet sequences. (not isalpha)"
+                    )
+
+            def s(m: re.Match[bytes]) -> bytes:
+                try:
+                    return _idc_escapes[m.group(1)]
+                except KeyError:
+                    raise exceptions.EscapeSequenceError(
+                        b"\\"
+                        + m.group(1)
+                        + b"is an invalid escape sequence."
+                    )
+
+            args[key_str] = _esc_re.sub(
+                s,
+                value,
+            )
+        elif cmd != b"":
+            raise exceptions.MultiCommandError(
+                b"You can't use multiple commands inside one line!"
+            )
+        else:
+            cmd = arg
+    return cmd, args
+
+
+LINES = [
+    b"PRIVMSG\tTARGET=andrew@andrewyu.org\tMESSAGE=hello there\r\n",
+    b"CHANMSG\tTARGET=#hackers@andrewyu.org\tTYPE=NORMAL\t"
+    b"MESSAGE=line one\\nline two\\tindented\r\n",
+    b"LOGIN\tUSERNAME=guest@andrewyu.org\tPASSWORD=guest\r\n",
+    b"ping\tcookie=12345\r\n",
+    b"SEARCH\tQUERY=hello\tBEFOREID=435200000000000000\r\n",
+]
+ARGS: list[tuple[bytes, dict[str, Optional[bytes]]]] = [
+    (
+        b"CHANMSG",
+        {
+            "SOURCE": b"andrew@andrewyu.org",
+            "TYPE": b"NORMAL",
+            "TARGET": b"#hackers@andrewyu.org",
+            "MESSAGE": b"Just a normal line of chat, nothing special.",
+            "RSTS": b"1660000000.123456",
+        },
+    ),
+    (
+        b"PRIVMSG",
+        {
+            "SOURCE": b"hax@andrewyu.org",
+            "TYPE": b"NORMAL",
+            "TARGET": b"andrew@andrewyu.org",
+            "MESSAGE": b"two\nlines\twith a tab",
+            "RSTS": b"1660000000.123456",
+        },
+    ),
+    (b"PONG", {"COOKIE": b"12345", "RSTS": None}),
+    # Its BEFOREID comes back in the next SEARCH, so it has to decode.
+    (
+        b"END_SEARCH",
+        {
+            "COUNT": b"20",
+            "MORE": b"1",
+            "BEFOREID": b"435200000000000000",
+        },
+    ),
+]
+
+
+def rate(func: Callable[[], object]) -> float:
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(N):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return N / best
+
+
+def main() -> None:
+    print(f"{'case':>30} {'old lines/s':>12} {'new lines/s':>12}")
+    for line in LINES:
+        assert old_decode(line) == codec.decode_line(line)
+        old = rate(lambda: old_decode(line))
+        new = rate(lambda: codec.decode_line(line))
+        name = "decode " + line.split(b"\t")[0].decode()
+        print(f"{name:>30} {old:12.0f} {new:12.0f}")
+    for cmd, kwargs in ARGS:
+        assert old_encode(cmd, **kwargs) == codec.encode_line(
+            cmd, kwargs
+        )
+        assert codec.decode_line(codec.encode_line(cmd, kwargs)) == (
+            cmd,
+            {k: v for k, v in kwargs.items() if v is not None},
+        )
+        old = rate(lambda: old_encode(cmd, **kwargs))
+        new = rate(lambda: codec.encode_line(cmd, kwargs))
+        name = "encode " + cmd.decode()
+        print(f"{name:>30} {old:12.0f} {new:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#
+# Bandwidth saved against CPU spent by COMPRESS, on recorded traffic.
+# Traffic is recorded by starting idc.py on loopback, logging in
+# --clients users who are all in #bench, and having each of them send
+# --messages CHANMSGs and PRIVMSGs of everyday chat, while every
+# client's incoming lines are kept.  --save writes the recording out
+# and --traffic replays one instead of recording.
+#
+#     python3 bench/bench_compress.py
+#     python3 bench/bench_compress.py --save traffic.json
+#     python3 bench/bench_compress.py --traffic traffic.json \
+#         --json out.json
+#
+# Each client's lines are then compressed the way the server's writer
+# would, for a few zlib settings, with a sync flush after every line
+# (a quiet connection, where every message is a write of its own) and
+# after every 64 KiB (a busy one, or a LOGIN burst).  CPU time is per
+# KiB of lines, for compressing on the server and decompressing on the
+# client.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+import trio
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import harness  # noqa: E402
+
+# (level, window_bits, mem_level): zlib's default, then cheaper and
+# harder settings, then small windows for connections that need to be
+# light on memory.
+SETTINGS = [
+    (6, 15, 8),
+    (1, 15, 8),
+    (9, 15, 9),
+    (6, 12, 5),
+    (6, 10, 3),
+]
+WORDS = (
+    "the be to of and a in that have i it for not on with he as you do"
+    " at this but his by from they we say her she or an will my one all"
+    " would there their what so up out if about who get which go me"
+    " when make can like time no just him know take people into year"
+    " your good some could them see other than then now look only come"
+    " its over think also back after use two how our work first well"
+    " way even new want because any these give day most us lol ok yeah"
+    " thanks"
+    " anyone here working build server client patch commit branch merge"
+    " test broken fixed release config tls trio python idc channel"
+).split()
+
+
+@dataclass
+class Result:
+    level: int
+    window_bits: int
+    mem_level: int
+    flush: str
+    raw: int
+    wire: int
+    deflate_s: float
+    inflate_s: float
+
+    @property
+    def memory(self) -> int:
+        return 2 ** (self.window_bits + 2) + 2 ** (self.mem_level + 9)
+
+
+def chat(rng: random.Random) -> bytes:
+    n = min(int(rng.expovariate(1 / 8)) + 1, 60)
+    words = rng.choices(WORDS, k=n)
+    return " ".join(words).capitalize().encode("ascii") + b"."
+
+
+async def record(args: argparse.Namespace) -> list[list[bytes]]:
+    rng = random.Random(args.seed)
+    streams: list[list[bytes]] = [[] for _ in range(args.clients)]
+    received = 0
+    # The clients here read slower than a real one would, so don't let
+    # the server disconnect them for it.
+    with harness.start_server(
+        args.clients,
+        members=args.clients,
+        extra="outbound.queue_size = 1 << 20",
+    ) as s:
+        clients = []
+        for i in range(args.clients):
+            c = await harness.Client.connect(s.port)
+            streams[i].extend(await c.login(i))
+            clients.append(c)
+
+        async def read(i: int) -> None:
+            nonlocal received
+            while True:
+                line = await clients[i].readline()
+                streams[i].append(line)
+                if line.startswith((b"CHANMSG", b"PRIVMSG")):
+                    received += 1
+
+        async def write(i: int) -> None:
+            for _ in range(args.messages):
+                if rng.random() < 0.7:
+                    target = b"CHANMSG\tTARGET=" + harness.CHANNEL
+                else:
+                    target = b"PRIVMSG\tTARGET=" + harness.username(
+                        rng.randrange(args.clients)
+                    )
+                await clients[i].send(
+                    target + b"\tMESSAGE=" + chat(rng) + b"\r\n"
+                )
+                await trio.sleep(rng.random() * 0.05)
+
+        async with trio.open_nursery() as nursery:
+            for i in range(args.clients):
+                nursery.start_soon(read, i)
+            async with trio.open_nursery() as writers:
+                for i in range(args.clients):
+                    writers.start_soon(write, i)
+            # Wait for things to go quiet.
+            while True:
+                before = received
+                await trio.sleep(0.5)
+                if received == before:
+                    break
+            nursery.cancel_scope.cancel()
+        for c in clients:
+            await c.aclose()
+    return streams
+
+
+def chunks(lines: list[bytes], flush: str) -> list[bytes]:
+    data = [line + b"\r\n" for line in lines]
+    if flush == "line":
+        return data
+    out = []
+    pending: list[bytes] = []
+    size = 0
+    for line in data:
+        pending.append(line)
+        size += len(line)
+        if size >= 64 << 10:
+            out.append(b"".join(pending))
+            pending = []
+            size = 0
+    if pending:
+        out.append(b"".join(pending))
+    return out
+
+
+def measure(
+    streams: list[list[bytes]],
+    level: int,
+    window_bits: int,
+    mem_level: int,
+    flush: str,
+) -> Result:
+    r = Result(level, window_bits, mem_level, flush, 0, 0, 0.0, 0.0)
+    for lines in streams:
+        writes = chunks(lines, flush)
+        d = zlib.compressobj(
+            level, zlib.DEFLATED, window_bits, mem_level
+        )
+        started = time.process_time()
+        wire = [
+            d.compress(w) + d.flush(zlib.Z_SYNC_FLUSH) for w in writes
+        ]
+        r.deflate_s += time.process_time() - started
+        i = zlib.decompressobj()
+        started = time.process_time()
+        for w in wire:
+            i.decompress(w)
+        r.inflate_s += time.process_time() - started
+        r.raw += sum(map(len, writes))
+        r.wire += sum(map(len, wire))
+    return r
+
+
+def report(streams: list[list[bytes]], results: list[Result]) -> None:
+    lines = sum(map(len, streams))
+    print(
+        f"{len(streams)} connections, {lines} lines,"
+        f" {results[0].raw / lines:.0f} bytes per line"
+    )
+    print(
+        f"{'level':>5} {'wbits':>5} {'mem':>3} {'flush':>6}"
+        f" {'wire %':>7} {'B/line':>7} {'deflate us/KiB':>15}"
+        f" {'inflate us/KiB':>15} {'KiB/conn':>9}"
+    )
+    for r in results:
+        kib = r.raw / 1024
+        print(
+            f"{r.level:>5} {r.window_bits:>5} {r.mem_level:>3}"
+            f" {r.flush:>6} {r.wire / r.raw * 100:>7.1f}"
+            f" {r.wire / lines:>7.1f} {r.deflate_s / kib * 1e6:>15.1f}"
+            f" {r.inflate_s / kib * 1e6:>15.1f}"
+            f" {r.memory / 1024:>9.0f}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        description="Measure what COMPRESS saves and costs."
+    )
+    p.add_argument("--clients", type=int, default=50)
+    p.add_argument(
+        "--messages", type=int, default=100, help="sent per client"
+    )
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--traffic", help="replay this recording instead")
+    p.add_argument("--save", help="write the recording here")
+    p.add_argument("--json", help="also write the results here")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    streams: list[list[bytes]]
+    if args.traffic:
+        with open(args.traffic) as f:
+            streams = [
+                [line.encode("latin-1") for line in s]
+                for s in json.load(f)
+            ]
+    else:
+        streams = trio.run(record, args)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                [
+                    [line.decode("latin-1") for line in s]
+                    for s in streams
+                ],
+                f,
+            )
+    results = [
+        measure(streams, *setting, flush)
+        for flush in ("line", "64KiB")
+        for setting in SETTINGS
+    ]
+    report(streams, results)
+    if args.json:
+        out: list[dict[str, Any]] = [
+            dict(vars(r), memory=r.memory) for r in results
+        ]
+        with open(args.json, "w") as f:
+            json.dump(out, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
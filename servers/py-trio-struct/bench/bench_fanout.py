@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# CPU time per CHANMSG as the channel grows, for utils.send (encode the
+# line once, then put it in every client's outbound queue) and for the
+# old recursive send that encoded it again for every client and every
+# offline queue and wrote to each stream in turn (copied below).
+#
+#     python3 bench/bench_fanout.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Awaitable, Callable, Optional
+import os
+import sys
+import time
+
+import trio
+import trio.abc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import codec  # noqa: E402
+import entities  # noqa: E402
+import minilog  # noqa: E402
+import offline  # noqa: E402
+import utils  # noqa: E402
+
+SIZES = [10, 100, 1000, 5000]
+# Every fifth member is offline and gets the line queued.
+OFFLINE_EVERY = 5
+ROUNDS = 20
+
+
+class NullStream(trio.abc.SendStream):
+    async def send_all(
+        self, data: bytes | bytearray | memoryview
+    ) -> None:
+        pass
+
+    async def wait_send_all_might_not_block(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def old_send(
+    recver: utils.V,
+    command: bytes,
+    delayable: bool = True,
+    **kwargs: Optional[bytes],
+) -> None:
+    kwargs["RSTS"] = kwargs.get("RSTS", utils.ts())
+    if isinstance(recver, list):
+        for t in recver:
+            await old_send(t, command, delayable, **kwargs)
+    elif isinstance(recver, entities.Client):
+        b = codec.encode_line(command, kwargs)
+        await recver.stream.send_all(b)
+    elif isinstance(recver, entities.User):
+        if recver.connected_clients:
+            for c in recver.connected_clients:
+                await old_send(c, command, delayable, **kwargs)
+        elif delayable:
+            offline.store.append(
+                recver.username, codec.encode_line(command, kwargs)
+            )
+    elif isinstance(recver, entities.Channel):
+        for t in recver.broadcast_to:
+            await old_send(t, command, delayable, **kwargs)
+
+
+async def new_send(
+    recver: utils.V,
+    command: bytes,
+    delayable: bool = True,
+    **kwargs: Optional[bytes],
+) -> None:
+    utils.send(recver, command, delayable, **kwargs)
+
+
+def make_channel(
+    size: int,
+) -> tuple[entities.Channel, list[trio.MemoryReceiveChannel[bytes]]]:
+    users = []
+    outboxes = []
+    for i in range(size):
+        u = entities.User(
+            username=b"user%d@example.org" % i,
+            password=b"",
+        )
+        if i % OFFLINE_EVERY:
+            c = entities.Client(cid=b"%d" % i, stream=NullStream())
+            c.outbox, outbox_recv = trio.open_memory_channel(ROUNDS)
+            outboxes.append(outbox_recv)
+            u.add_client(c)
+        users.append(u)
+    channel = entities.Channel(
+        channelname=b"#bench@example.org",
+        guild=None,
+        broadcast_to=set(users),
+    )
+    return channel, outboxes
+
+
+async def cpu_per_message(
+    send: Callable[..., Awaitable[None]], channel: entities.Channel
+) -> float:
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        await send(
+            channel,
+            b"CHANMSG",
+            SOURCE=b"andrew@andrewyu.org",
+            TYPE=b"NORMAL",
+            TARGET=channel.channelname,
+            MESSAGE=b"Hello everyone, this is a fairly ordinary"
+            b" message.",
+        )
+    elapsed = time.process_time() - start
+    offline.store = offline.MemoryOfflineStore()
+    return elapsed / ROUNDS
+
+
+async def main() -> None:
+    minilog.configure(level_name="info")
+    print(
+        f"{'members':>8} {'old ms/msg':>11} {'new ms/msg':>11}"
+        f" {'old us/rcpt':>12} {'new us/rcpt':>12}"
+    )
+    for size in SIZES:
+        channel, outboxes = make_channel(size)
+        old = await cpu_per_message(old_send, channel)
+        new = await cpu_per_message(new_send, channel)
+        for outbox_recv in outboxes:
+            assert len(outbox_recv.receive_nowait()) > 0
+        print(
+            f"{size:>8} {old * 1e3:11.3f} {new * 1e3:11.3f}"
+            f" {old / size * 1e6:12.2f} {new / size * 1e6:12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    trio.run(main)
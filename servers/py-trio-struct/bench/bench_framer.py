@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+#
+# Compares framer.LineFramer against the old split-the-whole-buffer
+# loop from idc.connection_loop.  On many short lines the framer is
+# slower: it costs a next_line() call per line, which also strips the
+# CR and checks the length, where the old loop just counts.  It only
+# wins once lines are long, since the old loop splits everything it
+# has buffered again on every read.
+#
+#     python3 bench/bench_framer.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Callable, Iterator
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import framer  # noqa: E402
+
+SIZES = [1024, 64 * 1024, 1024 * 1024]
+CHUNK = 512
+
+
+def old_split_loop(chunks: list[bytes]) -> int:
+    n = 0
+    msg = b""
+    for newmsg in chunks:
+        msg += newmsg
+        split_msg = msg.split(b"\n")
+        if split_msg[-1] == b"\r":
+            split_msg = split_msg[:-1]
+        if len(split_msg) < 2:
+            continue
+        data = split_msg[0:-1]
+        msg = split_msg[-1]
+        for cmdline in data:
+            n += 1
+    return n
+
+
+def new_framer(chunks: list[bytes]) -> int:
+    n = 0
+    f = framer.LineFramer(max_line_length=0)
+    for newmsg in chunks:
+        f.feed(newmsg)
+        while f.next_line() is not None:
+            n += 1
+    return n
+
+
+def chunked(data: bytes) -> list[bytes]:
+    return [data[i : i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def inputs(size: int) -> Iterator[tuple[str, list[bytes]]]:
+    line = (
+        b"CHANMSG\tTARGET=#hackers@andrewyu.org\tMESSAGE=" + b"x" * 40
+    )
+    paste = (line + b"\r\n") * (size // (len(line) + 2) + 1)
+    yield "lines", chunked(paste[:size])
+    # One huge line with no LF, which is what a hostile client sends.
+    yield "one line", chunked(b"y" * size + b"\r\n")
+
+
+def timeit(
+    func: Callable[[list[bytes]], int], chunks: list[bytes]
+) -> float:
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        func(chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    print(
+        f"{'input':>20} {'old (s)':>10} {'new (s)':>10} {'speedup':>8}"
+    )
+    for size in SIZES:
+        for name, chunks in inputs(size):
+            assert old_split_loop(chunks) == new_framer(chunks)
+            old = timeit(old_split_loop, chunks)
+            new = timeit(new_framer, chunks)
+            label = f"{size // 1024} KiB {name}"
+            print(
+                f"{label:>20} {old:10.5f} {new:10.5f} {old / new:7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
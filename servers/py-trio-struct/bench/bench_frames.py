@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+#
+# Commands per second read from a client in text lines (LineFramer and
+# codec.decode_line) against binary frames (FrameFramer and
+# codec.decode_frame), for the same commands arriving in 4 KiB reads,
+# and what it costs to write lines and frames out.
+#
+#     python3 bench/bench_frames.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Callable, Union
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import codec  # noqa: E402
+import framer  # noqa: E402
+
+COMMANDS = 20000
+CHUNK = 4096
+
+CASES: list[tuple[str, bytes, dict[str, bytes]]] = [
+    ("PING", b"PING", {"COOKIE": b"12345"}),
+    (
+        "PRIVMSG",
+        b"PRIVMSG",
+        {
+            "TARGET": b"andrew@andrewyu.org",
+            "MESSAGE": b"Just a normal line of chat, nothing special.",
+        },
+    ),
+    (
+        "CHANMSG escaped",
+        b"CHANMSG",
+        {
+            "TARGET": b"#hackers@andrewyu.org",
+            "TYPE": b"NORMAL",
+            "MESSAGE": b"line one\nline two\tindented\n" * 4,
+        },
+    ),
+    (
+        "CHANMSG 1 KiB",
+        b"CHANMSG",
+        {"TARGET": b"#hackers@andrewyu.org", "MESSAGE": b"x" * 1024},
+    ),
+    (
+        "CHANMSG 8 KiB, escaped",
+        b"CHANMSG",
+        {
+            "TARGET": b"#hackers@andrewyu.org",
+            "MESSAGE": b"a log line\twith fields\n" * 350,
+        },
+    ),
+]
+
+Framer = Union[framer.LineFramer, framer.FrameFramer]
+
+
+def read_all(
+    chunks: list[bytes],
+    make: Callable[[], Framer],
+    decode: Callable[[bytes], tuple[bytes, dict[str, bytes]]],
+) -> int:
+    n = 0
+    f = make()
+    for chunk in chunks:
+        f.feed(chunk)
+        while True:
+            body = f.next_line()
+            if body is None:
+                break
+            decode(body)
+            n += 1
+    return n
+
+
+def best(func: Callable[[], object], repeat: int = 3) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def chunked(data: bytes) -> list[bytes]:
+    return [data[i : i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def main() -> None:
+    print("reading, in commands per second and MB/s of wire bytes")
+    print(
+        f"{'case':>24} {'text/s':>9} {'MB/s':>6} {'binary/s':>9}"
+        f" {'MB/s':>6} {'speedup':>8}"
+    )
+    for name, cmd, kwargs in CASES:
+        line = codec.encode_line(cmd, kwargs)
+        frame = codec.encode_frame(cmd, kwargs)
+        assert codec.decode_line(line) == codec.decode_frame(frame[4:])
+        text = chunked(line * COMMANDS)
+        binary = chunked(frame * COMMANDS)
+
+        def lines() -> None:
+            n = read_all(
+                text, lambda: framer.LineFramer(0), codec.decode_line
+            )
+            assert n == COMMANDS
+
+        def frames() -> None:
+            n = read_all(
+                binary,
+                lambda: framer.FrameFramer(0),
+                codec.decode_frame,
+            )
+            assert n == COMMANDS
+
+        t = best(lines)
+        b = best(frames)
+        print(
+            f"{name:>24} {COMMANDS / t:9.0f}"
+            f" {len(line) * COMMANDS / t / 1e6:6.1f}"
+            f" {COMMANDS / b:9.0f}"
+            f" {len(frame) * COMMANDS / b / 1e6:6.1f} {t / b:8.2f}"
+        )
+
+    print()
+    print("writing, in microseconds per command")
+    print(
+        f"{'case':>24} {'line':>7} {'frame':>7} {'line->frame':>12}"
+        f" {'cached':>7}"
+    )
+    for name, cmd, kwargs in CASES:
+        line = codec.encode_line(cmd, kwargs)
+
+        def encode_lines() -> None:
+            for _ in range(COMMANDS):
+                codec.encode_line(cmd, kwargs)
+
+        def encode_frames() -> None:
+            for _ in range(COMMANDS):
+                codec.encode_frame(cmd, kwargs)
+
+        def convert() -> None:
+            # What a binary client's writer does with a line nobody
+            # else has been sent.
+            for _ in range(COMMANDS):
+                codec._frames.clear()
+                codec.frames_of(line)
+
+        def convert_cached() -> None:
+            for _ in range(COMMANDS):
+                codec.frames_of(line)
+
+        us = [
+            best(f) / COMMANDS * 1e6
+            for f in (
+                encode_lines,
+                encode_frames,
+                convert,
+                convert_cached,
+            )
+        ]
+        print(
+            f"{name:>24} {us[0]:7.2f} {us[1]:7.2f} {us[2]:12.2f}"
+            f" {us[3]:7.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
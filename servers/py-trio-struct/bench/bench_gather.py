@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#
+# Memory and writes for a burst of CHANMSGs fanned out to a channel and
+# written to every member over TLS, with the old way of building lines
+# and writing them (one send_all per line, copied below) and the
+# current one (codec.encode_line and idc.write_loop).  tracemalloc can
+# only see blocks that are alive, so what it reports is the peak above
+# what was allocated before the burst, along with the blocks still
+# alive once it's written.  It also reports the peak while encoding a
+# single line, which is what every copy of the MESSAGE costs.
+#
+#     python3 bench/bench_gather.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Awaitable, Callable, Mapping, Optional
+import os
+import ssl
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import trio
+import trio.abc
+import trio.testing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import codec  # noqa: E402
+import entities  # noqa: E402
+import idc  # noqa: E402
+import minilog  # noqa: E402
+import utils  # noqa: E402
+
+from certs import client_context, self_signed  # noqa: E402
+
+SIZES = [10, 100, 1000]
+# CHANMSGs that pile up in every member's queue before it's written.
+BURST = 16
+MESSAGE = b"Hello everyone, this is a fairly ordinary message. " * 4
+
+
+class CountingStream(trio.abc.SendStream):
+    """
+    Stands in for the socket under a TLS stream once the handshake is
+    done, counting writes and throwing the bytes away.
+    """
+
+    def __init__(self) -> None:
+        self.writes = 0
+        self.nbytes = 0
+
+    async def send_all(
+        self, data: bytes | bytearray | memoryview
+    ) -> None:
+        self.writes += 1
+        self.nbytes += len(data)
+
+    async def wait_send_all_might_not_block(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+def old_encode_line(
+    command: bytes, kwargs: Mapping[str, Optional[bytes]]
+) -> bytes:
+    parts = [command.upper()]
+    for key, value in kwargs.items():
+        if value is None:
+            continue
+        if b"\r" in value or b"\n" in value or b"\t" in value:
+            for char, escaped in codec._escapes.items():
+                value = value.replace(char, escaped)
+        parts.append(key.encode("ascii") + b"=" + value)
+    return b"\t".join(parts) + b"\r\n"
+
+
+async def old_write_loop(
+    client: entities.Client,
+    outbox_recv: trio.MemoryReceiveChannel[bytes],
+) -> None:
+    async with outbox_recv:
+        async for line in outbox_recv:
+            await client.stream.send_all(line)
+
+
+async def tls_client(
+    server_ctx: ssl.SSLContext,
+) -> tuple[entities.Client, CountingStream]:
+    server_raw, client_raw = trio.testing.memory_stream_pair()
+    server = trio.SSLStream(server_raw, server_ctx, server_side=True)
+    client = trio.SSLStream(
+        client_raw, client_context(), server_hostname="localhost"
+    )
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(server.do_handshake)
+        nursery.start_soon(client.do_handshake)
+    counting = CountingStream()
+    server.transport_stream = counting
+    return entities.Client(cid=b"bench", stream=server), counting
+
+
+async def make_channel(
+    size: int, server_ctx: ssl.SSLContext
+) -> tuple[
+    entities.Channel, list[entities.Client], list[CountingStream]
+]:
+    users = []
+    clients = []
+    streams = []
+    for i in range(size):
+        u = entities.User(
+            username=b"user%d@example.org" % i, password=b""
+        )
+        c, counting = await tls_client(server_ctx)
+        u.add_client(c)
+        users.append(u)
+        clients.append(c)
+        streams.append(counting)
+    channel = entities.Channel(
+        channelname=b"#bench@example.org",
+        guild=None,
+        broadcast_to=set(users),
+    )
+    return channel, clients, streams
+
+
+async def burst(
+    channel: entities.Channel,
+    clients: list[entities.Client],
+    encode: Callable[[bytes, Mapping[str, Optional[bytes]]], bytes],
+    write_loop: Callable[
+        [entities.Client, trio.MemoryReceiveChannel[bytes]],
+        Awaitable[None],
+    ],
+) -> None:
+    receivers = []
+    for c in clients:
+        c.outbox, outbox_recv = trio.open_memory_channel(BURST)
+        receivers.append(outbox_recv)
+    for i in range(BURST):
+        line = encode(
+            b"CHANMSG",
+            {
+                "SOURCE": b"andrew@andrewyu.org",
+                "TYPE": b"NORMAL",
+                "TARGET": channel.channelname,
+                "MESSAGE": MESSAGE,
+                "ID": b"%d" % (1 << 60 | i),
+                "RSTS": utils.ts(),
+            },
+        )
+        utils.deliver(line, utils.resolve_recipients(channel))
+    for c in clients:
+        assert c.outbox is not None
+        c.outbox.close()
+    async with trio.open_nursery() as nursery:
+        for c, outbox_recv in zip(clients, receivers):
+            nursery.start_soon(write_loop, c, outbox_recv)
+
+
+def encode_peak(
+    encode: Callable[[bytes, Mapping[str, Optional[bytes]]], bytes],
+    message: bytes,
+) -> tuple[int, int]:
+    """
+    The most bytes allocated at once while encoding a CHANMSG, and how
+    long the line is.
+    """
+    kwargs = {"SOURCE": b"andrew@andrewyu.org", "MESSAGE": message}
+    encode(b"CHANMSG", kwargs)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    line = encode(b"CHANMSG", kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - base, len(line)
+
+
+async def main() -> None:
+    minilog.configure(level_name="info")
+    print(f"{'MESSAGE':>8} {'line':>6} {'old peak':>9} {'new peak':>9}")
+    for n in [64, 1024, 8192]:
+        message = b"x" * n
+        old, length = encode_peak(old_encode_line, message)
+        new, _ = encode_peak(codec.encode_line, message)
+        print(f"{n:>8} {length:>6} {old:>9} {new:>9}")
+    print()
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = self_signed(directory)
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(cert, key)
+    print(
+        f"{BURST} CHANMSGs of {len(MESSAGE)} bytes per member,"
+        " written over TLS"
+    )
+    print(
+        f"{'members':>8} {'way':>4} {'peak KiB':>9} {'left':>7}"
+        f" {'writes':>7} {'wire KiB':>9} {'us/line':>8}"
+    )
+    ways = [
+        ("old", old_encode_line, old_write_loop),
+        ("new", codec.encode_line, idc.write_loop),
+    ]
+    for size in SIZES:
+        channel, clients, streams = await make_channel(size, server_ctx)
+        for name, encode, write_loop in ways:
+            # Once to warm up and time, once to trace.
+            for s in streams:
+                s.writes = s.nbytes = 0
+            start = time.process_time()
+            await burst(channel, clients, encode, write_loop)
+            elapsed = time.process_time() - start
+            writes = sum(s.writes for s in streams)
+            nbytes = sum(s.nbytes for s in streams)
+            tracemalloc.start()
+            base, _ = tracemalloc.get_traced_memory()
+            before = tracemalloc.take_snapshot()
+            await burst(channel, clients, encode, write_loop)
+            _, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            blocks = sum(
+                d.count_diff
+                for d in after.compare_to(before, "filename")
+            )
+            print(
+                f"{size:>8} {name:>4} {(peak - base) / 1024:9.1f}"
+                f" {blocks:7d} {writes:7d} {nbytes / 1024:9.1f}"
+                f" {elapsed / (size * BURST) * 1e6:8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+#
+# Load generator: starts idc.py on loopback with a throwaway
+# certificate, connects lots of TLS clients that each log in as their
+# own user, then has every client send a mix of PRIVMSGs (to a random
+# user) and CHANMSGs (to #bench, which the first --members users are
+# in).  Reports throughput, delivery latency and whether every message
+# reached every recipient exactly once, as JSON.
+#
+#     python3 bench/bench_load.py --clients 2000 --procs 2
+#     python3 bench/bench_load.py --help
+#
+# Latency is measured two ways: from the RSTS the server stamped on
+# the line to the client reading it ("server_to_client"), and from the
+# sender writing the message, whose send time is inside MESSAGE, to the
+# recipient reading it ("end_to_end").  Both ends are on this machine,
+# so the clocks agree.
+#
+# Which client sends what to whom is worked out up front from --seed,
+# so every load process knows what each of its clients should get
+# without having to talk to the others.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Optional
+import argparse
+import json
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+import trio
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import harness  # noqa: E402
+
+PRIVMSG = b"PRIVMSG"
+CHANMSG = b"CHANMSG"
+
+# Per sender, in order: (command, target user or -1 for the channel).
+Plan = list[list[tuple[bytes, int]]]
+
+
+def make_plan(args: argparse.Namespace) -> Plan:
+    rng = random.Random(args.seed)
+    plan = []
+    for _ in range(args.clients):
+        messages = []
+        for _ in range(args.messages):
+            if rng.random() < args.privmsg_ratio:
+                messages.append((PRIVMSG, rng.randrange(args.clients)))
+            else:
+                messages.append((CHANMSG, -1))
+        plan.append(messages)
+    return plan
+
+
+def recipients(
+    sender: int, command: bytes, target: int, members: int
+) -> list[int]:
+    if command == CHANMSG:
+        return list(range(members))
+    if target == sender:
+        return [sender]
+    # The sender gets its own PRIVMSG echoed back.
+    return [target, sender]
+
+
+def expected_for(
+    plan: Plan, members: int, clients: range
+) -> dict[int, set[bytes]]:
+    """
+    Message IDs each of these clients should receive.
+    """
+    wanted = set(clients)
+    expected: dict[int, set[bytes]] = {i: set() for i in clients}
+    for sender, messages in enumerate(plan):
+        for seq, (command, target) in enumerate(messages):
+            for r in recipients(sender, command, target, members):
+                if r in wanted:
+                    expected[r].add(b"%d.%d" % (sender, seq))
+    return expected
+
+
+def field_of(line: bytes, key: bytes) -> Optional[bytes]:
+    for arg in line.split(b"\t")[1:]:
+        k, _, v = arg.partition(b"=")
+        if k == key:
+            return v
+    return None
+
+
+@dataclass
+class Results:
+    sent: int = 0
+    expected: int = 0
+    delivered: int = 0
+    duplicates: int = 0
+    missing: int = 0
+    unexpected: int = 0
+    disconnected: int = 0
+    first_send: float = float("inf")
+    last_receive: float = 0.0
+    server_to_client: list[float] = field(default_factory=list)
+    end_to_end: list[float] = field(default_factory=list)
+
+    def merge(self, other: Results) -> None:
+        for name in (
+            "sent",
+            "expected",
+            "delivered",
+            "duplicates",
+            "missing",
+            "unexpected",
+            "disconnected",
+        ):
+            setattr(
+                self, name, getattr(self, name) + getattr(other, name)
+            )
+        self.first_send = min(self.first_send, other.first_send)
+        self.last_receive = max(self.last_receive, other.last_receive)
+        self.server_to_client += other.server_to_client
+        self.end_to_end += other.end_to_end
+
+
+async def run_slice(
+    args: argparse.Namespace,
+    port: int,
+    clients: range,
+    barrier: Any,
+) -> Results:
+    plan = make_plan(args)
+    expected = expected_for(plan, args.members, clients)
+    results = Results()
+    received: dict[int, Counter[bytes]] = {
+        i: Counter() for i in clients
+    }
+    conns: dict[int, harness.Client] = {}
+    handshakes = trio.Semaphore(args.connect_concurrency)
+
+    async def connect(i: int) -> None:
+        async with handshakes:
+            c = await harness.Client.connect(port)
+            await c.login(i)
+            conns[i] = c
+
+    async with trio.open_nursery() as nursery:
+        for i in clients:
+            nursery.start_soon(connect, i)
+    # Nobody sends until every process has all its clients logged in,
+    # so nothing ends up in an offline queue.
+    await trio.to_thread.run_sync(barrier.wait)
+
+    remaining = sum(1 for i in clients if expected[i])
+    all_in = trio.Event()
+    if not remaining:
+        all_in.set()
+
+    async def read(i: int, c: harness.Client) -> None:
+        nonlocal remaining
+        want = expected[i]
+        got = received[i]
+        done = not want
+        have = 0
+        try:
+            while True:
+                line = await c.readline()
+                now = time.time()
+                command = line.split(b"\t", 1)[0]
+                if command not in (PRIVMSG, CHANMSG):
+                    continue
+                message = field_of(line, b"MESSAGE")
+                rsts = field_of(line, b"RSTS")
+                if message is None:
+                    continue
+                msg_id, _, sent_at = message.partition(b" ")
+                got[msg_id] += 1
+                if got[msg_id] == 1 and msg_id in want:
+                    have += 1
+                results.last_receive = max(results.last_receive, now)
+                if rsts is not None:
+                    results.server_to_client.append(now - float(rsts))
+                results.end_to_end.append(now - float(sent_at))
+                if not done and have == len(want):
+                    done = True
+                    remaining -= 1
+                    if not remaining:
+                        all_in.set()
+        except (EOFError, trio.BrokenResourceError):
+            results.disconnected += 1
+
+    async def send(i: int, c: harness.Client) -> None:
+        interval = 1 / args.rate if args.rate else 0
+        # Spread the clients' first messages over one interval.
+        await trio.sleep(random.random() * interval)
+        for seq, (command, target) in enumerate(plan[i]):
+            if command == PRIVMSG:
+                to = harness.username(target)
+            else:
+                to = harness.CHANNEL
+            now = time.time()
+            results.first_send = min(results.first_send, now)
+            try:
+                await c.send(
+                    b"%s\tTARGET=%s\tMESSAGE=%d.%d %r\r\n"
+                    % (command, to, i, seq, now)
+                )
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                # read() has noticed, or will.
+                return
+            results.sent += 1
+            await trio.sleep(interval)
+
+    sending_time = args.messages / args.rate if args.rate else 0
+    async with trio.open_nursery() as nursery:
+        for i, c in conns.items():
+            nursery.start_soon(read, i, c)
+            nursery.start_soon(send, i, c)
+        with trio.move_on_after(sending_time + args.drain_timeout):
+            await all_in.wait()
+        # Stick around a little to catch duplicates.
+        await trio.sleep(args.grace)
+        nursery.cancel_scope.cancel()
+
+    for i in clients:
+        want = expected[i]
+        got = received[i]
+        results.expected += len(want)
+        for msg_id, n in got.items():
+            if msg_id in want:
+                results.delivered += 1
+                results.duplicates += n - 1
+            else:
+                results.unexpected += n
+        results.missing += len(want - got.keys())
+    for c in conns.values():
+        await c.aclose()
+    return results
+
+
+def _slice_process(
+    args: argparse.Namespace,
+    port: int,
+    clients: range,
+    barrier: multiprocessing.synchronize.Barrier,
+    out: Any,
+) -> None:
+    out.put(trio.run(run_slice, args, port, clients, barrier))
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    if not samples:
+        return {}
+    samples.sort()
+    n = len(samples)
+
+    def at(q: float) -> float:
+        return round(samples[min(n - 1, int(q * n))] * 1000, 3)
+
+    return {
+        "p50": at(0.5),
+        "p99": at(0.99),
+        "p999": at(0.999),
+        "max": round(samples[-1] * 1000, 3),
+    }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    results = Results()
+    slices = [
+        range(p, args.clients, args.procs) for p in range(args.procs)
+    ]
+    with harness.start_server(
+        args.clients,
+        members=args.members,
+        workers=args.workers,
+        extra=args.extra_config,
+        log=args.server_log,
+    ) as server:
+        started = time.perf_counter()
+        if args.procs == 1:
+            results = trio.run(
+                run_slice,
+                args,
+                server.port,
+                slices[0],
+                threading.Barrier(1),
+            )
+        else:
+            barrier = multiprocessing.Barrier(args.procs)
+            out: Any = multiprocessing.Queue()
+            procs = [
+                multiprocessing.Process(
+                    target=_slice_process,
+                    args=(args, server.port, s, barrier, out),
+                )
+                for s in slices
+            ]
+            for p in procs:
+                p.start()
+            for _ in procs:
+                while True:
+                    try:
+                        results.merge(out.get(timeout=1))
+                        break
+                    except queue.Empty:
+                        if any(p.exitcode for p in procs):
+                            raise RuntimeError("A load process died")
+            for p in procs:
+                p.join()
+        wall = time.perf_counter() - started
+
+    elapsed = max(results.last_receive - results.first_send, 1e-9)
+    return {
+        "config": {
+            k: v for k, v in vars(args).items() if k != "output"
+        },
+        "wall_seconds": round(wall, 3),
+        "active_seconds": round(elapsed, 3),
+        "sent": results.sent,
+        "expected_deliveries": results.expected,
+        "delivered": results.delivered,
+        "duplicates": results.duplicates,
+        "missing": results.missing,
+        "unexpected": results.unexpected,
+        "disconnected_clients": results.disconnected,
+        "exactly_once": (
+            results.delivered == results.expected
+            and not results.duplicates
+            and not results.unexpected
+        ),
+        "messages_per_second": round(results.sent / elapsed, 1),
+        "deliveries_per_second": round(
+            len(results.end_to_end) / elapsed, 1
+        ),
+        "latency_ms": {
+            "server_to_client": percentiles(results.server_to_client),
+            "end_to_end": percentiles(results.end_to_end),
+        },
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        description="Load test idc.py over loopback TLS."
+    )
+    p.add_argument("--clients", type=int, default=1000)
+    p.add_argument(
+        "--messages", type=int, default=10, help="per client"
+    )
+    p.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="messages per second per client, 0 for as fast as"
+        " possible",
+    )
+    p.add_argument(
+        "--privmsg-ratio",
+        type=float,
+        default=0.9,
+        help="share of PRIVMSGs, the rest are CHANMSGs",
+    )
+    p.add_argument(
+        "--members", type=int, default=20, help="users in #bench"
+    )
+    p.add_argument(
+        "--workers", type=int, default=1, help="server processes"
+    )
+    p.add_argument(
+        "--procs", type=int, default=1, help="load generator processes"
+    )
+    p.add_argument("--connect-concurrency", type=int, default=100)
+    p.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=30.0,
+        help="seconds to wait for deliveries after the last send",
+    )
+    p.add_argument(
+        "--grace",
+        type=float,
+        default=1.0,
+        help="seconds to keep reading for duplicates",
+    )
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument(
+        "--extra-config",
+        default="",
+        help="Python appended to the server's generated config.py",
+    )
+    p.add_argument(
+        "--server-log", help="write the server's output here"
+    )
+    p.add_argument("--output", help="write the JSON here too")
+    args = p.parse_args()
+    args.members = min(args.members, args.clients)
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if not report["exactly_once"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
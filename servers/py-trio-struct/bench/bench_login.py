@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+#
+# LOGIN latency against channel count and offline backlog size: time
+# from handling LOGIN until the client has read END_OFFLINE_MESSAGES
+# over TLS on a socketpair, with the burst written line by line
+# (burst_size 0, how it used to be) and coalesced.
+#
+#     python3 bench/bench_login.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import os
+import ssl
+import sys
+import tempfile
+import time
+
+import trio
+import trio.abc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import accounts  # noqa: E402
+import certs  # noqa: E402
+import config  # noqa: E402
+import entities  # noqa: E402
+import idc  # noqa: E402
+import minilog  # noqa: E402
+import offline  # noqa: E402
+import passwords  # noqa: E402
+import utils  # noqa: E402
+
+CHANNELS = [1, 100, 500]
+BACKLOGS = [0, 1000, 10000]
+MEMBERS = 50
+# Keep password checking out of the numbers.
+config.passwords.scheme = "pbkdf2-sha256"
+config.passwords.pbkdf2_iterations = 1
+PASSWORD = passwords.hash_sync(b"pw")
+USERNAME = b"bench@example.org"
+LINE = (
+    b"PRIVMSG\tSOURCE=hax@andrewyu.org\tTYPE=NORMAL\t"
+    b"TARGET=bench@example.org\tMESSAGE=you there?\t"
+    b"RSTS=1660000000.123456\r\n"
+)
+
+
+class CountingStream(trio.abc.SendStream):
+    def __init__(self, stream: trio.SSLStream) -> None:
+        self.stream = stream
+        self.writes = 0
+
+    async def send_all(
+        self, data: bytes | bytearray | memoryview
+    ) -> None:
+        self.writes += 1
+        await self.stream.send_all(data)
+
+    async def wait_send_all_might_not_block(self) -> None:
+        await self.stream.wait_send_all_might_not_block()
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+
+def setup_user(n_channels: int, backlog: int) -> entities.User:
+    members = [
+        entities.User(
+            username=b"member%d@example.org" % i,
+            password=b"",
+        )
+        for i in range(MEMBERS)
+    ]
+    user = entities.User(username=USERNAME, password=PASSWORD)
+    for i in range(n_channels):
+        channel = entities.Channel(
+            channelname=b"#chan%d@example.org" % i,
+            guild=None,
+            broadcast_to=set(members),
+        )
+        utils.join_channel(user, channel)
+    accounts.directory.users[USERNAME] = user
+    offline.store = offline.MemoryOfflineStore()
+    for _ in range(backlog):
+        offline.store.append(USERNAME, LINE)
+    return user
+
+
+async def one_login(
+    sctx: ssl.SSLContext, n_channels: int, backlog: int, burst_size: int
+) -> tuple[float, int]:
+    config.outbound.burst_size = burst_size
+    setup_user(n_channels, backlog)
+    a, b = trio.socket.socketpair()
+    server = trio.SSLStream(
+        trio.SocketStream(a), sctx, server_side=True
+    )
+    peer = trio.SSLStream(
+        trio.SocketStream(b),
+        certs.client_context(),
+        server_hostname="x",
+    )
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(server.do_handshake)
+        nursery.start_soon(peer.do_handshake)
+
+    stream = CountingStream(server)
+    client = entities.Client(cid=b"0", stream=stream)  # type: ignore
+    outbox_recv: trio.MemoryReceiveChannel[bytes]
+    client.outbox, outbox_recv = trio.open_memory_channel(1024)
+    elapsed = 0.0
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(idc.write_loop, client, outbox_recv)
+
+        async def read_until_done() -> None:
+            tail = b""
+            async for data in peer:
+                if b"END_OFFLINE_MESSAGES" in tail + data:
+                    return
+                tail = data[-32:]
+
+        start = time.perf_counter()
+        async with trio.open_nursery() as inner:
+            inner.start_soon(read_until_done)
+            await idc._login_cmd(
+                client, {"USERNAME": USERNAME, "PASSWORD": b"pw"}
+            )
+        elapsed = time.perf_counter() - start
+        client.outbox.close()
+    await server.aclose()
+    await peer.aclose()
+    return elapsed, stream.writes
+
+
+async def main() -> None:
+    minilog.configure(level_name="info")
+    with tempfile.TemporaryDirectory() as d:
+        cert, key = certs.self_signed(d)
+        sctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        sctx.load_cert_chain(cert, key)
+        print(
+            f"{'channels':>8} {'backlog':>8}"
+            f" {'old ms':>8} {'writes':>7}"
+            f" {'new ms':>8} {'writes':>7}"
+        )
+        for n_channels in CHANNELS:
+            for backlog in BACKLOGS:
+                old, old_writes = await one_login(
+                    sctx, n_channels, backlog, 0
+                )
+                new, new_writes = await one_login(
+                    sctx, n_channels, backlog, 65536
+                )
+                print(
+                    f"{n_channels:>8} {backlog:>8} {old * 1e3:8.1f}"
+                    f" {old_writes:>7} {new * 1e3:8.1f} {new_writes:>7}"
+                )
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+#
+# What loopwatch.LoopWatch adds to every task step: tasks that do
+# nothing but yield, with and without it, plus what marking a command
+# as being handled costs.
+#
+#     python3 bench/bench_loopwatch.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import os
+import sys
+import time
+
+import trio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import loopwatch  # noqa: E402
+import minilog  # noqa: E402
+
+TASKS = 100
+STEPS = 2000
+ROUNDS = 5
+
+
+async def yielder() -> None:
+    for _ in range(STEPS):
+        await trio.lowlevel.checkpoint()
+
+
+async def steps(watched: bool) -> float:
+    """
+    Seconds of CPU per task step.
+    """
+    best = float("inf")
+    for _ in range(ROUNDS):
+        async with trio.open_nursery() as nursery:
+            if watched:
+                watch = loopwatch.LoopWatch(0.1, 50, 20)
+                await nursery.start(watch.run, 0.5)
+            start = time.process_time()
+            async with trio.open_nursery() as inner:
+                for _ in range(TASKS):
+                    inner.start_soon(yielder)
+            best = min(best, time.process_time() - start)
+            nursery.cancel_scope.cancel()
+    return best / (TASKS * STEPS)
+
+
+def handling() -> float:
+    n = 1000000
+    start = time.perf_counter()
+    for _ in range(n):
+        token = loopwatch.handling.set((b"17", b"CHANMSG"))
+        loopwatch.handling.reset(token)
+    return (time.perf_counter() - start) / n
+
+
+async def main() -> None:
+    minilog.configure(level_name="info")
+    plain = await steps(False)
+    watched = await steps(True)
+    print(f"task step, unwatched  {plain * 1e6:6.2f} us")
+    print(f"task step, watched    {watched * 1e6:6.2f} us")
+    print(f"marking a command     {handling() * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+#
+# Memory footprint of idle TLS connections, registered users (a million
+# by default), channel memberships and queued offline messages.  Each
+# kind is grown in steps, and after every step the growth in
+# tracemalloc's traced bytes and in the process's RSS is divided by the
+# number of things added.
+#
+#     python3 bench/bench_memory.py
+#     python3 bench/bench_memory.py --clients 4000 --top 5 \
+#         --json out.json
+#
+# The connections are opened by a separate process so that only the
+# server's side of them is counted here: the Client, both streams, the
+# TLS state and buffers, the outbound queue and the connection's tasks.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Iterator
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import ssl
+import sys
+import tempfile
+import tracemalloc
+
+import trio
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+import certs  # noqa: E402
+import harness  # noqa: E402
+import entities  # noqa: E402
+import idc  # noqa: E402
+import minilog  # noqa: E402
+import metrics  # noqa: E402
+import offline  # noqa: E402
+import utils  # noqa: E402
+
+LINE = (
+    b"PRIVMSG\tSOURCE=user1@example.org\tTYPE=NORMAL\t"
+    b"TARGET=user0@example.org\tMESSAGE=are you there? %08d\t"
+    b"RSTS=1660000000.123456\r\n"
+)
+
+
+def rss() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+@dataclass
+class Step:
+    count: int
+    traced: int
+    rss: int
+
+
+@dataclass
+class Series:
+    kind: str
+    steps: list[Step] = field(default_factory=list)
+    top: list[tuple[str, int]] = field(default_factory=list)
+
+
+@dataclass
+class Meter:
+    """
+    Measures how much memory has been added since it was created.
+    """
+
+    top_n: int
+    snapshot: Any = None
+    traced: int = 0
+    rss: int = 0
+
+    def __post_init__(self) -> None:
+        gc.collect()
+        self.snapshot = tracemalloc.take_snapshot()
+        self.traced = tracemalloc.get_traced_memory()[0]
+        self.rss = rss()
+
+    def step(self, series: Series, count: int) -> None:
+        gc.collect()
+        series.steps.append(
+            Step(
+                count,
+                tracemalloc.get_traced_memory()[0] - self.traced,
+                rss() - self.rss,
+            )
+        )
+
+    def breakdown(self, series: Series) -> None:
+        if not self.top_n:
+            return
+        gc.collect()
+        stats = tracemalloc.take_snapshot().compare_to(
+            self.snapshot, "lineno"
+        )
+        for stat in stats[: self.top_n]:
+            frame = stat.traceback[0]
+            where = f"{os.path.basename(frame.filename)}:{frame.lineno}"
+            series.top.append((where, stat.size_diff))
+
+
+def curve(maximum: int, start: int) -> Iterator[int]:
+    n = min(start, maximum)
+    while n < maximum:
+        yield n
+        n *= 2
+    yield maximum
+
+
+def measure_users(args: argparse.Namespace) -> Series:
+    # Loaded the way idc.py does it, into a dict keyed on the name.
+    series = Series("user")
+    users: dict[bytes, entities.User] = {}
+    meter = Meter(args.top)
+    for target in curve(args.users, args.start):
+        while len(users) < target:
+            i = len(users)
+            username = entities.intern_name(b"user%d@example.org" % i)
+            users[username] = entities.User(
+                username=username,
+                # A real hash is about this long, and unique.
+                password=b"$scrypt$n=16384,r=8,p=1$%022d$%043d"
+                % (i, i),
+                options=entities.intern_flags(["offline-messages"]),
+            )
+        meter.step(series, target)
+    meter.breakdown(series)
+    return series
+
+
+def measure_memberships(args: argparse.Namespace) -> Series:
+    series = Series("channel membership")
+    users = [
+        entities.User(username=b"user%d@example.org" % i, password=b"")
+        for i in range(args.members)
+    ]
+    channel = entities.Channel(
+        channelname=b"#big@example.org", guild=None
+    )
+    meter = Meter(args.top)
+    added = 0
+    for target in curve(args.members, args.start):
+        while added < target:
+            utils.join_channel(users[added], channel)
+            added += 1
+        meter.step(series, target)
+    meter.breakdown(series)
+    return series
+
+
+def measure_offline(
+    args: argparse.Namespace, kind: str, store: offline.OfflineStore
+) -> Series:
+    series = Series(f"offline message ({kind})")
+    meter = Meter(args.top)
+    added = 0
+    for target in curve(args.messages, args.start):
+        while added < target:
+            # A hundred users with a backlog each.
+            store.append(
+                b"user%d@example.org" % (added % 100), LINE % added
+            )
+            added += 1
+        meter.step(series, target)
+    meter.breakdown(series)
+    store.close()
+    return series
+
+
+def _opener(conn: Connection) -> None:
+    """
+    Runs in the child process: open however many connections the
+    parent asks for and keep them open until told to stop.
+    """
+    port = conn.recv()
+
+    async def main() -> None:
+        streams: list[harness.Client] = []
+        while True:
+            n = await trio.to_thread.run_sync(conn.recv)
+            if n is None:
+                break
+            async with trio.open_nursery() as nursery:
+                for _ in range(n):
+                    nursery.start_soon(open_one, streams)
+            conn.send(len(streams))
+        for s in streams:
+            await s.aclose()
+
+    async def open_one(streams: list[harness.Client]) -> None:
+        streams.append(await harness.Client.connect(port))
+
+    trio.run(main)
+
+
+async def measure_clients(
+    args: argparse.Namespace,
+    parent: Connection,
+    proc: multiprocessing.Process,
+) -> Series:
+    series = Series("idle TLS client")
+    async with trio.open_nursery() as nursery:
+        listeners = await nursery.start(
+            trio.serve_tcp, idc.tls_wrapper, 0
+        )
+        parent.send(listeners[0].socket.getsockname()[1])
+        meter = Meter(args.top)
+        opened = 0
+        for target in curve(args.clients, args.start):
+            parent.send(target - opened)
+            opened = await trio.to_thread.run_sync(parent.recv)
+            # The MOTD and CLIENT_CERT have to go out, and every task
+            # settle into waiting, before this counts as idle.
+            while metrics.connections.value < opened:
+                await trio.sleep(0.05)
+            await trio.sleep(0.5)
+            meter.step(series, target)
+        meter.breakdown(series)
+        parent.send(None)
+        await trio.to_thread.run_sync(proc.join)
+        nursery.cancel_scope.cancel()
+    return series
+
+
+def report(all_series: list[Series]) -> None:
+    for series in all_series:
+        print(f"== {series.kind}")
+        print(
+            f"{'count':>10} {'traced':>12} {'per item':>9}"
+            f" {'RSS':>12} {'per item':>9}"
+        )
+        for s in series.steps:
+            print(
+                f"{s.count:>10} {s.traced:>12}"
+                f" {s.traced / s.count:>9.0f}"
+                f" {s.rss:>12} {s.rss / s.count:>9.0f}"
+            )
+        for where, size in series.top:
+            print(f"    {size:>12} {where}")
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        description="Measure idc.py's memory use per kind of thing."
+    )
+    p.add_argument("--clients", type=int, default=2000)
+    p.add_argument("--users", type=int, default=1000000)
+    p.add_argument("--members", type=int, default=100000)
+    p.add_argument("--messages", type=int, default=100000)
+    p.add_argument(
+        "--start",
+        type=int,
+        default=250,
+        help="first step of each curve",
+    )
+    p.add_argument(
+        "--top",
+        type=int,
+        default=0,
+        help="show this many allocation sites for each kind",
+    )
+    p.add_argument("--json", help="also write the results here")
+    return p.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    minilog.configure(level_name="warning")
+    directory = tempfile.mkdtemp(prefix="idc-bench-")
+    cert, key = certs.self_signed(directory)
+    idc.ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    idc.ctx.load_cert_chain(cert, key)
+
+    # Forked before anything else so that it starts out small and
+    # outside of trio.run().
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_opener, args=(child,))
+    proc.start()
+
+    tracemalloc.start()
+    measurements: list[Callable[[], Series]] = [
+        lambda: trio.run(measure_clients, args, parent, proc),
+        lambda: measure_users(args),
+        lambda: measure_memberships(args),
+        lambda: measure_offline(
+            args, "memory", offline.MemoryOfflineStore()
+        ),
+        lambda: measure_offline(
+            args,
+            "segment",
+            offline.SegmentOfflineStore(
+                os.path.join(directory, "offline.log")
+            ),
+        ),
+    ]
+    results = []
+    for measure in measurements:
+        results.append(measure())
+    tracemalloc.stop()
+
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                [
+                    {
+                        "kind": s.kind,
+                        "steps": [vars(step) for step in s.steps],
+                        "top": s.top,
+                    }
+                    for s in results
+                ],
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# What recording metrics costs per line and per command: the counter
+# bump in read_loop and write_loop, and the timing and histogram update
+# around every command handler.
+#
+#     python3 bench/bench_metrics.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Callable
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import metrics  # noqa: E402
+
+N = 1000000
+
+
+def counter() -> None:
+    c = metrics.Counter("bench_total", "")
+    for _ in range(N):
+        c.inc(100)
+
+
+def timed_command() -> None:
+    h = metrics.commands["BENCH"]
+    for _ in range(N):
+        started = time.perf_counter()
+        h.observe(time.perf_counter() - started)
+
+
+def empty() -> None:
+    for _ in range(N):
+        pass
+
+
+def timeit(func: Callable[[], None]) -> float:
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best / N * 1e9
+
+
+def main() -> None:
+    base = timeit(empty)
+    print(f"{'ns each':>24}")
+    print(f"{'Counter.inc()':>24} {timeit(counter) - base:7.0f}")
+    print(f"{'timed command':>24} {timeit(timed_command) - base:7.0f}")
+    start = time.perf_counter()
+    text = metrics.exposition()
+    elapsed = (time.perf_counter() - start) * 1e6
+    print(f"{'exposition()':>24} {elapsed:7.0f} us, {len(text)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Cost of the per-line debug logging in read_loop: the old eager
+# f-string and print() against minilog with debug switched off, and
+# with debug on but buffered.  "caller" is the time spent where the
+# line is logged, "total" adds the formatting and writing that the
+# buffered sink does later in its thread.  Output goes to /dev/null.
+#
+#     python3 bench/bench_minilog.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Callable
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import minilog  # noqa: E402
+
+N = 200000
+CID = "42"
+LINE = (
+    b"CHANMSG\tTARGET=#hackers@andrewyu.org\tMESSAGE=hello there"
+    b"\tRSTS=1660000000.123456\r\n"
+)
+
+
+def old(devnull: minilog.TextIO) -> None:
+    for _ in range(N):
+        print(
+            minilog.textStyle.fgBrightWhite
+            + "[D] "
+            + f"{CID} >>> {LINE!r}"
+            + minilog.textStyle.reset,
+            file=devnull,
+        )
+
+
+def new(devnull: minilog.TextIO) -> None:
+    for _ in range(N):
+        minilog.debug("%s >>> %r", CID, LINE)
+
+
+def timeit(
+    func: Callable[[minilog.TextIO], None],
+) -> tuple[float, float]:
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            start = time.perf_counter()
+            func(devnull)
+            caller = time.perf_counter() - start
+            minilog.flush()
+            total = time.perf_counter() - start
+            return caller / N * 1e9, total / N * 1e9
+        finally:
+            sys.stdout = sys.__stdout__
+
+
+def main() -> None:
+    print(f"{'ns/line':>32} {'caller':>8} {'total':>8}")
+    caller, total = timeit(old)
+    print(f"{'old f-string + print()':>32} {caller:8.0f} {total:8.0f}")
+    cases = [
+        ("debug, unbuffered", "debug", False, "info"),
+        ("debug, buffered", "debug", True, "info"),
+        ("info, ring at info", "info", True, "info"),
+        ("info, ring at debug", "info", True, "debug"),
+    ]
+    for label, level, buffered, ring_level in cases:
+        minilog.configure(
+            level_name=level,
+            buffered=buffered,
+            ring_level_name=ring_level,
+        )
+        if isinstance(minilog.sink, minilog.BufferedSink):
+            # Stand in for flush_loop(), which would keep up.
+            minilog.sink.max_pending = N + 1
+        caller, total = timeit(new)
+        print(f"{label:>32} {caller:8.0f} {total:8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Time to queue and then drain one user's offline backlog: the old
+# list.pop(0) loop against offline.MemoryOfflineStore and
+# offline.SegmentOfflineStore, plus how long the segment store takes to
+# come back after a restart.
+#
+#     python3 bench/bench_offline.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import os
+import sys
+import tempfile
+import time
+
+import trio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import offline  # noqa: E402
+
+SIZES = [1000, 10000, 100000]
+# Lines per peek(), as cluster.drain_backlog does.
+BATCH = 256
+USER = b"andrew@andrewyu.org"
+LINE = (
+    b"PRIVMSG\tSOURCE=hax@andrewyu.org\tTYPE=NORMAL\t"
+    b"TARGET=andrew@andrewyu.org\tMESSAGE=you there?\t"
+    b"RSTS=1660000000.123456\r\n"
+)
+
+
+def old_list(n: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    queue: list[bytes] = []
+    for _ in range(n):
+        queue.append(LINE)
+    mid = time.perf_counter()
+    for i in range(len(queue)):
+        queue.pop(0)
+    return mid - start, time.perf_counter() - mid
+
+
+def store(s: offline.OfflineStore, n: int) -> tuple[float, float]:
+    start = time.perf_counter()
+    for _ in range(n):
+        s.append(USER, LINE)
+    trio.run(s.sync)
+    mid = time.perf_counter()
+    got = 0
+    while True:
+        pos, lines = s.peek(USER, BATCH)
+        s.consume(USER, pos + len(lines))
+        got += len(lines)
+        if len(lines) < BATCH:
+            break
+    assert got == n
+    return mid - start, time.perf_counter() - mid
+
+
+def main() -> None:
+    print(
+        f"{'backlog':>8} {'store':>8}"
+        f" {'queue (s)':>10} {'drain (s)':>10}"
+        f" {'replay (s)':>10}"
+    )
+    with tempfile.TemporaryDirectory() as d:
+        for n in SIZES:
+            q, dr = old_list(n)
+            print(f"{n:>8} {'list':>8} {q:10.4f} {dr:10.4f}")
+            q, dr = store(offline.MemoryOfflineStore(), n)
+            print(f"{n:>8} {'memory':>8} {q:10.4f} {dr:10.4f}")
+
+            path = os.path.join(d, f"offline-{n}.log")
+            seg = offline.SegmentOfflineStore(path)
+            for _ in range(n):
+                seg.append(USER, LINE)
+            seg.close()
+            start = time.perf_counter()
+            seg = offline.SegmentOfflineStore(path)
+            replay = time.perf_counter() - start
+            assert seg.pending(USER) == n
+            seg.close()
+            os.unlink(path)
+            q, dr = store(offline.SegmentOfflineStore(path), n)
+            print(
+                f"{n:>8} {'segment':>8} {q:10.4f} {dr:10.4f}"
+                f" {replay:10.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Logins per second during a login storm, and how late a task that
+# stands in for ordinary message traffic gets woken up meanwhile.  The
+# password check runs either right on the event loop or through
+# passwords.check_password() in the bounded thread pool.
+#
+#     python3 bench/bench_passwords.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from typing import Awaitable, Callable
+import os
+import sys
+import time
+
+import trio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import passwords  # noqa: E402
+
+LOGINS = 64
+TICK = 0.001
+
+
+async def on_loop(stored: bytes, password: bytes) -> bool:
+    await trio.sleep(0)
+    return passwords.check_sync(stored, password)
+
+
+def percentile(xs: list[float], p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+
+async def storm(
+    check: Callable[[bytes, bytes], Awaitable[bool]], stored: bytes
+) -> tuple[float, list[float]]:
+    lateness: list[float] = []
+    done = trio.Event()
+
+    async def traffic() -> None:
+        while not done.is_set():
+            start = time.perf_counter()
+            await trio.sleep(TICK)
+            lateness.append(time.perf_counter() - start - TICK)
+
+    async def login() -> None:
+        assert await check(stored, b"hunter2")
+
+    start = time.perf_counter()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(traffic)
+        async with trio.open_nursery() as logins:
+            for _ in range(LOGINS):
+                logins.start_soon(login)
+        done.set()
+    return LOGINS / (time.perf_counter() - start), lateness
+
+
+async def main() -> None:
+    stored = passwords.hash_sync(b"hunter2")
+    print(
+        f"{LOGINS} concurrent logins, {stored.split(b'$')[1].decode()}"
+    )
+    print(
+        f"{'mode':>8} {'logins/s':>9} {'p50 lag ms':>11}"
+        f" {'p99 lag ms':>11} {'max lag ms':>11}"
+    )
+    for name, check in [
+        ("loop", on_loop),
+        ("threads", passwords.check_password),
+    ]:
+        rate, lag = await storm(check, stored)
+        print(
+            f"{name:>8} {rate:9.1f} {percentile(lag, 0.5) * 1e3:11.2f}"
+            f" {percentile(lag, 0.99) * 1e3:11.2f}"
+            f" {max(lag) * 1e3:11.2f}"
+        )
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Search index throughput and query latency on a synthetic corpus:
+# --messages CHANMSGs of --words words each, drawn from a Zipf-like
+# vocabulary, from --users users into --channels channels.  Indexing
+# includes writing the memtable out and merging segments, done inline
+# here instead of in the background.  Queries are then run as a user
+# in ten of the channels, for a few kinds of query.
+#
+#     python3 bench/bench_search.py
+#     python3 bench/bench_search.py --messages 200000 --queries 50
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from itertools import accumulate
+from typing import Callable
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import trio
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import cluster  # noqa: E402
+import minilog  # noqa: E402
+import search  # noqa: E402
+
+BATCH = 10000
+
+
+def vocabulary(
+    args: argparse.Namespace,
+) -> tuple[list[str], list[float]]:
+    words = [f"w{i}" for i in range(args.vocab)]
+    weights = list(
+        accumulate(1 / (k + 1) ** 1.1 for k in range(args.vocab))
+    )
+    return words, weights
+
+
+async def build(
+    args: argparse.Namespace, ix: search.Index
+) -> dict[str, float]:
+    rng = random.Random(args.seed)
+    words, cum = vocabulary(args)
+    spent = {"add": 0.0, "flush": 0.0, "merge": 0.0}
+    for start in range(0, args.messages, BATCH):
+        n = min(BATCH, args.messages - start)
+        drawn = rng.choices(words, cum_weights=cum, k=n * args.words)
+        batch = []
+        for i in range(n):
+            text = " ".join(
+                drawn[i * args.words : (i + 1) * args.words]
+            )
+            source = b"user%d@example.org" % rng.randrange(args.users)
+            channel = b"#c%d@example.org" % rng.randrange(args.channels)
+            message = text.encode("ascii")
+            message_id = cluster.next_id()
+            line = (
+                b"CHANMSG\tSOURCE=%s\tTYPE=NORMAL\tTARGET=%s"
+                b"\tMESSAGE=%s\tID=%d\tRSTS=%r\r\n"
+                % (
+                    source,
+                    channel,
+                    message,
+                    message_id,
+                    cluster.id_ts(message_id),
+                )
+            )
+            batch.append((channel, source, message_id, line, message))
+        started = time.perf_counter()
+        for channel, source, message_id, line, message in batch:
+            ix.add(
+                search.CHANMSG,
+                channel,
+                source,
+                message_id,
+                line,
+                message,
+            )
+            if len(ix.memtable) >= ix.flush_docs:
+                spent["add"] += time.perf_counter() - started
+                started = time.perf_counter()
+                await ix.flush()
+                spent["flush"] += time.perf_counter() - started
+                started = time.perf_counter()
+                await ix.merge()
+                spent["merge"] += time.perf_counter() - started
+                started = time.perf_counter()
+        spent["add"] += time.perf_counter() - started
+    started = time.perf_counter()
+    await ix.flush()
+    spent["flush"] += time.perf_counter() - started
+    return spent
+
+
+def percentile(samples: list[float], q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def run_queries(args: argparse.Namespace, ix: search.Index) -> None:
+    rng = random.Random(args.seed + 1)
+    words, _ = vocabulary(args)
+    channels = {
+        b"#c%d@example.org" % c
+        for c in rng.sample(
+            range(args.channels), min(10, args.channels)
+        )
+    }
+    one = sorted(channels)[0]
+
+    def query(**kw: object) -> Callable[[], search.Query]:
+        return lambda: search.Query(
+            user=b"user0@example.org",
+            channels=channels,
+            limit=args.limit,
+            **kw,  # type: ignore[arg-type]
+        )
+
+    def word(lo: int, hi: int) -> bytes:
+        return words[rng.randrange(lo, min(hi, args.vocab))].encode()
+
+    kinds: list[tuple[str, Callable[[], search.Query]]] = [
+        ("common word", lambda: query(terms=[word(0, 10)])()),
+        ("mid word", lambda: query(terms=[word(100, 1000)])()),
+        ("rare word", lambda: query(terms=[word(10000, 50000)])()),
+        (
+            "two words",
+            lambda: query(terms=[word(0, 100), word(100, 1000)])(),
+        ),
+        (
+            "word in a channel",
+            lambda: query(terms=[word(0, 100)], channel=one)(),
+        ),
+        (
+            "word from a user",
+            lambda: query(
+                terms=[word(0, 100)],
+                source=b"user%d@example.org"
+                % rng.randrange(args.users),
+            )(),
+        ),
+    ]
+    print(f"{'query':>20} {'p50 ms':>8} {'p99 ms':>8} {'hits':>6}")
+    for label, make in kinds:
+        samples = []
+        hits = 0
+        for _ in range(args.queries):
+            q = make()
+            started = time.perf_counter()
+            hits += len(ix.search(q))
+            samples.append(time.perf_counter() - started)
+        print(
+            f"{label:>20} {percentile(samples, 0.5) * 1e3:8.2f}"
+            f" {percentile(samples, 0.99) * 1e3:8.2f}"
+            f" {hits / args.queries:6.1f}"
+        )
+
+
+def parse_args() -> argparse.Namespace:
+    p = argparse.ArgumentParser(
+        description="Measure the search index on a synthetic corpus."
+    )
+    p.add_argument("--messages", type=int, default=2000000)
+    p.add_argument("--words", type=int, default=8, help="per message")
+    p.add_argument("--vocab", type=int, default=50000)
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--channels", type=int, default=100)
+    p.add_argument("--flush-docs", type=int, default=50000)
+    p.add_argument("--merge-factor", type=int, default=8)
+    p.add_argument("--queries", type=int, default=200, help="per kind")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--seed", type=int, default=1)
+    return p.parse_args()
+
+
+async def main() -> None:
+    args = parse_args()
+    minilog.configure(level_name="warning")
+    directory = tempfile.mkdtemp(prefix="idc-bench-search-")
+    try:
+        ix = search.Index(
+            path=directory,
+            flush_docs=args.flush_docs,
+            merge_factor=args.merge_factor,
+        )
+        started = time.perf_counter()
+        spent = await build(args, ix)
+        total = time.perf_counter() - started
+        indexing = sum(spent.values())
+        size = sum(
+            os.path.getsize(os.path.join(directory, n))
+            for n in os.listdir(directory)
+        )
+        print(
+            f"indexed {args.messages} messages in {indexing:.1f}s:"
+            f" {args.messages / indexing:.0f}/s overall,"
+            f" {args.messages / spent['add']:.0f}/s into the memtable"
+        )
+        print(
+            f"  adding {spent['add']:.1f}s, writing segments"
+            f" {spent['flush']:.1f}s, merging {spent['merge']:.1f}s"
+            f" (corpus generation took {total - indexing:.1f}s more)"
+        )
+        print(
+            f"  {len(ix.own)} segments, {size / 1e6:.0f} MB,"
+            f" {size / args.messages:.0f} bytes per message"
+        )
+        run_queries(args, ix)
+        ix.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    trio.run(main)
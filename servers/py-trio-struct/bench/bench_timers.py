@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# What a keepalive deadline costs per connection: a task of its own
+# sleeping under trio.move_on_after() against a timer in
+# timers.Wheel.  For each, the CPU time to set up and to cancel one and
+# the memory it holds (tracemalloc), and for the wheel, the time to
+# fire one and to run an empty tick.
+#
+#     python3 bench/bench_timers.py
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import functools
+import os
+import sys
+import time
+import tracemalloc
+
+import trio
+import trio.testing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import timers  # noqa: E402
+
+SIZES = [1000, 10000, 100000]
+PING_AFTER = 120.0
+
+
+async def deadline_task(fired: list[int]) -> None:
+    with trio.move_on_after(PING_AFTER):
+        await trio.sleep_forever()
+    fired.append(1)
+
+
+async def tasks(n: int) -> tuple[float, float, float]:
+    fired: list[int] = []
+    async with trio.open_nursery() as nursery:
+        tracemalloc.start()
+        base, _ = tracemalloc.get_traced_memory()
+        start = time.process_time()
+        for _ in range(n):
+            nursery.start_soon(deadline_task, fired)
+        # Let every task get as far as its sleep.
+        await trio.testing.wait_all_tasks_blocked()
+        setup = time.process_time() - start
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        start = time.process_time()
+        nursery.cancel_scope.cancel()
+    cancel = time.process_time() - start
+    return setup / n, (held - base) / n, cancel / n
+
+
+def wheel(n: int) -> tuple[float, float, float, float, float]:
+    fired: list[int] = []
+    w = timers.Wheel(tick=1.0)
+    callback = functools.partial(fired.append, 1)
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    start = time.process_time()
+    ts = [w.call_at(PING_AFTER, callback) for _ in range(n)]
+    setup = time.process_time() - start
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.process_time()
+    for t in ts:
+        t.cancel()
+    cancel = time.process_time() - start
+    ts = [w.call_at(w.now + PING_AFTER, callback) for _ in range(n)]
+    start = time.process_time()
+    w.advance(w.now + int(PING_AFTER))
+    fire = time.process_time() - start
+    assert len(fired) == n
+    start = time.process_time()
+    w.advance(w.now + 100000)
+    tick = (time.process_time() - start) / 100000
+    return setup / n, (held - base) / n, cancel / n, fire / n, tick
+
+
+async def main() -> None:
+    print(
+        f"{'conns':>7} {'way':>6} {'setup us':>9} {'bytes':>6}"
+        f" {'cancel us':>10} {'fire us':>8} {'tick us':>8}"
+    )
+    for n in SIZES:
+        setup, held, cancel = await tasks(n)
+        print(
+            f"{n:>7} {'tasks':>6} {setup * 1e6:9.2f} {held:6.0f}"
+            f" {cancel * 1e6:10.2f}"
+        )
+        setup, held, cancel, fire, tick = wheel(n)
+        print(
+            f"{n:>7} {'wheel':>6} {setup * 1e6:9.2f} {held:6.0f}"
+            f" {cancel * 1e6:10.2f} {fire * 1e6:8.2f}"
+            f" {tick * 1e6:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    trio.run(main)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# Throwaway self-signed certificate for the benchmarks, made with the
+# openssl command line tool.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+import os
+import ssl
+import subprocess
+
+
+def self_signed(directory: str) -> tuple[str, str]:
+    """
+    Write a self-signed certificate and key for localhost into
+    directory and return their paths.
+    """
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=localhost",
+            "-keyout",
+            key,
+            "-out",
+            cert,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def client_context() -> ssl.SSLContext:
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#
+# Runs a real server in a subprocess for the end-to-end benchmarks, with
+# a generated config.py that loads the normal one and then swaps in
+# benchmark users, a throwaway certificate and a free port.
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Optional
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import trio
+
+import certs
+
+SERVER_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..")
+)
+DOMAIN = b"example.org"
+CHANNEL = b"#bench@" + DOMAIN
+PASSWORD = b"pw"
+
+# Plaintext passwords get rehashed on first login, so make that cheap.
+# Every benchmark client connects from 127.0.0.1, so the per-address
+# admission limits are out of the way too, and so are command rate
+# limits, since benchmarks flood on purpose.
+_CONFIG = """\
+exec(compile(open({real!r}).read(), {real!r}, "exec"))
+listen.port = {port}
+tls.cert = {cert!r}
+tls.key = {key!r}
+cluster.workers = {workers}
+cluster.bus_path = {bus_path!r}
+offline.path = {offline_path!r}
+passwords.scheme = "pbkdf2-sha256"
+passwords.pbkdf2_iterations = 1
+admission.max_connections = 1 << 20
+admission.max_handshakes = 1 << 20
+admission.max_per_ip = 1 << 20
+admission.rate = admission.per_ip_rate = 1e9
+admission.burst = admission.per_ip_burst = 1e9
+ratelimit.enabled = False
+metrics.port = None
+users = {{
+    b"user%d@{domain}" % i: {{
+        "password": {password!r},
+        "bio": b"",
+        "permissions": set(),
+        "options": [],
+    }}
+    for i in range({users})
+}}
+channels = {{
+    {channel!r}: {{
+        "broadcast_to": [b"user%d@{domain}" % i for i in range({members})]
+    }}
+}}
+{extra}
+"""
+
+
+def username(i: int) -> bytes:
+    return b"user%d@%s" % (i, DOMAIN)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+@dataclass
+class Server:
+    proc: subprocess.Popen[bytes]
+    port: int
+    directory: str
+
+    def stop(self) -> None:
+        # SIGINT, so the server shuts down the way it does on ^C.
+        self.proc.send_signal(2)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def __enter__(self) -> Server:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.stop()
+
+
+def start_server(
+    users: int,
+    members: int = 0,
+    workers: int = 1,
+    extra: str = "",
+    directory: Optional[str] = None,
+    log: Optional[str] = None,
+) -> Server:
+    """
+    Start idc.py with users user0..user<users-1>@example.org, all with
+    the password "pw", and #bench@example.org holding the first members
+    of them.  extra is appended to the generated config.py.
+    """
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="idc-bench-")
+    cert, key = certs.self_signed(directory)
+    port = free_port()
+    with open(os.path.join(directory, "config.py"), "w") as f:
+        f.write(
+            _CONFIG.format(
+                real=os.path.join(SERVER_DIR, "config.py"),
+                port=port,
+                cert=cert,
+                key=key,
+                workers=workers,
+                bus_path=os.path.join(directory, "bus.sock"),
+                offline_path=os.path.join(directory, "offline.log"),
+                domain=DOMAIN.decode("ascii"),
+                password=PASSWORD,
+                users=users,
+                channel=CHANNEL,
+                members=members,
+                extra=extra,
+            )
+        )
+    out = open(log, "wb") if log else subprocess.DEVNULL
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys, runpy; "
+            f"sys.path[:0] = [{directory!r}, {SERVER_DIR!r}]; "
+            f"runpy.run_path({os.path.join(SERVER_DIR, 'idc.py')!r},"
+            " run_name='__main__')",
+        ],
+        cwd=directory,
+        stdout=out,
+        stderr=out,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(
+                f"The server exited with {proc.returncode}"
+            )
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            # Give every worker a moment to start listening too.
+            time.sleep(0.2 * workers)
+            return Server(proc, port, directory)
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("The server didn't start listening")
+
+
+@dataclass
+class Client:
+    """
+    A minimal IDC client over TLS, reading whole lines.
+    """
+
+    stream: trio.SSLStream[trio.SocketStream]
+    buf: bytes = b""
+    pending: deque[bytes] = field(default_factory=deque)
+
+    @classmethod
+    async def connect(cls, port: int) -> Client:
+        tcp = await trio.open_tcp_stream("127.0.0.1", port)
+        stream = trio.SSLStream(
+            tcp, certs.client_context(), server_hostname="localhost"
+        )
+        await stream.do_handshake()
+        return cls(stream)
+
+    async def send(self, line: bytes) -> None:
+        await self.stream.send_all(line)
+
+    async def readline(self) -> bytes:
+        while not self.pending:
+            data = await self.stream.receive_some(65536)
+            if not data:
+                raise EOFError
+            *lines, self.buf = (self.buf + data).split(b"\n")
+            self.pending.extend(line.rstrip(b"\r") for line in lines)
+        return self.pending.popleft()
+
+    async def wait_for(self, command: bytes) -> list[bytes]:
+        """
+        Read up to and including a line with this command, returning
+        every line read.
+        """
+        seen = []
+        while True:
+            line = await self.readline()
+            seen.append(line)
+            if line.split(b"\t", 1)[0] == command:
+                return seen
+
+    async def login(self, i: int) -> list[bytes]:
+        await self.send(
+            b"LOGIN\tUSERNAME=%s\tPASSWORD=%s\r\n"
+            % (username(i), PASSWORD)
+        )
+        return await self.wait_for(b"END_OFFLINE_MESSAGES")
+
+    async def aclose(self) -> None:
+        with trio.move_on_after(1):
+            await self.stream.aclose()
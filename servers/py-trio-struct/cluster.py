@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+#
+# Multi-process mode for the Internet Delay Chat server written in
+# Python Trio.  Don't run this; set config.cluster.workers instead.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# The supervisor forks config.cluster.workers worker processes.  Each
+# worker listens on the same port with SO_REUSEPORT, so the kernel
+# spreads connections across them, and connects to a bus that the
+# supervisor runs on a Unix socket.
+#
+# Bus messages are ordinary IDC lines.  Those with a TO argument, which
+# always comes first, are passed on to that worker untouched.  A LINE is
+# a whole encoded line in base64, since escapes inside it wouldn't
+# survive being escaped again:
+#
+#     HELLO       WORKER                  worker -> supervisor
+#     PRESENCE    USERNAME WORKER STATE   sent to every other worker
+#     DELIVER     TO USERS LINE HOPS      users are connected to TO
+#     OFFLINE     TO USERS LINE HOPS      TO owns these users' queues
+#     FETCH       TO ID USERNAME WORKER   send me USERNAME's oldest
+#                                         queued lines
+#     BACKLOG     TO ID POS LINE          one of them, at position POS
+#     BACKLOG_END TO ID                   that's all of them
+#     CONSUMED    TO USERNAME UPTO        they were delivered up to
+#                                         position UPTO; forget them
+#     CHANMSG     TO SOURCE TYPE TARGET MESSAGE
+#                                         TO is the channel's home
+#
+# Every user's offline queue lives with one worker, their "home",
+# picked by hashing the username.  Channels have a home too, picked the
+# same way, which numbers and records all of the channel's messages.
+# The supervisor keeps the list of which users are connected to which
+# worker, gives it to workers as they connect and cleans up after
+# workers that go away.
+
+from __future__ import annotations
+from typing import Awaitable, Callable, Optional
+
+import base64
+import math
+import os
+import signal
+import socket
+import time
+import traceback
+import zlib
+
+import trio
+
+import codec
+import config
+import entities
+import framer
+import minilog
+import offline
+import utils
+
+worker_id = 0
+workers = config.cluster.workers
+# Username -> IDs of the *other* workers the user is connected to.
+routes: dict[bytes, set[int]] = {}
+# Set by idc so that lines from the bus can reach local users.
+local_users: dict[bytes, entities.User] = {}
+# Set by idc: sends a CHANMSG to a channel this worker is the home of.
+post_chanmsg: Callable[[dict[str, bytes]], None] = lambda args: None
+
+_bus: Optional[trio.MemorySendChannel[bytes]] = None
+_fetches: dict[
+    bytes, trio.MemorySendChannel[Optional[tuple[int, bytes]]]
+] = {}
+_fetch_counter = 0
+# Offline lines handed out per FETCH, or per peek() at home.  They're
+# only consumed once they've been passed on, so this is also how many
+# a lost worker can leave to be delivered twice.
+_FETCH_BATCH = 256
+
+# A line bounces between workers with stale routes at most this often
+# before it's simply queued at the user's home.
+_MAX_HOPS = 3
+
+# Seconds between checks for exited workers.
+_REAP_INTERVAL = 0.5
+
+# Message IDs are the time in microseconds with the worker ID in the
+# low bits, so they're unique across workers and sort by time.
+_WORKER_BITS = 8
+_last_id = 0
+
+
+def active() -> bool:
+    return _bus is not None
+
+
+def home(username: bytes) -> int:
+    return zlib.crc32(username) % workers
+
+
+def is_home(username: bytes) -> bool:
+    return not active() or home(username) == worker_id
+
+
+def next_id(after: int = 0) -> int:
+    """
+    A new message ID, greater than after and than every ID this worker
+    has handed out before, even if the clock went backwards.
+    """
+    global _last_id
+    floor = max(_last_id, after) >> _WORKER_BITS
+    micros = max(time.time_ns() // 1000, floor + 1)
+    _last_id = micros << _WORKER_BITS | worker_id
+    return _last_id
+
+
+def id_ts(message_id: int) -> float:
+    """
+    The timestamp a message ID was made at, which is its RSTS.
+    """
+    return (message_id >> _WORKER_BITS) / 1e6
+
+
+def line_id(line: bytes) -> int:
+    """
+    The ID of an encoded message, or 0 for one from before there were
+    IDs.
+    """
+    _, args = codec.decode_line(line)
+    try:
+        return int(args.get("ID", b"0"))
+    except ValueError:
+        return 0
+
+
+def _send(command: bytes, **kwargs: Optional[bytes]) -> None:
+    assert _bus is not None
+    _bus.send_nowait(codec.encode_line(command, kwargs))
+
+
+def _num(i: int) -> bytes:
+    return str(i).encode("ascii")
+
+
+def _pack(line: bytes) -> bytes:
+    return base64.b64encode(line)
+
+
+def _unpack(value: bytes) -> bytes:
+    return base64.b64decode(value, validate=True)
+
+
+def announce(username: bytes, online: bool) -> None:
+    """
+    Tell the other workers that a user's first client connected to, or
+    last client disconnected from, this worker.
+    """
+    if active():
+        _send(
+            b"PRESENCE",
+            USERNAME=username,
+            WORKER=_num(worker_id),
+            STATE=b"ONLINE" if online else b"OFFLINE",
+        )
+
+
+def forward(
+    w: int, usernames: list[bytes], line: bytes, hops: int = 0
+) -> None:
+    _send(
+        b"DELIVER",
+        TO=_num(w),
+        USERS=b" ".join(usernames),
+        LINE=_pack(line),
+        HOPS=_num(hops),
+    )
+
+
+def forward_offline(
+    username: bytes, line: bytes, hops: int = 0
+) -> None:
+    _send(
+        b"OFFLINE",
+        TO=_num(home(username)),
+        USERS=username,
+        LINE=_pack(line),
+        HOPS=_num(hops),
+    )
+
+
+def forward_chanmsg(args: dict[str, bytes]) -> None:
+    """
+    Have the channel's home worker send a CHANMSG.
+    """
+    _send(
+        b"CHANMSG",
+        TO=_num(home(args["TARGET"])),
+        SOURCE=args["SOURCE"],
+        TYPE=args["TYPE"],
+        TARGET=args["TARGET"],
+        MESSAGE=args["MESSAGE"],
+    )
+
+
+async def drain_backlog(
+    username: bytes, emit: Callable[[bytes], Awaitable[None]]
+) -> None:
+    """
+    Pass each of the user's offline messages to emit(), fetching them
+    from the user's home worker if that isn't this one.  Lines are only
+    consumed once emit() has returned, so if it raises, the line it
+    was given and the ones after it stay queued.
+    """
+    if is_home(username):
+        while True:
+            upto, lines = offline.store.peek(username, _FETCH_BATCH)
+            try:
+                for line in lines:
+                    await emit(line)
+                    upto += 1
+            finally:
+                offline.store.consume(username, upto)
+            if len(lines) < _FETCH_BATCH:
+                return
+    while await _fetch_batch(username, emit) == _FETCH_BATCH:
+        pass
+
+
+async def _fetch_batch(
+    username: bytes, emit: Callable[[bytes], Awaitable[None]]
+) -> int:
+    """
+    Fetch up to _FETCH_BATCH of the user's offline messages from their
+    home worker, pass them to emit() and tell the home worker which of
+    them to consume.  Returns how many were passed on.
+    """
+    global _fetch_counter
+    _fetch_counter += 1
+    fetch_id = _num(_fetch_counter)
+    send_channel, receive_channel = trio.open_memory_channel[
+        Optional[tuple[int, bytes]]
+    ](math.inf)
+    _fetches[fetch_id] = send_channel
+    emitted = 0
+    upto: Optional[int] = None
+    try:
+        _send(
+            b"FETCH",
+            TO=_num(home(username)),
+            ID=fetch_id,
+            USERNAME=username,
+            WORKER=_num(worker_id),
+        )
+        while True:
+            queued: Optional[tuple[int, bytes]] = None
+            with trio.move_on_after(config.cluster.fetch_timeout):
+                queued = await receive_channel.receive()
+                if queued is None:
+                    return emitted
+            if queued is None:
+                # What wasn't passed on yet stays queued at home.
+                minilog.warning(
+                    "Timed out fetching offline messages of %r"
+                    " from worker %d.",
+                    username,
+                    home(username),
+                )
+                return 0
+            pos, line = queued
+            await emit(line)
+            emitted += 1
+            upto = pos + 1
+    finally:
+        del _fetches[fetch_id]
+        if upto is not None:
+            _send(
+                b"CONSUMED",
+                TO=_num(home(username)),
+                USERNAME=username,
+                UPTO=_num(upto),
+            )
+
+
+def _deliver_here(username: bytes, line: bytes, hops: int) -> None:
+    user = local_users.get(username)
+    if user is not None and user.connected_clients:
+        for c in user.connected_clients:
+            utils.enqueue(c, line)
+        return
+    if hops < _MAX_HOPS:
+        elsewhere = routes.get(username)
+        if elsewhere:
+            for w in elsewhere:
+                forward(w, [username], line, hops + 1)
+            return
+        if not is_home(username):
+            forward_offline(username, line, hops + 1)
+            return
+    offline.store.append(username, line)
+
+
+def _handle(cmd: bytes, args: dict[str, bytes]) -> None:
+    if cmd == b"PRESENCE":
+        w = int(args["WORKER"])
+        username = args["USERNAME"]
+        if w == worker_id:
+            return
+        if args["STATE"] == b"ONLINE":
+            routes.setdefault(username, set()).add(w)
+        else:
+            ws = routes.get(username)
+            if ws is not None:
+                ws.discard(w)
+                if not ws:
+                    del routes[username]
+    elif cmd in (b"DELIVER", b"OFFLINE"):
+        line = _unpack(args["LINE"])
+        hops = int(args.get("HOPS", b"0"))
+        for username in args["USERS"].split(b" "):
+            _deliver_here(username, line, hops)
+    elif cmd == b"FETCH":
+        to = args["WORKER"]
+        pos, lines = offline.store.peek(args["USERNAME"], _FETCH_BATCH)
+        for line in lines:
+            _send(
+                b"BACKLOG",
+                TO=to,
+                ID=args["ID"],
+                POS=_num(pos),
+                LINE=_pack(line),
+            )
+            pos += 1
+        _send(b"BACKLOG_END", TO=to, ID=args["ID"])
+    elif cmd == b"BACKLOG":
+        fetch = _fetches.get(args["ID"])
+        if fetch is not None:
+            fetch.send_nowait(
+                (int(args["POS"]), _unpack(args["LINE"]))
+            )
+    elif cmd == b"CONSUMED":
+        offline.store.consume(args["USERNAME"], int(args["UPTO"]))
+    elif cmd == b"BACKLOG_END":
+        fetch = _fetches.get(args["ID"])
+        if fetch is not None:
+            fetch.send_nowait(None)
+    elif cmd == b"CHANMSG":
+        post_chanmsg(args)
+    else:
+        minilog.warning("Unknown bus message %r", cmd)
+
+
+async def _bus_reader(
+    stream: trio.abc.ReceiveStream, nursery: trio.Nursery
+) -> None:
+    line_framer = framer.LineFramer(max_line_length=0)
+    async for data in stream:
+        line_framer.feed(data)
+        while True:
+            line = line_framer.next_line()
+            if line is None:
+                break
+            cmd, args = codec.decode_line(line)
+            _handle(cmd, args)
+    # The supervisor is gone, so it's shutting down or dead; either way
+    # this worker can't reach the others anymore.
+    minilog.warning(
+        "Worker %d: the bus closed, shutting down.", worker_id
+    )
+    nursery.cancel_scope.cancel()
+
+
+async def _bus_writer(
+    stream: trio.abc.SendStream,
+    receive_channel: trio.MemoryReceiveChannel[bytes],
+) -> None:
+    async for line in receive_channel:
+        # Send everything that's piled up in one go.
+        pending = [line]
+        while True:
+            try:
+                pending.append(receive_channel.receive_nowait())
+            except trio.WouldBlock:
+                break
+        await stream.send_all(b"".join(pending))
+
+
+async def connect(nursery: trio.Nursery) -> None:
+    """
+    Connect this worker to the supervisor's bus.
+    """
+    global _bus
+    for _ in range(50):
+        try:
+            stream = await trio.open_unix_socket(
+                config.cluster.bus_path
+            )
+            break
+        except OSError:
+            await trio.sleep(0.1)
+    else:
+        raise OSError(
+            f"Can't reach the bus at {config.cluster.bus_path}"
+        )
+    send_channel, receive_channel = trio.open_memory_channel[bytes](
+        math.inf
+    )
+    _bus = send_channel
+    _send(b"HELLO", WORKER=_num(worker_id))
+    nursery.start_soon(_bus_writer, stream, receive_channel)
+    nursery.start_soon(_bus_reader, stream, nursery)
+
+
+async def reuseport_listeners(port: int) -> list[trio.SocketListener]:
+    """
+    Like trio.open_tcp_listeners(), but with SO_REUSEPORT set so that
+    every worker can listen on the same port.
+    """
+    listeners = []
+    for family, type, proto, _, addr in await trio.socket.getaddrinfo(
+        None, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE
+    ):
+        sock = trio.socket.socket(family, type, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        await sock.bind(addr)
+        sock.listen(socket.SOMAXCONN)
+        listeners.append(trio.SocketListener(sock))
+    return listeners
+
+
+async def _hub(sock: socket.socket, pids: list[int]) -> None:
+    hub_routes: dict[bytes, set[int]] = {}
+    conns: dict[int, trio.MemorySendChannel[bytes]] = {}
+
+    def broadcast(line: bytes, sender: int) -> None:
+        for w, conn in conns.items():
+            if w != sender:
+                conn.send_nowait(line)
+
+    def presence(username: bytes, w: int, online: bool) -> bytes:
+        return codec.encode_line(
+            b"PRESENCE",
+            {
+                "USERNAME": username,
+                "WORKER": _num(w),
+                "STATE": b"ONLINE" if online else b"OFFLINE",
+            },
+        )
+
+    async def handle(stream: trio.SocketStream) -> None:
+        line_framer = framer.LineFramer(max_line_length=0)
+        send_channel, receive_channel = trio.open_memory_channel[bytes](
+            math.inf
+        )
+        w = -1
+        try:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(_bus_writer, stream, receive_channel)
+                async for data in stream:
+                    line_framer.feed(data)
+                    while True:
+                        line = line_framer.next_line()
+                        if line is None:
+                            break
+                        parts = line.split(b"\t", 2)
+                        if len(parts) > 1 and parts[1].startswith(
+                            b"TO="
+                        ):
+                            conn = conns.get(int(parts[1][3:]))
+                            if conn is not None:
+                                conn.send_nowait(line + b"\r\n")
+                            continue
+                        cmd, args = codec.decode_line(line)
+                        if cmd == b"HELLO":
+                            w = int(args["WORKER"])
+                            conns[w] = send_channel
+                            minilog.note("Worker %d is on the bus.", w)
+                            for username, ws in hub_routes.items():
+                                for x in ws:
+                                    send_channel.send_nowait(
+                                        presence(username, x, True)
+                                    )
+                        elif cmd == b"PRESENCE":
+                            username = args["USERNAME"]
+                            if args["STATE"] == b"ONLINE":
+                                hub_routes.setdefault(
+                                    username, set()
+                                ).add(w)
+                            else:
+                                ws = hub_routes.get(username, set())
+                                ws.discard(w)
+                                if not ws:
+                                    hub_routes.pop(username, None)
+                            broadcast(line + b"\r\n", w)
+                nursery.cancel_scope.cancel()
+        except trio.BrokenResourceError:
+            pass
+        finally:
+            if conns.get(w) is send_channel:
+                del conns[w]
+                minilog.warning("Worker %d left the bus.", w)
+                for username in [
+                    u for u, ws in hub_routes.items() if w in ws
+                ]:
+                    hub_routes[username].discard(w)
+                    if not hub_routes[username]:
+                        del hub_routes[username]
+                    broadcast(presence(username, w, False), w)
+
+    async def reap() -> None:
+        alive = set(pids)
+        while alive:
+            # Poll rather than wait in a thread, which could not be
+            # cancelled and would hold up shutting the bus down.
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                await trio.sleep(_REAP_INTERVAL)
+                continue
+            alive.discard(pid)
+            minilog.error("Worker process %d exited (%d).", pid, status)
+        nursery.cancel_scope.cancel()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(reap)
+        await trio.serve_listeners(
+            handle,
+            [trio.SocketListener(trio.socket.from_stdlib_socket(sock))],
+        )
+
+
+def supervise(run_worker: Callable[[], None]) -> None:
+    """
+    Fork the workers, each of which calls run_worker(), then run the
+    bus until all of them have exited.
+    """
+    global worker_id
+    if workers > 1 << _WORKER_BITS:
+        raise ValueError(
+            f"At most {1 << _WORKER_BITS} workers can tell their"
+            " message IDs apart."
+        )
+    if config.history.path is None:
+        # Only a channel's home would have its messages, in memory, so
+        # CHATHISTORY anywhere else would come back empty.
+        raise ValueError(
+            "history.path can't be None with more than one worker."
+        )
+    path = config.cluster.bus_path
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(workers)
+
+    # Otherwise every worker would write out the same buffered lines.
+    minilog.flush()
+    pids = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            sock.close()
+            worker_id = i
+            code = 0
+            try:
+                run_worker()
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                minilog.dump_ring()
+                code = 1
+            minilog.flush()
+            os._exit(code)
+        pids.append(pid)
+    minilog.note("Started %d workers: %s", workers, tuple(pids))
+
+    try:
+        trio.run(_hub, sock, pids)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # SIGINT, so that the workers' finally blocks get to run.
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        os.unlink(path)
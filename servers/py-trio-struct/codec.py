@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+#
+# Line codec for the Internet Delay Chat server written in Python Trio.
+# Turns raw IDC lines into (command, arguments) pairs and back.  This
+# library is not intended to be used outside of that program.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from __future__ import annotations
+from typing import Mapping, Optional
+
+import re
+import struct
+import sys
+
+import exceptions
+
+# Escape sequence -> byte, for lines coming in.  An escaped backslash
+# is kept escaped, and a lone backslash is never escaped on the way out,
+# so backslash pairs pass through the server verbatim.
+_unescapes: dict[bytes, bytes] = {
+    b"\\": b"\\\\",
+    b"r": b"\r",
+    b"n": b"\n",
+    b"t": b"\t",
+}
+# Byte -> escape sequence, for lines going out.
+_escapes: dict[bytes, bytes] = {
+    b"\r": b"\\r",
+    b"\n": b"\\n",
+    b"\t": b"\\t",
+}
+
+_unescape_re = re.compile(rb"\\(.)")
+
+# Argument keys the server knows about.  Looking these up in a dict
+# gives back one shared, already validated str instead of decoding and
+# checking every key on every line.  Lowercase spellings are in there
+# too since clients are allowed to send them.
+KNOWN_KEYS = (
+    "AFTER",
+    "BEFORE",
+    "BEFOREID",
+    "CHANNEL",
+    "COMMENT",
+    "COOKIE",
+    "COUNT",
+    "FINGERPRINT",
+    "ID",
+    "LIMIT",
+    "MESSAGE",
+    "MORE",
+    "PASSWORD",
+    "PROBLEM",
+    "QUERY",
+    "RESUME",
+    "RSTS",
+    "SEQ",
+    "SOURCE",
+    "TARGET",
+    "TYPE",
+    "USERNAME",
+    "USERS",
+)
+_keys: dict[bytes, str] = {}
+for _k in KNOWN_KEYS:
+    _keys[_k.encode("ascii")] = _keys[_k.lower().encode("ascii")] = (
+        sys.intern(_k)
+    )
+# Outgoing key -> b"\tKEY=", filled in the first time a key is used.
+_prefixes: dict[str, bytes] = {}
+
+
+def _unescape(m: re.Match[bytes]) -> bytes:
+    try:
+        return _unescapes[m.group(1)]
+    except KeyError:
+        raise exceptions.EscapeSequenceError(
+            b"\\" + m.group(1) + b"is an invalid escape sequence."
+        )
+
+
+def _decode_key(key: bytes) -> str:
+    key = key.upper()
+    try:
+        return _keys[key]
+    except KeyError:
+        pass
+    if not key.isascii():
+        raise exceptions.NonAlphaKeyError(
+            b"Argument keys must be ASCII alphabet sequences.  (decode error)"
+        )
+    if not key.isalpha():
+        raise exceptions.NonAlphaKeyError(
+            b"Argument keys must be ASCII alphabet sequences. (not isalpha)"
+        )
+    return key.decode("ascii")
+
+
+def _encode_key(key: str) -> bytes:
+    if key != key.upper():
+        raise exceptions.IdiotError(
+            "Why are you using lowercase keys in the code?"
+        )
+    prefix = b"\t" + key.encode("ascii") + b"="
+    _prefixes[key] = prefix
+    return prefix
+
+
+def decode_line(msg: bytes) -> tuple[bytes, dict[str, bytes]]:
+    """
+    Parses a raw IDC message into the command and key/value pairs.
+    A trailing CR-LF is stripped if present.
+    Example: PRIVMSG TARGET:yay MESSAGE:Hi
+    (b'PRIVMSG', {'TARGET': b'yay', 'MESSAGE': b'Hi'})
+    """
+    if msg.endswith(b"\n"):
+        msg = msg[:-1]
+    if msg.endswith(b"\r"):
+        msg = msg[:-1]
+    cmd = b""
+    args: dict[str, bytes] = {}
+    for arg in msg.split(b"\t"):
+        key, sep, value = arg.partition(b"=")
+        if sep:
+            try:
+                key_str = _keys[key]
+            except KeyError:
+                key_str = _decode_key(key)
+            if b"\\" in value:
+                value = _unescape_re.sub(_unescape, value)
+            args[key_str] = value
+        elif cmd != b"":
+            raise exceptions.MultiCommandError(
+                b"You can't use multiple commands inside one line!"
+            )
+        else:
+            cmd = arg
+    return cmd, args
+
+
+def encode_line(
+    command: bytes, kwargs: Mapping[str, Optional[bytes]]
+) -> bytes:
+    """
+    Turns a command and its arguments into a raw IDC message, adding
+    the final CR-LF.  Arguments whose value is None are left out.
+    The line is put together with a single join, so values that don't
+    need escaping are only copied once, straight into it.
+    """
+    parts = [command.upper()]
+    for key, value in kwargs.items():
+        try:
+            prefix = _prefixes[key]
+        except KeyError:
+            prefix = _encode_key(key)
+        if value is None:
+            continue
+        if b"\r" in value or b"\n" in value or b"\t" in value:
+            for char, escaped in _escapes.items():
+                value = value.replace(char, escaped)
+        parts.append(prefix)
+        parts.append(value)
+    parts.append(b"\r\n")
+    return b"".join(parts)
+
+
+# Binary frames, for connections that have sent BINARY.  Integers are
+# big-endian, and nothing is escaped:
+#
+#     u32  length of the rest of the frame
+#     u16  length of the command, then the command
+#     then for each argument:
+#     u8   length of the key, then the key
+#     u32  length of the value, then the value
+#
+# A frame carries exactly what a line does, so commands handle either
+# without knowing which it was.  Inside the server, values keep
+# backslashes escaped the way they arrive in lines, so backslashes in
+# a frame's values are doubled on the way in and undone on the way out.
+frame_length = struct.Struct(">I")
+_command_length = struct.Struct(">H")
+_value_length = struct.Struct(">I")
+# Outgoing key -> its length byte and the key.
+_frame_keys: dict[str, bytes] = {}
+# Escape sequence in a line going out -> the byte it stands for.  Any
+# other backslash is taken as it is.
+_line_escapes = {b"\\": b"\\", b"r": b"\r", b"n": b"\n", b"t": b"\t"}
+# Encoded line -> its frame, for lines sent to many binary clients.
+_frames: dict[bytes, bytes] = {}
+_FRAMES_CACHED = 1024
+_FRAME_CACHE_MAX_BYTES = 4096
+
+
+def decode_frame(frame: bytes) -> tuple[bytes, dict[str, bytes]]:
+    """
+    Parses the body of a binary frame, without its length, into the
+    command and key/value pairs, like decode_line() does for a line.
+    """
+    end = len(frame)
+    pos = 2 + (
+        _command_length.unpack_from(frame)[0] if end >= 2 else end
+    )
+    cmd = frame[2:pos]
+    args: dict[str, bytes] = {}
+    while pos < end:
+        kend = pos + 1 + frame[pos]
+        if kend + 4 > end:
+            break
+        key = frame[pos + 1 : kend]
+        pos = kend + 4 + _value_length.unpack_from(frame, kend)[0]
+        try:
+            key_str = _keys[key]
+        except KeyError:
+            key_str = _decode_key(key)
+        value = frame[kend + 4 : pos]
+        if b"\\" in value:
+            value = value.replace(b"\\", b"\\\\")
+        args[key_str] = value
+    if pos != end:
+        raise exceptions.BadFrameError(
+            b"The fields of a frame don't add up to its length."
+        )
+    return cmd, args
+
+
+def encode_frame(
+    command: bytes, kwargs: Mapping[str, Optional[bytes]]
+) -> bytes:
+    """
+    Turns a command and its arguments into a binary frame, with its
+    length.  Arguments whose value is None are left out.
+    """
+    command = command.upper()
+    parts = [b"", _command_length.pack(len(command)), command]
+    for key, value in kwargs.items():
+        try:
+            prefix = _frame_keys[key]
+        except KeyError:
+            prefix = _frame_keys[key] = (
+                bytes((len(key),)) + _encode_key(key)[1:-1]
+            )
+        if value is None:
+            continue
+        parts.append(prefix)
+        parts.append(_value_length.pack(len(value)))
+        parts.append(value)
+    body = b"".join(parts)
+    return frame_length.pack(len(body)) + body
+
+
+def _unescape_line(m: re.Match[bytes]) -> bytes:
+    return _line_escapes.get(m.group(1), m.group(0))
+
+
+def _line_to_frame(line: bytes) -> bytes:
+    command, *fields = line.split(b"\t")
+    kwargs = {}
+    for arg in fields:
+        key, _, value = arg.partition(b"=")
+        if b"\\" not in value:
+            pass
+        elif b"\\\\" in value:
+            value = _unescape_re.sub(_unescape_line, value)
+        else:
+            # Nothing can be mistaken for an escape here, so plain
+            # replacing is quicker.
+            value = (
+                value.replace(b"\\r", b"\r")
+                .replace(b"\\n", b"\n")
+                .replace(b"\\t", b"\t")
+            )
+        kwargs[_keys.get(key) or key.decode("ascii")] = value
+    return encode_frame(command, kwargs)
+
+
+def frames_of(data: bytes) -> bytes:
+    """
+    The binary frames for one or more lines from encode_line().  Short
+    ones are remembered for a while, since the same line is usually on
+    its way to many clients.
+    """
+    frames = _frames.get(data)
+    if frames is not None:
+        return frames
+    frames = b"".join(
+        [_line_to_frame(line) for line in data.split(b"\r\n")[:-1]]
+    )
+    if len(data) <= _FRAME_CACHE_MAX_BYTES:
+        if len(_frames) >= _FRAMES_CACHED:
+            _frames.clear()
+        _frames[data] = frames
+    return frames
@@ -1,62 +1,308 @@
-import entities
+class listen:
+    port = 6835
 
 
-class listen:
-    port = 1025
+class passwords:
+    # New hashes use this scheme, "scrypt" or "pbkdf2-sha256".  Stored
+    # passwords with another scheme or other parameters (or plaintext)
+    # are rehashed when their user next logs in.
+    scheme = "scrypt"
+    scrypt_n = 1 << 14
+    scrypt_r = 8
+    scrypt_p = 1
+    pbkdf2_iterations = 600000
+    # Worker threads for hashing; 0 means one per CPU.
+    threads = 0
+
+
+class tls:
+    cert = "/etc/letsencrypt/live/fcm.andrewyu.org/fullchain.pem"
+    key = "/etc/letsencrypt/live/fcm.andrewyu.org/privkey.pem"
 
 
 server_name = b"andrewyu.org"
+
+# Longest line, excluding the CR-LF, that a client may send.  Anything
+# longer is rejected with LINE_TOO_LONG before it's buffered in full.
+max_line_length = 16384
+# Whether clients may switch to length-prefixed binary frames with
+# BINARY.  Frames can't be longer than max_line_length either.
+binary_frames = True
+
+
+class outbound:
+    # Lines that may wait in a client's outbound queue before the slow
+    # consumer policy kicks in.
+    queue_size = 1024
+    # What to do with a line for a client whose queue is full:
+    #   "disconnect"  drop the client
+    #   "drop"        throw the line away if its command is in
+    #                 droppable_commands, otherwise disconnect
+    #   "spill"       put the line in the user's offline queue, to be
+    #                 delivered on their next login, and disconnect;
+    #                 it's only queued once, and not at all while
+    #                 another of the user's clients is getting it
+    slow_consumer_policy = "disconnect"
+    droppable_commands = {b"CHANMSG"}
+    # Seconds a closing connection gets to flush what's still queued.
+    linger = 5.0
+    # Long replies such as the LOGIN burst are handed to the writer in
+    # chunks of about this many bytes, and the writer sends whatever
+    # has piled up in a client's queue in writes of up to about this
+    # many bytes.  0 writes every line separately.
+    burst_size = 65536
+
+
+class admission:
+    # New connections are turned away, before their TLS handshake, once
+    # there are max_connections, or max_handshakes still handshaking,
+    # or max_per_ip from the same address.  In cluster mode these are
+    # per worker.
+    max_connections = 10000
+    max_handshakes = 256
+    max_per_ip = 20
+    # New connections allowed per second on average, and at once, in
+    # all and from one address.
+    rate = 200.0
+    burst = 400
+    per_ip_rate = 2.0
+    per_ip_burst = 10
+    # IPv6 addresses count as one address per network this long.
+    ipv6_prefix = 64
+
+
+class ratelimit:
+    # Every command costs tokens from two buckets, one for its
+    # connection and one shared by all of its user's connections.  A
+    # command that overdraws either is still handled, but nothing more
+    # is read from the connection until both are out of debt, so a
+    # flood gets slowed down rather than disconnected.
+    enabled = True
+    # What commands cost; anything else costs 1.  A CHANMSG costs
+    # chanmsg_per_member more for each member of the channel, since
+    # that's how many lines it turns into.
+    costs = {b"LOGIN": 5.0, b"SEARCH": 5.0, b"CHATHISTORY": 2.0}
+    chanmsg_per_member = 0.05
+    # Tokens per second and most tokens, for the connection and the
+    # user.  Users get the first profile here that one of their options
+    # names, and everyone else gets "default".
+    profiles = {
+        "default": {"connection": (5.0, 30.0), "user": (10.0, 60.0)},
+        "bot": {"connection": (50.0, 300.0), "user": (100.0, 600.0)},
+    }
+
+
+class timeouts:
+    # Seconds a client may stay quiet before the server sends it a
+    # PING, and then how many more before it's disconnected if it still
+    # hasn't sent anything.
+    ping_after = 120.0
+    ping_timeout = 60.0
+    # Seconds a new connection gets to finish its TLS handshake.
+    handshake = 10.0
+    # All of the above are checked this often, by one timer wheel.
+    tick = 1.0
+
+
+class compression:
+    # Whether clients may switch their connection to zlib with COMPRESS.
+    enabled = True
+    # zlib settings for what the server sends.  Each compressed
+    # connection holds about 2 ** (window_bits + 2) + 2 ** (mem_level +
+    # 9) bytes for that, 256 KiB with these, and 32 KiB to read.
+    level = 6
+    window_bits = 15
+    mem_level = 8
+    # Writes at least this big are compressed in a worker thread instead
+    # of on the event loop.
+    thread_bytes = 32 << 10
+    # Most bytes to inflate at a time from what a client sent.
+    inflate_chunk = 64 << 10
+
+
+class offline:
+    # "memory" keeps offline messages in RAM and loses them on restart;
+    # "segment" keeps them in an append-only file at path.
+    store = "memory"
+    path = "offline.log"
+    # Records buffered before they're written to the file; they're
+    # fsync()ed, in a thread, every sync_interval seconds.
+    sync_every = 64
+    sync_interval = 1.0
+    # Don't bother compacting the file until this much of it is dead.
+    compact_min_bytes = 1 << 20
+
+
+class history:
+    # Channel messages are kept for CHATHISTORY: the newest ring_size
+    # of each channel in memory, and all of them in segment files under
+    # the directory path, or nowhere else if it's None, which only
+    # works with a single worker.
+    ring_size = 1000
+    path = "history"
+    # Start a new segment once the current one is this big.
+    segment_bytes = 64 << 20
+    # Bytes of messages between entries in a segment's timestamp index.
+    index_every = 64 << 10
+    # Channels whose segments are kept open for appending.
+    open_writers = 256
+    # Segments, across every channel, kept mapped for reading.
+    open_segments = 1024
+    # Messages CHATHISTORY returns when asked for no LIMIT, and at most.
+    default_limit = 50
+    max_limit = 500
+    # False leaves channel messages out of offline queues; clients
+    # fetch what they missed with CHATHISTORY instead.
+    queue_offline = True
+    # Per channel, the most messages sent to a client that logs in with
+    # RESUME=<the last message ID it saw>.
+    resume_limit = 100
+
+
+class search:
+    # CHANMSGs and PRIVMSGs are indexed for SEARCH in segment files
+    # under the directory path, or not at all if it's None.
+    path = "search"
+    # New messages are written out as a segment once there are
+    # flush_docs of them or flush_interval seconds have passed; in
+    # cluster mode that's also how long other workers take to see them.
+    flush_docs = 50000
+    flush_interval = 10.0
+    # Merge segments once there are more than this many.
+    merge_factor = 8
+    # Results SEARCH returns when asked for no LIMIT, and at most.
+    default_limit = 20
+    max_limit = 100
+
+
+class log:
+    # Least severe level that's logged: "parser", "debug", "info",
+    # "note", "caution", "warning" or "error".  "debug" logs every line
+    # sent and received.
+    level = "info"
+    # None logs to stdout; otherwise lines are appended to this file,
+    # which is rotated once it reaches max_bytes, keeping backups old
+    # ones around.
+    path = None
+    max_bytes = 16 << 20
+    backups = 5
+    # Batch log lines up and write them from a thread every
+    # flush_interval seconds, instead of as they happen.
+    buffered = True
+    flush_interval = 0.5
+    # The last ring_size lines at ring_level and above are kept in
+    # memory and dumped to stderr if the server crashes.
+    ring_size = 1000
+    ring_level = "info"
+
+
+class loopwatch:
+    # Watch the event loop for stalls: how late a task sleeping every
+    # lag_interval seconds wakes up, and every task step that runs for
+    # longer than slow_step seconds without yielding, which is logged
+    # with its stack (at most stack_depth frames of it).  The newest
+    # report_size of those are kept for the LAG command, which needs
+    # the "stats" permission.
+    enabled = True
+    lag_interval = 0.5
+    slow_step = 0.1
+    stack_depth = 20
+    report_size = 50
+
+
+class metrics:
+    # Serve Prometheus metrics over plain HTTP at
+    # http://host:port/metrics, or not at all if port is None.  In
+    # cluster mode worker n uses port + n.  Users with the "stats"
+    # permission can also see them with the STATS command.
+    host = "127.0.0.1"
+    port = 6836
+
+
+class cluster:
+    # Worker processes.  With more than one, every worker listens on
+    # listen.port with SO_REUSEPORT and they talk to each other through
+    # a Unix socket at bus_path.  Each worker keeps its own offline
+    # store, at offline.path plus ".<worker number>".
+    workers = 1
+    bus_path = "idc-bus.sock"
+    # Seconds to wait on another worker for a user's offline messages
+    # during LOGIN.
+    fetch_timeout = 5.0
+
+
+class accounts:
+    # "config" loads every user and channel in users and channels below
+    # at startup.  "sqlite" looks them up in the database at path as
+    # they're needed instead; run "python3 accounts.py [path]" to copy
+    # users and channels from here into it.
+    store = "config"
+    path = "accounts.db"
+    # Users and channels kept in memory while nobody is using them.
+    cache_users = 100000
+    cache_channels = 10000
+
+
 users = {
-    b"guest@" + server_name: {
-        "password": b"guest",
+    b"guest@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$u9MdFcM9O40GvwmWuCmakw$IGeWVZe5xOltOWqbwr4E6HyRQGfNkqtCbDohjK5VdmU",
         "bio": b"Guest",
         "permissions": set(),
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"Noisytoot@" + server_name: {
-        "password": b"pissnet",
+    b"Noisytoot@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$FklKHZzai9oFmnZL4mAJmA$3JyaEogXS3mpRPBKGt3KjoeYr4j3Od0aMPds2cYYDyM",
         "bio": b"Ron",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"andrew@" + server_name: {
-        "password": b"hunter2",
+    b"andrew@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$2anUva6ExEoHZxssb8Oq1Q$rF2EzLQig7alHm4phD/EkMQYog6JkAaabLXMN4nRiZo",
         "bio": b"Andrew Yu",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"hax@" + server_name: {
-        "password": b"lurk",
+    b"hax@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$5rzZ9yuqHkFK5DAPVomc/Q$EnzsymNVfrUcVgbq+hhKMnj3tCnasj82t1xLxjtyNq4",
         "bio": b"Professional h4xx0r",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"luk3yx@" + server_name: {
-        "password": b"billy",
+    b"luk3yx@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$w5QaQ8npfHscO6T3hxUHNg$jbQ/8fHtkSYuNQ0lToDaWoCJ05sfIYURfryqrJ1gbNQ",
         "bio": b"Random bot",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"idcbot@" + server_name: {
-        "password": b"",
+    b"idcbot@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$iXpxvgrcVQHDlMiIDZ2noQ$b4tn4O1/K2wn+AUjMWugz45cIRbbtkRQB9CprhZwvus",
         "bio": b"#IDC relay bot",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"speechbot@" + server_name: {
-        "password": b"",
+    b"speechbot@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$MH2oqdcZ1GFlTOemfJGvyQ$WcLWEqUEhLJoorQ1mSAtkMnHibYGJFM0yeF+8ZENJRc",
         "bio": b"#librespeech relay bot",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"vitali64@" + server_name: {
-        "password": b"hello",
+    b"vitali64@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$PYmgZ65LgUNcjXCyj+mRCg$oolEOmQBf18Gq1ksgpD4Z4dxEE1DcDkX9Y0h3GxzeE4",
         "bio": b"Nice person",
         "permissions": {"kill", "new-guild"},
         "options": ["offline-messages", "eat-cookies"],
     },
-    b"lurk@" + server_name: {
-        "password": b"HQWkf36lIttHBYGifwvcjso6RGPN2Ne_frrt6FpP3qc",
+    b"lurk@"
+    + server_name: {
+        "password": b"$scrypt$n=16384,r=8,p=1$8v1D/ohzRTa1u2LB0cD3fQ$FKcYEDACQibI/oOYb+LP7+obU4vkt3sj0CQgcGAbgYM",
         "bio": b"Random human",
         "permissions": {"kill"},
         "options": ["bot"],
@@ -64,7 +310,8 @@ users = {
 }
 
 guilds = {
-    b"haxxors@" + server_name: {
+    b"haxxors@"
+    + server_name: {
         "description": b"Haxxors guild",
         "user_roles": [],
         "channels": [],
@@ -75,7 +322,8 @@ guilds = {
 
 
 channels = {
-    b"#librespeech@" + server_name: {
+    b"#librespeech@"
+    + server_name: {
         "broadcast_to": {
             b"andrew@andrewyu.org",
             b"Noisytoot@andrewyu.org",
@@ -87,7 +335,8 @@ channels = {
             b"guest@andrewyu.org",
         }
     },
-    b"#hackers@" + server_name: {
+    b"#hackers@"
+    + server_name: {
         "broadcast_to": {
             b"andrew@andrewyu.org",
             b"lurk@andrewyu.org",
@@ -32,12 +32,47 @@
 #
 
 from __future__ import annotations
-from typing import Optional, Union, List, Sequence, Any
-from dataclasses import dataclass, field
+from typing import Optional, Sequence, Any, AbstractSet
+from typing import TYPE_CHECKING
+from dataclasses import dataclass
+import zlib
+import trio
 import trio.abc
 
+import timers
 
-@dataclass
+if TYPE_CHECKING:
+    import limits
+
+# Entities are slotted and compare by identity.  There can be millions
+# of users, most of them offline and in no channels, so empty client
+# lists and member sets start out as the shared () and frozenset() and
+# only become real containers once something is put in them.  A user
+# is in a handful of channels, so that side is a tuple; a channel can
+# have a great many members, so that side is a set.
+
+_names: dict[bytes, bytes] = {}
+_flags: dict[frozenset[str], frozenset[str]] = {}
+
+
+def intern_name(name: bytes) -> bytes:
+    """
+    The one shared copy of a user, channel or guild name, so that the
+    config, the entity and every index keyed on it hold the same bytes.
+    """
+    return _names.setdefault(name, name)
+
+
+def intern_flags(flags: Any) -> frozenset[str]:
+    """
+    A shared frozenset of options or permissions; most users have the
+    same ones.
+    """
+    f = frozenset(flags)
+    return _flags.setdefault(f, f)
+
+
+@dataclass(slots=True, eq=False)
 class Server:
     # stub, we're not using it just yet
     rvalue: bytes
@@ -45,34 +80,70 @@ class Server:
     users: dict[bytes, User]
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class User:
     username: bytes
     password: bytes
-    options: list[str]
-    connected_clients: list[Client] = field(default_factory=list)
-    in_channels: list[Channel] = field(default_factory=list)
-    queue: list[bytes] = field(default_factory=list)
+    options: frozenset[str] = frozenset()
+    permissions: frozenset[str] = frozenset()
+    connected_clients: Sequence[Client] = ()
+    in_channels: tuple[Channel, ...] = ()
+    # Shared by all of the user's connections; see limits.charge().
+    bucket: Optional[limits.TokenBucket] = None
+
+    def add_client(self, client: Client) -> None:
+        if isinstance(self.connected_clients, list):
+            self.connected_clients.append(client)
+        else:
+            self.connected_clients = [client]
 
+    def remove_client(self, client: Client) -> None:
+        self.connected_clients = [
+            c for c in self.connected_clients if c is not client
+        ] or ()
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Client:
     cid: bytes
     stream: trio.abc.Stream
     user: Optional[User] = None
     ccrt: Optional[Any] = None
+    # Drained by the connection's writer task; see utils.enqueue().
+    outbox: Optional[trio.MemorySendChannel[bytes]] = None
+    # Cancelling this ends the whole connection.
+    cancel_scope: Optional[trio.CancelScope] = None
+    # Set once the client has sent COMPRESS; see idc._compress_cmd().
+    inflate: Optional[zlib._Decompress] = None
+    deflate: Optional[zlib._Compress] = None
+    # Set once the client has sent BINARY, and once the reply to it has
+    # been written; see idc._binary_cmd().
+    reads_binary: bool = False
+    writes_binary: bool = False
+    # Replies to COMPRESS or BINARY that haven't been written yet, and
+    # what the writer switches to after writing each.
+    switches: tuple[tuple[bytes, str], ...] = ()
+    # trio.current_time() of the last read, and the keepalive timer
+    # that checks on it; see idc._keepalive().
+    last_read: float = 0.0
+    timer: Optional[timers.Timer] = None
+    # Commands sent on this connection; see limits.charge().
+    bucket: Optional[limits.TokenBucket] = None
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Guild:
     guildname: bytes
-    users: list[User]
-    channels: list[Channel]
+    users: AbstractSet[User] = frozenset()
+    channels: AbstractSet[Channel] = frozenset()
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Channel:
     channelname: bytes
     guild: Optional[Guild]
-    broadcast_to: list[User]
+    # Add to this through utils.join_channel().
+    broadcast_to: AbstractSet[User] = frozenset()
+    # Bumped on every membership change; see utils.member_list().
+    members_version: int = 0
+    members_cache: Optional[tuple[int, bytes]] = None
@@ -168,3 +168,59 @@ class TargetOfflineError(IDCUserCausedException):
     """
 
     error_type = b"TARGET_OFFLINE"
+
+
+class LineTooLongError(IDCUserCausedException):
+    """
+    Line longer than config.max_line_length
+    """
+
+    error_type = b"LINE_TOO_LONG"
+
+
+class PermissionDeniedError(IDCUserCausedException):
+    """
+    User lacks the permission a command needs
+    """
+
+    error_type = b"PERMISSION_DENIED"
+
+
+class NotInChannelError(IDCUserCausedException):
+    """
+    User isn't a member of the channel they asked about
+    """
+
+    error_type = b"NOT_IN_CHANNEL"
+
+
+class InvalidArgumentError(IDCUserCausedException):
+    """
+    An argument's value doesn't make sense
+    """
+
+    error_type = b"INVALID_ARGUMENT"
+
+
+class AlreadyCompressed(IDCUserCausedException):
+    """
+    Connection has already been switched to compression
+    """
+
+    error_type = b"REDUNDENT_COMPRESS"
+
+
+class BadFrameError(IDCUserCausedException):
+    """
+    A binary frame's fields don't add up to its length
+    """
+
+    error_type = b"BAD_FRAME"
+
+
+class AlreadyBinary(IDCUserCausedException):
+    """
+    Connection has already been switched to binary frames
+    """
+
+    error_type = b"REDUNDENT_BINARY"
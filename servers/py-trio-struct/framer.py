@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Incremental line framer for the Internet Delay Chat server written in
+# Python Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from __future__ import annotations
+from typing import Optional
+from collections import deque
+from dataclasses import dataclass, field
+
+import codec
+import exceptions
+
+
+@dataclass
+class LineFramer:
+    """
+    Splits a byte stream into LF-terminated lines.  Incoming chunks are
+    appended to one bytearray; bytes before scan_offset are known not to
+    contain a LF, so they're never searched again.  Once a LF shows up,
+    every complete line in the buffer is split off in one C-level call
+    and handed out one at a time by next_line().
+    """
+
+    max_line_length: int
+    buf: bytearray = field(default_factory=bytearray)
+    scan_offset: int = 0
+    ready: deque[bytes] = field(default_factory=deque)
+    # Set after an oversized line has been reported, until the LF that
+    # ends it shows up.  Bytes of that line are thrown away meanwhile.
+    discarding: bool = False
+
+    def _too_long(self) -> exceptions.LineTooLongError:
+        return exceptions.LineTooLongError(
+            b"Lines may not be longer than "
+            + str(self.max_line_length).encode("ascii")
+            + b" bytes."
+        )
+
+    def feed(self, data: bytes) -> None:
+        self.buf += data
+
+    def next_line(self) -> Optional[bytes]:
+        """
+        Return the next complete line without its CR-LF, or None if more
+        data is needed.  Raises LineTooLongError once per line that
+        exceeds max_line_length; the rest of that line is dropped.
+        """
+        if not self.ready:
+            end = self.buf.rfind(b"\n", self.scan_offset)
+            if end == -1:
+                self.scan_offset = len(self.buf)
+                if self.discarding:
+                    del self.buf[:]
+                    self.scan_offset = 0
+                elif self.max_line_length and self.scan_offset > (
+                    # The CR of a line whose LF is still to come isn't
+                    # part of it.
+                    self.max_line_length
+                    + (self.buf[-1:] == b"\r")
+                ):
+                    del self.buf[:]
+                    self.scan_offset = 0
+                    self.discarding = True
+                    raise self._too_long()
+                return None
+            # One copy of the complete lines, not two.
+            with memoryview(self.buf) as view:
+                self.ready.extend(bytes(view[:end]).split(b"\n"))
+            del self.buf[: end + 1]
+            self.scan_offset = len(self.buf)
+            if self.discarding:
+                self.discarding = False
+                self.ready.popleft()
+                if not self.ready:
+                    return self.next_line()
+
+        line = self.ready.popleft()
+        if line[-1:] == b"\r":
+            line = line[:-1]
+        if self.max_line_length and len(line) > self.max_line_length:
+            raise self._too_long()
+        return line
+
+    def take_rest(self) -> bytes:
+        """
+        Return everything fed in but not yet returned by next_line(),
+        as it came in, and forget it.  For when the rest of the stream
+        has to be read differently, like after COMPRESS.
+        """
+        rest = b"".join(line + b"\n" for line in self.ready)
+        rest += self.buf
+        self.ready.clear()
+        del self.buf[:]
+        self.scan_offset = 0
+        self.discarding = False
+        return rest
+
+
+@dataclass
+class FrameFramer:
+    """
+    Splits a byte stream into length-prefixed binary frames (see
+    codec.decode_frame()).  It stands in for a LineFramer once a client
+    has sent BINARY, so next_line() hands out the body of each frame.
+    Like LineFramer, it splits off every complete frame in the buffer
+    at once and hands them out one at a time.
+    """
+
+    max_frame_length: int
+    buf: bytearray = field(default_factory=bytearray)
+    ready: deque[bytes] = field(default_factory=deque)
+    # Bytes still to throw away of a frame that was too long.
+    skipping: int = 0
+
+    def feed(self, data: bytes) -> None:
+        if self.skipping:
+            n = min(self.skipping, len(data))
+            self.skipping -= n
+            data = data[n:]
+        self.buf += data
+
+    def next_line(self) -> Optional[bytes]:
+        """
+        Return the next complete frame's body, or None if more data is
+        needed.  Raises LineTooLongError once per frame that's longer
+        than max_frame_length, and skips it.
+        """
+        if not self.ready and len(self.buf) >= codec.frame_length.size:
+            self._split()
+        if self.ready:
+            return self.ready.popleft()
+        return None
+
+    def _split(self) -> None:
+        data = bytes(self.buf)
+        end = len(data)
+        pos = 0
+        header = codec.frame_length.size
+        unpack_from = codec.frame_length.unpack_from
+        ready = self.ready
+        limit = self.max_frame_length
+        while end - pos >= header:
+            (length,) = unpack_from(data, pos)
+            if limit and length > limit:
+                if ready:
+                    # Hand out the ones before it first.
+                    break
+                pos += header
+                self.skipping = max(0, length - (end - pos))
+                pos = min(end, pos + length)
+                del self.buf[:pos]
+                raise exceptions.LineTooLongError(
+                    b"Frames may not be longer than "
+                    + str(limit).encode("ascii")
+                    + b" bytes."
+                )
+            if end - pos - header < length:
+                break
+            ready.append(data[pos + header : pos + header + length])
+            pos += header + length
+        del self.buf[:pos]
+
+    def take_rest(self) -> bytes:
+        """
+        Return everything fed in but not yet returned by next_line(),
+        and forget it.
+        """
+        rest = b"".join(
+            codec.frame_length.pack(len(f)) + f for f in self.ready
+        )
+        rest += self.buf
+        self.ready.clear()
+        del self.buf[:]
+        self.skipping = 0
+        return rest
@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+#
+# Channel message history for the Internet Delay Chat server written in
+# Python Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# Every channel message is kept twice: in a ring of the channel's most
+# recent messages in memory, and appended to segment files on disk,
+#
+#     <path>/<hex channel name>/<worker>-<number>.seg
+#
+# Each record is an _header (timestamp, length) followed by the line as
+# it was delivered.  Next to each segment, a .idx file holds a sparse
+# index: (timestamp, offset) of the first record and of the first one
+# after every index_every bytes.  Readers mmap the segments, find where
+# to start in the index and walk the records from there.  Workers each
+# write their own segments and read everyone's.
+#
+# Each message has an ID, unique across the server, and a SEQ that
+# counts up by one per channel so that clients can spot missed ones.
+# Only the channel's home worker (see cluster.py) numbers its messages;
+# after a restart it carries on from the last one on disk.
+
+from __future__ import annotations
+from typing import Iterator, Optional
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from heapq import merge
+
+import bisect
+import mmap
+import os
+import struct
+
+import trio
+
+import minilog
+import codec
+import config
+import cluster
+
+_header = struct.Struct(">dI")
+_entry = struct.Struct(">dQ")
+
+Message = tuple[float, bytes]
+
+
+@dataclass
+class Query:
+    """
+    Messages with after < timestamp < before.  With only before (or
+    neither), the newest limit of them; otherwise the oldest.
+    """
+
+    after: Optional[float] = None
+    before: Optional[float] = None
+    limit: int = 50
+
+    @property
+    def newest(self) -> bool:
+        return self.after is None
+
+    def wants(self, ts: float) -> bool:
+        return (self.after is None or ts > self.after) and (
+            self.before is None or ts < self.before
+        )
+
+
+# A reader keeps what has been appended to a segment since it was last
+# mapped in memory, and maps it again once there's this much of it.
+_REMAP_BYTES = 64 << 10
+
+
+@dataclass
+class Segment:
+    """
+    One segment file and its index, as seen by a reader.  refresh()
+    picks up whatever has been appended since the last look.  The
+    first `mapped` bytes are read through map and the rest from tail.
+    """
+
+    path: str
+    size: int = 0
+    map: Optional[mmap.mmap] = None
+    mapped: int = 0
+    tail: bytes = b""
+    index_ts: list[float] = field(default_factory=list)
+    index_off: list[int] = field(default_factory=list)
+    index_size: int = 0
+
+    def refresh(self) -> None:
+        size = os.stat(self.path).st_size
+        if size < self.size:
+            # Truncated after a crash; start over.
+            self.close()
+            self.index_size = 0
+            self.index_ts.clear()
+            self.index_off.clear()
+        if size - self.mapped >= _REMAP_BYTES:
+            if self.map is not None:
+                self.map.close()
+            with open(self.path, "rb") as f:
+                self.map = mmap.mmap(
+                    f.fileno(), size, access=mmap.ACCESS_READ
+                )
+            self.size = self.mapped = size
+            self.tail = b""
+        elif size > self.size:
+            with open(self.path, "rb") as f:
+                self.tail += os.pread(
+                    f.fileno(), size - self.size, self.size
+                )
+            self.size = size
+        try:
+            index_size = os.stat(self.path[:-4] + ".idx").st_size
+        except FileNotFoundError:
+            index_size = 0
+        if index_size > self.index_size:
+            with open(self.path[:-4] + ".idx", "rb") as f:
+                f.seek(self.index_size)
+                data = f.read(index_size - self.index_size)
+            # A half-written entry is read again next time.
+            whole = len(data) - len(data) % _entry.size
+            for ts, off in _entry.iter_unpack(data[:whole]):
+                self.index_ts.append(ts)
+                self.index_off.append(off)
+            self.index_size += whole
+
+    def records(
+        self, start: int = 0, end: Optional[int] = None
+    ) -> Iterator[tuple[float, int, bytes]]:
+        """
+        (timestamp, offset, line) for each whole record between start
+        and end.
+        """
+        end = self.size if end is None else min(end, self.size)
+        pos = start
+        while pos + _header.size <= end:
+            ts, length = _header.unpack(self._read(pos, _header.size))
+            if pos + _header.size + length > self.size:
+                # Still being written.
+                return
+            yield ts, pos, self._read(pos + _header.size, length)
+            pos += _header.size + length
+
+    def _read(self, pos: int, length: int) -> bytes:
+        end = pos + length
+        if end <= self.mapped:
+            assert self.map is not None
+            return self.map[pos:end]
+        if pos >= self.mapped:
+            return self.tail[pos - self.mapped : end - self.mapped]
+        assert self.map is not None
+        return self.map[pos:] + self.tail[: end - self.mapped]
+
+    def last_ts(self) -> float:
+        if not self.index_off:
+            return float("-inf")
+        ts = self.index_ts[-1]
+        for ts, _, _ in self.records(self.index_off[-1]):
+            pass
+        return ts
+
+    def oldest(self, q: Query) -> Iterator[Message]:
+        start = 0
+        if q.after is not None and self.index_ts:
+            # The last indexed record at or before after.
+            i = bisect.bisect_right(self.index_ts, q.after) - 1
+            start = self.index_off[max(i, 0)]
+        for ts, _, line in self.records(start):
+            if q.before is not None and ts >= q.before:
+                return
+            if q.wants(ts):
+                yield ts, line
+
+    def newest(self, q: Query) -> Iterator[Message]:
+        """
+        Newest first: walk the index's blocks backwards, reading each
+        block forwards.
+        """
+        if not self.index_off:
+            return
+        last = len(self.index_off)
+        if q.before is not None:
+            # Blocks from the first entry at or after before on only
+            # hold later records.
+            last = bisect.bisect_left(self.index_ts, q.before)
+        for i in range(last - 1, -1, -1):
+            end = (
+                self.index_off[i + 1]
+                if i + 1 < len(self.index_off)
+                else None
+            )
+            block = [
+                (ts, line)
+                for ts, _, line in self.records(self.index_off[i], end)
+                if q.wants(ts)
+            ]
+            yield from reversed(block)
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.size = self.mapped = 0
+        self.tail = b""
+
+
+@dataclass
+class Writer:
+    """
+    Appends one channel's messages to this worker's current segment.
+    """
+
+    directory: str
+    segment_bytes: int
+    index_every: int
+    number: int = -1
+    fd: int = -1
+    index_fd: int = -1
+    size: int = 0
+    indexed_at: int = -1
+    # Appended to since the last take_dirty().
+    dirty: bool = False
+
+    def __post_init__(self) -> None:
+        prefix = f"{cluster.worker_id:03d}-"
+        numbers = [
+            int(name[len(prefix) : -4])
+            for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(".seg")
+        ]
+        self._open(max(numbers, default=0))
+
+    def _path(self, ext: str) -> str:
+        return os.path.join(
+            self.directory,
+            f"{cluster.worker_id:03d}-{self.number:08d}{ext}",
+        )
+
+    def _open(self, number: int) -> None:
+        self.close()
+        self.number = number
+        self.fd = os.open(
+            self._path(".seg"), os.O_RDWR | os.O_CREAT, 0o644
+        )
+        self.index_fd = os.open(
+            self._path(".idx"), os.O_RDWR | os.O_CREAT, 0o644
+        )
+        self._recover()
+
+    def _recover(self) -> None:
+        """
+        Drop records and index entries torn by a crash.
+        """
+        segment = Segment(self._path(".seg"))
+        segment.refresh()
+        while True:
+            start = segment.index_off[-1] if segment.index_off else 0
+            self.size = start
+            for _, pos, line in segment.records(start):
+                self.size = pos + _header.size + len(line)
+            if self.size > start or not segment.index_off:
+                break
+            # The indexed record itself didn't make it.
+            segment.index_ts.pop()
+            segment.index_off.pop()
+        segment.close()
+        if self.size < os.fstat(self.fd).st_size:
+            minilog.caution(
+                "%s: dropping torn records", self._path(".seg")
+            )
+        os.ftruncate(self.fd, self.size)
+        os.lseek(self.fd, self.size, os.SEEK_SET)
+        index_size = len(segment.index_off) * _entry.size
+        os.ftruncate(self.index_fd, index_size)
+        os.lseek(self.index_fd, index_size, os.SEEK_SET)
+        self.indexed_at = (
+            segment.index_off[-1] if segment.index_off else -1
+        )
+
+    def append(self, ts: float, line: bytes) -> None:
+        if self.size >= self.segment_bytes:
+            self._open(self.number + 1)
+        if self.indexed_at < 0 or (
+            self.size - self.indexed_at >= self.index_every
+        ):
+            # The record goes in first, so a reader never finds an
+            # index entry pointing past the end of the segment.
+            os.write(self.fd, _header.pack(ts, len(line)) + line)
+            os.write(self.index_fd, _entry.pack(ts, self.size))
+            self.indexed_at = self.size
+        else:
+            os.write(self.fd, _header.pack(ts, len(line)) + line)
+        self.size += _header.size + len(line)
+        self.dirty = True
+
+    def take_dirty(self) -> list[int]:
+        """
+        Duplicates of the segment and index descriptors if anything has
+        been appended since last time, to be synced and closed by
+        _fsync(), which can then run in a thread while this writer
+        carries on or is closed.
+        """
+        if not self.dirty or self.fd < 0:
+            return []
+        self.dirty = False
+        return [os.dup(self.fd), os.dup(self.index_fd)]
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            os.close(self.index_fd)
+            self.fd = self.index_fd = -1
+
+
+def _fsync(fds: list[int]) -> None:
+    for fd in fds:
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+@dataclass
+class History:
+    path: Optional[str]
+    ring_size: int = 1000
+    segment_bytes: int = 64 << 20
+    index_every: int = 64 << 10
+    open_writers: int = 256
+    open_segments: int = 1024
+    # Per channel: the newest ring_size messages, oldest first.
+    rings: dict[bytes, deque[Message]] = field(default_factory=dict)
+    # ID and sequence number of each channel's last message.
+    last: dict[bytes, tuple[int, int]] = field(default_factory=dict)
+    writers: OrderedDict[bytes, Writer] = field(
+        default_factory=OrderedDict
+    )
+    # Segments mapped for reading, least recently read first.
+    segments: OrderedDict[str, Segment] = field(
+        default_factory=OrderedDict
+    )
+
+    def _directory(self, channelname: bytes) -> str:
+        assert self.path is not None
+        return os.path.join(self.path, channelname.hex())
+
+    def stamp(self, channelname: bytes) -> tuple[int, int]:
+        """
+        The message ID and sequence number of a new message in the
+        channel, both greater than the last one's.  The ID's timestamp
+        is its RSTS, so timestamps can be used as paging cursors too.
+        """
+        self._ring(channelname)
+        last_id, seq = self.last.get(channelname, (0, 0))
+        message_id = cluster.next_id(last_id)
+        self.last[channelname] = (message_id, seq + 1)
+        return message_id, seq + 1
+
+    def record(
+        self, channelname: bytes, ts: float, line: bytes
+    ) -> None:
+        self._ring(channelname).append((ts, line))
+        if self.path is None:
+            return
+        writer = self.writers.get(channelname)
+        if writer is None:
+            directory = self._directory(channelname)
+            os.makedirs(directory, exist_ok=True)
+            writer = self.writers[channelname] = Writer(
+                directory, self.segment_bytes, self.index_every
+            )
+            while len(self.writers) > self.open_writers:
+                self.writers.popitem(last=False)[1].close()
+        else:
+            self.writers.move_to_end(channelname)
+        writer.append(ts, line)
+
+    def _ring(self, channelname: bytes) -> deque[Message]:
+        ring = self.rings.get(channelname)
+        if ring is None:
+            # Start off with what's on disk, so the ring always holds
+            # the channel's newest messages.
+            ring = self.rings[channelname] = deque(
+                reversed(
+                    self._from_disk(
+                        channelname, Query(limit=self.ring_size)
+                    )
+                ),
+                maxlen=self.ring_size,
+            )
+            if ring and channelname not in self.last:
+                _, args = codec.decode_line(ring[-1][1])
+                self.last[channelname] = (
+                    int(args.get("ID", b"0")),
+                    int(args.get("SEQ", b"0")),
+                )
+        return ring
+
+    def _from_ring(
+        self, channelname: bytes, q: Query
+    ) -> Optional[list[Message]]:
+        """
+        The answer from the ring alone, or None if it might be missing
+        some.  With several workers the ring only has this worker's
+        messages, so it's never enough.
+        """
+        if self.path is not None and cluster.workers > 1:
+            return None
+        ring = self._ring(channelname)
+        complete = len(ring) < self.ring_size or self.path is None
+        if q.newest:
+            found = [m for m in reversed(ring) if q.wants(m[0])]
+            if len(found) >= q.limit or complete:
+                return found[: q.limit]
+            return None
+        assert q.after is not None
+        if not complete and (not ring or ring[0][0] > q.after):
+            return None
+        return [m for m in ring if q.wants(m[0])][: q.limit]
+
+    def _segments(self, channelname: bytes) -> list[list[Segment]]:
+        """
+        Every worker's segments for the channel, each worker's oldest
+        first.
+        """
+        directory = self._directory(channelname)
+        try:
+            names = sorted(
+                n for n in os.listdir(directory) if n.endswith(".seg")
+            )
+        except FileNotFoundError:
+            return []
+        chains: dict[str, list[Segment]] = {}
+        for name in names:
+            path = os.path.join(directory, name)
+            segment = self.segments.get(path)
+            if segment is None:
+                segment = self.segments[path] = Segment(path)
+            else:
+                self.segments.move_to_end(path)
+            segment.refresh()
+            chains.setdefault(name.split("-", 1)[0], []).append(segment)
+        # This channel's segments are the newest, so they stay mapped
+        # even if there are more of them than open_segments.
+        while len(self.segments) > max(self.open_segments, len(names)):
+            self.segments.popitem(last=False)[1].close()
+        return list(chains.values())
+
+    def _from_disk(self, channelname: bytes, q: Query) -> list[Message]:
+        if self.path is None:
+            return []
+        streams = []
+        for chain in self._segments(channelname):
+            if q.newest:
+                streams.append(
+                    m for s in reversed(chain) for m in s.newest(q)
+                )
+            else:
+                streams.append(
+                    m
+                    for s in chain
+                    if q.after is None or s.last_ts() > q.after
+                    for m in s.oldest(q)
+                )
+        found = []
+        for m in merge(*streams, key=lambda m: m[0], reverse=q.newest):
+            found.append(m)
+            if len(found) >= q.limit:
+                break
+        return found
+
+    def query(self, channelname: bytes, q: Query) -> list[Message]:
+        """
+        The messages q asks for, oldest first.
+        """
+        found = self._from_ring(channelname, q)
+        if found is None:
+            found = self._from_disk(channelname, q)
+        if q.newest:
+            found.reverse()
+        return found
+
+    def since(
+        self, channelname: bytes, message_id: int, limit: int
+    ) -> list[Message]:
+        """
+        The channel's messages after the one with message_id, oldest
+        first; the newest limit of them if there are more.
+        """
+        after = cluster.id_ts(message_id)
+        return [
+            (ts, line)
+            for ts, line in self.query(channelname, Query(limit=limit))
+            if ts > after
+            or (ts == after and cluster.line_id(line) > message_id)
+        ]
+
+    async def sync(self) -> None:
+        """
+        fsync the segments appended to since the last sync, in a thread.
+        """
+        fds = [
+            fd for w in self.writers.values() for fd in w.take_dirty()
+        ]
+        if fds:
+            await trio.to_thread.run_sync(_fsync, fds)
+
+    def close(self) -> None:
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        for segment in self.segments.values():
+            segment.close()
+        self.segments.clear()
+
+
+def open_history() -> History:
+    return History(
+        path=config.history.path,
+        ring_size=config.history.ring_size,
+        segment_bytes=config.history.segment_bytes,
+        index_every=config.history.index_every,
+        open_writers=config.history.open_writers,
+        open_segments=config.history.open_segments,
+    )
+
+
+store = History(path=None)
@@ -29,66 +29,82 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 #
-# This program requires Python 3.9 or later due to its extensive use of
-# type annotations.  Usage with an older version would likely cause
-# SyntaxErrors.  If mypy has problems detecting types on the Trio
-# library, install trio-typing.  Please mypy after every runnable edit.
+# This program requires Python 3.10 or later due to its extensive use of
+# type annotations and slotted dataclasses.  Usage with an older version
+# would likely cause SyntaxErrors.  If mypy has problems detecting types
+# on the Trio library, install trio-typing.  Please mypy after every
+# runnable edit.
 #
 
 from __future__ import annotations
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, Iterator, Optional
+import functools
+import math
 import time
-
-from pprint import pprint
+import zlib
 
 import trio
+import socket
 import ssl
+import struct
 import traceback
 
+import accounts
 import exceptions
 import entities
 import minilog
 import utils
 import config
+import codec
+import framer
+import offline
+import history
+import search
+import passwords
+import cluster
+import metrics
+import limits
+import loopwatch
+import timers
 
 starttime = time.time()
 
-PORT = 6835
+# Loaded in main(), so that importing this module doesn't need the
+# certificate to be readable.
+ctx: Optional[ssl.SSLContext] = None
+
+
+def make_ssl_context() -> ssl.SSLContext:
+    c = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    c.load_cert_chain(config.tls.cert, config.tls.key)
+    return c
 
-ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-ctx.load_cert_chain(
-    "/etc/letsencrypt/live/fcm.andrewyu.org/fullchain.pem",
-    "/etc/letsencrypt/live/fcm.andrewyu.org/privkey.pem",
-)
 
 client_id_counter = -1
-local_users: dict[bytes, entities.User] = {}
-local_channels: dict[bytes, entities.Channel] = {}
-
-for username in config.users:
-    local_users[username] = entities.User(
-        username=username,
-        password=config.users[username]["password"],
-        options=config.users[username]["options"],
-    )
 
-for channelname in config.channels:
-    local_channels[channelname] = entities.Channel(
-        channelname=channelname,
-        broadcast_to=[
-            local_users[username]
-            for username in config.channels[channelname]["broadcast_to"]
-        ],
-        guild=None,
-    )
-    for u in local_channels[channelname].broadcast_to:
-        u.in_channels.append(local_channels[channelname])
+
+def _outbound_depths() -> Iterator[int]:
+    for u in accounts.directory.users.values():
+        for c in u.connected_clients:
+            if c.outbox is not None:
+                yield c.outbox.statistics().current_buffer_used
+
+
+metrics.outbound_queued.func = lambda: sum(_outbound_depths())
+metrics.outbound_queued_max.func = lambda: max(
+    _outbound_depths(), default=0
+)
+metrics.offline_queued.func = lambda: offline.store.total()
+metrics.cached_users.func = lambda: len(accounts.directory.users)
+metrics.cached_channels.func = lambda: len(accounts.directory.channels)
+metrics.timers.func = lambda: timers.wheel.count
 
 
 _CMD_HANDLER = Callable[
     [entities.Client, "dict[str, bytes]"], Awaitable[None]
 ]
 _registered_commands: dict[bytes, _CMD_HANDLER] = {}
+_command_metrics: dict[bytes, metrics.Histogram] = {}
 
 
 def register_command(
@@ -96,6 +112,9 @@ def register_command(
 ) -> Callable[[_CMD_HANDLER], _CMD_HANDLER]:
     def register_inner(func: _CMD_HANDLER) -> _CMD_HANDLER:
         _registered_commands[command.encode("ascii")] = func
+        _command_metrics[command.encode("ascii")] = metrics.commands[
+            command
+        ]
         return func
 
     return register_inner
@@ -105,7 +124,7 @@ def register_command(
 async def _help_cmd(
     client: entities.Client, args: dict[str, bytes]
 ) -> None:
-    await utils.send(
+    utils.send(
         client,
         b"HELP",
         AVAILABLE_COMMANDS=b" ".join(_registered_commands),
@@ -125,109 +144,293 @@ async def _login_cmd(
 
     attempting_username = utils.carg(args, "USERNAME", b"LOGIN")
     attempting_password = utils.carg(args, "PASSWORD", b"LOGIN")
-    try:
-        if (
-            local_users[attempting_username].password
-            == attempting_password
-        ):
-            client.user = local_users[attempting_username]
-            local_users[attempting_username].connected_clients.append(
-                client
-            )
-            await utils.send(
-                client,
-                b"LOGIN_GOOD",
-                USERNAME=attempting_username,
-                COMMENT=b"Login is good.",
-            )
-            assert client.user is not None
-            for c in client.user.in_channels:
-                await utils.send(
-                    client,
-                    b"JOIN",
-                    CHANNEL=c.channelname,
-                    USERS=b" ".join(
-                        [u.username for u in c.broadcast_to]
-                    ),
-                )
-            await utils.send(
-                client,
-                b"END_BURST",
-                COMMENT=b"I'm finished telling you the state you're in.",
-            )
-            if client.user.queue:
-                for i in range(len(client.user.queue)):
-                    b = client.user.queue.pop(0)
-                    # Do not pop "i" here, because we're modifying the
-                    # iterated object within the iteration, so the
-                    # indexes change!  Therefore pop 0.
-                    await utils.quote(client, b)
-            await utils.send(
-                client,
-                b"END_OFFLINE_MESSAGES",
-                COMMENT=b"I'm finished telling you your offline messages.",
-            )
-        else:
+    resume = _id_arg(args, "RESUME")
+    user = accounts.directory.user(attempting_username)
+    stored = user.password if user else None
+    if not await passwords.check_password(stored, attempting_password):
+        if user is None:
             raise exceptions.LoginFailed(
-                b"Invalid password for " + attempting_username + b"."
+                attempting_username + b" is not a registered username."
             )
-    except KeyError:
+        raise exceptions.LoginFailed(
+            b"Invalid password for " + attempting_username + b"."
+        )
+    assert stored is not None
+    rehashed = None
+    if passwords.needs_rehash(stored):
+        rehashed = await passwords.hash_password(attempting_password)
+
+    # The user may have been dropped from memory, or deleted, while we
+    # waited.
+    user = accounts.directory.user(attempting_username)
+    if user is None:
         raise exceptions.LoginFailed(
             attempting_username + b" is not a registered username."
         )
+    if rehashed is not None:
+        accounts.directory.set_password(user, rehashed)
+        minilog.info(
+            "Upgraded the password hash of %r.", attempting_username
+        )
+    client.user = user
+    user.add_client(client)
+    accounts.directory.load_channels_of(user)
+    if len(user.connected_clients) == 1:
+        cluster.announce(user.username, True)
+    burst = utils.Burst(client, config.outbound.burst_size)
+    await burst.send(
+        b"LOGIN_GOOD",
+        USERNAME=attempting_username,
+        COMMENT=b"Login is good.",
+    )
+    for c in user.in_channels:
+        await burst.send(
+            b"JOIN",
+            CHANNEL=c.channelname,
+            USERS=utils.member_list(c),
+        )
+    await burst.send(
+        b"END_BURST",
+        COMMENT=b"I'm finished telling you the state you're in.",
+    )
+    if resume is None:
+        await cluster.drain_backlog(user.username, burst.quote)
+    else:
+        await _resume(user, resume, burst)
+    await burst.send(
+        b"END_OFFLINE_MESSAGES",
+        COMMENT=b"I'm finished telling you your offline messages.",
+    )
+    await burst.flush()
+
+
+async def _resume(
+    user: entities.User, after: int, burst: utils.Burst
+) -> None:
+    """
+    What a client that last saw message ID `after` has missed: each
+    channel's messages since then from history, at most resume_limit of
+    them per channel (a jump in SEQ tells the client to fetch the rest
+    with CHATHISTORY), then the rest of the offline queue.
+    """
+    for c in user.in_channels:
+        for _, line in history.store.since(
+            c.channelname, after, config.history.resume_limit
+        ):
+            await burst.quote(line)
+
+    async def emit(line: bytes) -> None:
+        if line.startswith(b"CHANMSG\t"):
+            # Already sent from history.
+            return
+        message_id = cluster.line_id(line)
+        if message_id == 0 or message_id > after:
+            await burst.quote(line)
+
+    await cluster.drain_backlog(user.username, emit)
+
+
+@register_command("COMPRESS")
+async def _compress_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    Switch the connection to a zlib stream both ways.  Whatever the
+    client sends after the COMPRESS line is compressed, and so is
+    whatever the server sends after its COMPRESS_GOOD reply.  The
+    server does a sync flush after every write, so what it has sent
+    can always be decompressed in full.  Works the same with BINARY,
+    in either order.
+    """
+    if not config.compression.enabled:
+        raise exceptions.UnknownCommand(
+            b"COMPRESS isn't enabled on this server."
+        )
+    if client.inflate is not None:
+        raise exceptions.AlreadyCompressed(
+            b"This connection is already compressed."
+        )
+    client.inflate = zlib.decompressobj()
+    line = utils.encode(
+        b"COMPRESS_GOOD",
+        COMMENT=b"Everything after this line is compressed.",
+    )
+    client.switches += ((line, "deflate"),)
+    await utils.quote(client, line)
+
+
+@register_command("BINARY")
+async def _binary_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    Switch the connection to length-prefixed binary frames both ways
+    (see codec.py).  Whatever the client sends after the BINARY line
+    is frames, and so is whatever the server sends after its
+    BINARY_GOOD reply.
+    """
+    if not config.binary_frames:
+        raise exceptions.UnknownCommand(
+            b"BINARY isn't enabled on this server."
+        )
+    if client.reads_binary:
+        raise exceptions.AlreadyBinary(
+            b"This connection is already using binary frames."
+        )
+    client.reads_binary = True
+    line = utils.encode(
+        b"BINARY_GOOD",
+        COMMENT=b"Everything after this is binary frames.",
+    )
+    client.switches += ((line, "binary"),)
+    await utils.quote(client, line)
 
 
 @register_command("PING")
 async def _ping_cmd(
     client: entities.Client, args: dict[str, bytes]
 ) -> None:
-    await utils.send(client, b"PONG", COOKIE=utils.carg(args, "COOKIE"))
+    utils.send(client, b"PONG", COOKIE=utils.carg(args, "COOKIE"))
+
+
+@register_command("PONG")
+async def _pong_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    The answer to a keepalive PING.  Hearing from the client at all is
+    what counts, and the read loop has already noted that.
+    """
 
 
 @register_command("EGG")
 async def _egg_cmd(
     client: entities.Client, args: dict[str, bytes]
 ) -> None:
-    await utils.send(
+    utils.send(
         client,
         b"EASTER_EGG",
         YAY=b"Andrew: Never gonna give you up\nnever gonna let you down\nnever gonna run around and desert you\nnever gonna make you cry\nnever gonna say goodbye\nnever gonna tell a lie and hurt you",
     )
 
 
+@register_command("STATS")
+async def _stats_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    if not client.user:
+        raise exceptions.NotLoggedIn(
+            b"You can't use STATS before logging in!"
+        )
+    if "stats" not in client.user.permissions:
+        raise exceptions.PermissionDeniedError(
+            b"You need the stats permission to use STATS."
+        )
+    burst = utils.Burst(client, config.outbound.burst_size)
+    for name, value in metrics.samples():
+        await burst.send(
+            b"STATS",
+            NAME=name.encode("utf-8"),
+            VALUE=metrics.format_value(value).encode("ascii"),
+        )
+    await burst.send(b"END_STATS", COMMENT=b"That's all of them.")
+    await burst.flush()
+
+
+@register_command("LAG")
+async def _lag_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    Report on the event loop: lag and the latest slow task steps,
+    oldest first.
+    """
+    if not client.user:
+        raise exceptions.NotLoggedIn(
+            b"You can't use LAG before logging in!"
+        )
+    if "stats" not in client.user.permissions:
+        raise exceptions.PermissionDeniedError(
+            b"You need the stats permission to use LAG."
+        )
+    watch = loopwatch.watch
+    if watch is None:
+        raise exceptions.UnknownCommand(
+            b"LAG isn't enabled on this server."
+        )
+    lags = watch.lags or (0.0,)
+    burst = utils.Burst(client, config.outbound.burst_size)
+    await burst.send(
+        b"LAG",
+        LAST=b"%.6f" % lags[-1],
+        MEAN=b"%.6f" % (sum(lags) / len(lags)),
+        MAX=b"%.6f" % max(lags),
+        SAMPLES=b"%d" % len(watch.lags),
+        SLOW=b"%d" % metrics.slow_steps.value,
+    )
+    for step in watch.report:
+        await burst.send(
+            b"SLOW_STEP",
+            WHEN=str(step.when).encode("ascii"),
+            SECONDS=b"%.6f" % step.seconds,
+            TASK=step.task.encode("utf-8"),
+            CLIENT=step.cid or None,
+            COMMAND=step.command or None,
+            SAMPLED=b"yes" if step.sampled else b"no",
+            STACK=step.stack.encode("utf-8"),
+        )
+    await burst.send(b"END_LAG", COMMENT=b"That's all of them.")
+    await burst.flush()
+
+
 @register_command("PRIVMSG")
 async def _privmsg_cmd(
     client: entities.Client, args: dict[str, bytes]
-) -> None:  # in the future this should return the raw line sent to the target client
+) -> None:
+    # In the future this should return the raw line sent to the target
+    # client.
     if not client.user:
         raise exceptions.NotLoggedIn(
             b"You can't use PRIVMSG before logging in!"
         )
     else:
         target_name = utils.carg(args, "TARGET")
-        try:
-            target_user = local_users[target_name]
-        except KeyError:
+        target_user = accounts.directory.user(target_name)
+        if target_user is None:
             raise exceptions.NonexistantTargetError(
                 b"The target " + target_name + b" is nonexistant."
             )
         else:
-            await utils.send(
-                target_user,
+            message = utils.carg(args, "MESSAGE")
+            message_id = cluster.next_id()
+            # The sender gets the very same line back.
+            line = utils.encode(
                 b"PRIVMSG",
                 SOURCE=client.user.username,
                 TYPE=args.get("TYPE", b"NORMAL"),
-                TARGET=utils.carg(args, "TARGET"),
-                MESSAGE=utils.carg(args, "MESSAGE"),
+                TARGET=target_name,
+                MESSAGE=message,
+                ID=b"%d" % message_id,
+                RSTS=str(cluster.id_ts(message_id)).encode("ascii"),
+            )
+            droppable = b"PRIVMSG" in config.outbound.droppable_commands
+            utils.deliver(
+                line, utils.resolve_recipients(target_user), droppable
             )
             if target_user is not client.user:
-                await utils.send(
-                    client.user,
-                    b"PRIVMSG",
-                    SOURCE=client.user.username,
-                    TYPE=args.get("TYPE", b"NORMAL"),
-                    TARGET=utils.carg(args, "TARGET"),
-                    MESSAGE=utils.carg(args, "MESSAGE"),
+                utils.deliver(
+                    line,
+                    utils.resolve_recipients(client.user),
+                    droppable,
+                )
+            if search.index is not None:
+                search.index.add(
+                    search.PRIVMSG,
+                    target_user.username,
+                    client.user.username,
+                    message_id,
+                    line,
+                    message,
                 )
         # Do you think that we should put echo-message here, or in utils.send()?
 
@@ -242,24 +445,222 @@ async def _chanmsg_cmd(
         )
     else:
         target_channel_name = utils.carg(args, "TARGET")
-        try:
-            target_channel = local_channels[target_channel_name]
-        except KeyError:
+        target_channel = accounts.directory.channel(target_channel_name)
+        if target_channel is None:
             raise exceptions.NonexistantTargetError(
                 b"The target channel "
                 + target_channel_name
                 + b"is nonexistant."
             )
         else:
+            post = {
+                "SOURCE": client.user.username,
+                "TYPE": args.get("TYPE", b"NORMAL"),
+                "TARGET": target_channel.channelname,
+                "MESSAGE": utils.carg(args, "MESSAGE"),
+            }
+            if cluster.is_home(target_channel.channelname):
+                _post_chanmsg(post)
+            else:
+                cluster.forward_chanmsg(post)
 
-            await utils.send(
-                target_channel,
-                b"CHANMSG",
-                SOURCE=client.user.username,
-                TYPE=args.get("TYPE", b"NORMAL"),
-                TARGET=target_channel_name,
-                MESSAGE=utils.carg(args, "MESSAGE"),
-            )
+
+def _post_chanmsg(args: dict[str, bytes]) -> None:
+    """
+    Number, record and deliver a CHANMSG.  Only the channel's home
+    worker does this, so that its messages are numbered in one place.
+    """
+    target_channel = accounts.directory.channel(args["TARGET"])
+    if target_channel is None:
+        return
+    metrics.chanmsg_fanout.observe(len(target_channel.broadcast_to))
+    message_id, seq = history.store.stamp(target_channel.channelname)
+    ts = cluster.id_ts(message_id)
+    line = utils.encode(
+        b"CHANMSG",
+        SOURCE=args["SOURCE"],
+        TYPE=args["TYPE"],
+        TARGET=target_channel.channelname,
+        MESSAGE=args["MESSAGE"],
+        ID=b"%d" % message_id,
+        SEQ=b"%d" % seq,
+        RSTS=str(ts).encode("ascii"),
+    )
+    history.store.record(target_channel.channelname, ts, line)
+    if search.index is not None:
+        search.index.add(
+            search.CHANMSG,
+            target_channel.channelname,
+            args["SOURCE"],
+            message_id,
+            line,
+            args["MESSAGE"],
+        )
+    r = utils.resolve_recipients(target_channel)
+    if not config.history.queue_offline:
+        r.offline_users.clear()
+    utils.deliver(
+        line,
+        r,
+        b"CHANMSG" in config.outbound.droppable_commands,
+    )
+
+
+cluster.post_chanmsg = _post_chanmsg
+
+
+def _timestamp_arg(args: dict[str, bytes], key: str) -> Optional[float]:
+    if key not in args:
+        return None
+    try:
+        ts = float(args[key])
+    except ValueError:
+        ts = math.nan
+    if not math.isfinite(ts):
+        raise exceptions.InvalidArgumentError(
+            key.encode("ascii") + b" must be a timestamp like RSTS."
+        )
+    return ts
+
+
+def _id_arg(args: dict[str, bytes], key: str) -> Optional[int]:
+    if key not in args:
+        return None
+    try:
+        message_id = int(args[key])
+    except ValueError:
+        message_id = -1
+    if message_id < 0:
+        raise exceptions.InvalidArgumentError(
+            key.encode("ascii") + b" must be a message ID."
+        )
+    return message_id
+
+
+def _limit_arg(args: dict[str, bytes], default: int, most: int) -> int:
+    if "LIMIT" not in args:
+        return default
+    try:
+        limit = int(args["LIMIT"])
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= most:
+        raise exceptions.InvalidArgumentError(
+            b"LIMIT must be a number from 1 to %d." % most
+        )
+    return limit
+
+
+@register_command("CHATHISTORY")
+async def _chathistory_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    Messages sent to a channel with AFTER < RSTS < BEFORE: with neither,
+    the newest LIMIT; with only BEFORE, the newest LIMIT before it;
+    otherwise the oldest LIMIT after AFTER.  They come back oldest first
+    as HISTORY lines, then END_HISTORY, whose MORE is 1 if there were
+    more to return.  Use the first or last RSTS as the next AFTER or
+    BEFORE to page through.
+    """
+    if not client.user:
+        raise exceptions.NotLoggedIn(
+            b"You can't use CHATHISTORY before logging in!"
+        )
+    target_channel_name = utils.carg(args, "TARGET", b"CHATHISTORY")
+    target_channel = accounts.directory.channel(target_channel_name)
+    if target_channel is None:
+        raise exceptions.NonexistantTargetError(
+            b"The target channel "
+            + target_channel_name
+            + b" is nonexistant."
+        )
+    if client.user not in target_channel.broadcast_to:
+        raise exceptions.NotInChannelError(
+            b"You aren't in " + target_channel_name + b"."
+        )
+    q = history.Query(
+        after=_timestamp_arg(args, "AFTER"),
+        before=_timestamp_arg(args, "BEFORE"),
+        limit=_limit_arg(
+            args, config.history.default_limit, config.history.max_limit
+        )
+        + 1,
+    )
+    found = history.store.query(target_channel.channelname, q)
+    more = len(found) >= q.limit
+    if more:
+        # Drop the one furthest from where the client is paging from.
+        found = found[1:] if q.newest else found[:-1]
+    burst = utils.Burst(client, config.outbound.burst_size)
+    for _, line in found:
+        await burst.quote(b"HISTORY" + line[len(b"CHANMSG") :])
+    await burst.send(
+        b"END_HISTORY",
+        TARGET=target_channel_name,
+        COUNT=b"%d" % len(found),
+        MORE=b"1" if more else b"0",
+    )
+    await burst.flush()
+
+
+@register_command("SEARCH")
+async def _search_cmd(
+    client: entities.Client, args: dict[str, bytes]
+) -> None:
+    """
+    Messages containing every word of QUERY, newest first, from the
+    channels the user is in and their own PRIVMSGs; optionally only
+    those in CHANNEL, from SOURCE, or with AFTER < RSTS < BEFORE.  They
+    come back as RESULT lines, then END_SEARCH, whose MORE is 1 if
+    there were more and whose BEFOREID is what to ask with for the
+    next page: only messages with a lower ID than that are returned.
+    """
+    if not client.user:
+        raise exceptions.NotLoggedIn(
+            b"You can't use SEARCH before logging in!"
+        )
+    if search.index is None:
+        raise exceptions.UnknownCommand(
+            b"SEARCH isn't enabled on this server."
+        )
+    terms = sorted(
+        search.terms_of(utils.carg(args, "QUERY", b"SEARCH"))
+    )
+    if not terms:
+        raise exceptions.InvalidArgumentError(
+            b"QUERY needs at least one word to search for."
+        )
+    limit = _limit_arg(
+        args, config.search.default_limit, config.search.max_limit
+    )
+    q = search.Query(
+        terms=terms,
+        user=client.user.username,
+        channels={c.channelname for c in client.user.in_channels},
+        channel=args.get("CHANNEL"),
+        source=args.get("SOURCE"),
+        after=_timestamp_arg(args, "AFTER"),
+        before=_timestamp_arg(args, "BEFORE"),
+        before_id=_id_arg(args, "BEFOREID"),
+        limit=limit + 1,
+    )
+    found = search.index.search(q)
+    more = len(found) > limit
+    found = found[:limit]
+    burst = utils.Burst(client, config.outbound.burst_size)
+    for _, line in found:
+        await burst.quote(b"RESULT" + line[line.index(b"\t") :])
+    end = {}
+    if more:
+        end["BEFOREID"] = b"%d" % found[-1][0]
+    await burst.send(
+        b"END_SEARCH",
+        COUNT=b"%d" % len(found),
+        MORE=b"1" if more else b"0",
+        **end,
+    )
+    await burst.flush()
 
 
 #             await utils.send(
@@ -275,73 +676,400 @@ async def connection_loop(stream: trio.SSLStream) -> None:
     global client_id_counter
     client_id_counter += 1
     ident = str(client_id_counter).encode("ascii")
-    minilog.note(f"Connection {str(ident)} has started.")
+    minilog.note("Connection %r has started.", ident)
+    handshake = trio.CancelScope()
+    deadline = timers.wheel.call_later(
+        config.timeouts.handshake, handshake.cancel
+    )
+    limits.gate.handshakes += 1
+    try:
+        with handshake:
+            await stream.do_handshake()
+    finally:
+        limits.gate.handshakes -= 1
+        deadline.cancel()
+    if handshake.cancelled_caught:
+        minilog.note("Connection %r took too long to handshake.", ident)
+        metrics.reaped.inc("handshake")
+        return
     client = entities.Client(cid=ident, stream=stream)
-    await utils.send(client, b"MOTD", MESSAGE=config.motd)
     client.ccrt = stream.getpeercert()
-    await utils.send(client, b"CLIENT_CERT", FINGERPRINT=repr(client.ccrt).encode("utf-8"))
+    outbox_recv: trio.MemoryReceiveChannel[bytes]
+    client.outbox, outbox_recv = trio.open_memory_channel(
+        config.outbound.queue_size
+    )
     try:
-        msg = b""
-        async for newmsg in stream:
-            msg += newmsg
-            split_msg = msg.split(b"\n")
-            if split_msg[-1] == b"\r":
-                split_msg = split_msg[:-1]
-            if len(split_msg) < 2:
-                continue
-            data = split_msg[0:-1]
-            msg = split_msg[-1]
-            minilog.debug(f"{ident.decode('ascii')} >>> {data!r}")
-            for cmdline in data:
+        async with trio.open_nursery() as nursery:
+            client.cancel_scope = nursery.cancel_scope
+            nursery.start_soon(write_loop, client, outbox_recv)
+            client.last_read = trio.current_time()
+            _keepalive(client)
+            utils.send(client, b"MOTD", MESSAGE=config.motd)
+            utils.send(
+                client,
+                b"CLIENT_CERT",
+                FINGERPRINT=repr(client.ccrt).encode("utf-8"),
+            )
+            try:
+                await read_loop(client)
+            finally:
+                if client.user:
+                    client.user.remove_client(client)
+                    if not client.user.connected_clients:
+                        cluster.announce(client.user.username, False)
+                # Let the writer flush what's left, but not forever.
+                client.outbox.close()
+                nursery.cancel_scope.deadline = (
+                    trio.current_time() + config.outbound.linger
+                )
+    except Exception as exc:
+        traceback.print_exc()
+        minilog.warning("%r: crashed: %s", ident, repr(exc))
+    finally:
+        if client.timer is not None:
+            client.timer.cancel()
+        del client.stream
+        del client
+        minilog.note("Connection %r has ended.", ident)
+
+
+def _keepalive(client: entities.Client) -> None:
+    """
+    Check on a connection from the timer wheel: PING it once it has
+    been quiet for timeouts.ping_after seconds, and disconnect it if it
+    stays quiet for timeouts.ping_timeout more.  Until then, look again
+    when that could next be due.
+    """
+    ping_after = config.timeouts.ping_after
+    idle = trio.current_time() - client.last_read
+    if idle < ping_after:
+        deadline = client.last_read + ping_after
+    elif idle < ping_after + config.timeouts.ping_timeout:
+        utils.enqueue(client, utils.encode(b"PING", COOKIE=utils.ts()))
+        deadline = (
+            client.last_read + ping_after + config.timeouts.ping_timeout
+        )
+    else:
+        minilog.note(
+            "Connection %r has been idle for %d seconds,"
+            " disconnecting.",
+            client.cid,
+            idle,
+        )
+        metrics.reaped.inc("idle")
+        client.timer = None
+        utils.disconnect(client)
+        return
+    client.timer = timers.wheel.call_at(
+        deadline, functools.partial(_keepalive, client)
+    )
+
+
+async def read_loop(client: entities.Client) -> None:
+    cid = client.cid.decode("ascii")
+    line_framer: framer.LineFramer | framer.FrameFramer
+    line_framer = framer.LineFramer(
+        max_line_length=config.max_line_length
+    )
+    decode: Callable[[bytes], tuple[bytes, dict[str, bytes]]]
+    decode = codec.decode_line
+    async for newmsg in client.stream:
+        client.last_read = trio.current_time()
+        metrics.received_bytes.inc(len(newmsg))
+        pending = newmsg
+        while pending:
+            if client.inflate is None:
+                line_framer.feed(pending)
+                pending = b""
+            else:
+                # A little at a time, so that a small amount of
+                # compressed data can't fill up memory.
+                try:
+                    data = client.inflate.decompress(
+                        pending, config.compression.inflate_chunk
+                    )
+                except zlib.error as exc:
+                    minilog.caution(
+                        "%s: bad compressed data (%s), disconnecting.",
+                        cid,
+                        str(exc),
+                    )
+                    return
+                metrics.inflated_bytes.inc(len(data))
+                line_framer.feed(data)
+                pending = client.inflate.unconsumed_tail
+            compressed = client.inflate is not None
+            while True:
+                # What's left of a bad line still costs something.
+                cost = 1.0
                 try:
-                    cmd, args = utils.bytesToStd(cmdline)
+                    cmdline = line_framer.next_line()
+                    if cmdline is None:
+                        break
+                    minilog.debug("%s >>> %r", cid, cmdline)
+                    cmd, args = decode(cmdline)
                     cmd = cmd.upper()
-                    if cmd in _registered_commands:
-                        await _registered_commands[cmd](client, args)
-                    else:
+                    if cmd not in _registered_commands:
                         raise exceptions.UnknownCommand(
                             cmd + b" is an unknown command."
                         )
+                    if config.ratelimit.enabled:
+                        cost = _command_cost(client, cmd, args)
+                    started = time.perf_counter()
+                    handling = loopwatch.handling.set((client.cid, cmd))
+                    try:
+                        await _registered_commands[cmd](client, args)
+                    finally:
+                        loopwatch.handling.reset(handling)
+                        _command_metrics[cmd].observe(
+                            time.perf_counter() - started
+                        )
                 except exceptions.IDCUserCausedException as e:
-                    await utils.send(
+                    utils.send(
                         client,
                         e.severity,
                         PROBLEM=e.error_type,
                         COMMENT=e.args[0],
                     )
-    except Exception as exc:
-        traceback.print_exc()
-        minilog.warning(f"{ident!r}: crashed: {exc!r}")
-    finally:
-        if client.user:
-            client.user.connected_clients.remove(client)
-        del client.stream
-        del client
-        minilog.note(f"Connection {str(ident)} has ended.")
+                delay = (
+                    limits.charge(client, cost)
+                    if config.ratelimit.enabled
+                    else 0.0
+                )
+                if delay:
+                    # Over the rate limit.  The client is left waiting
+                    # on the socket meanwhile, which doesn't count as
+                    # being idle, so the keepalive timer is held off
+                    # until the wait is over.
+                    metrics.ratelimit_delays.inc()
+                    metrics.ratelimit_delay_seconds.inc(delay)
+                    client.last_read = trio.current_time() + delay
+                    await trio.sleep(delay)
+                if client.reads_binary and decode is codec.decode_line:
+                    # That was BINARY; what came after it is frames.
+                    rest = line_framer.take_rest()
+                    line_framer = framer.FrameFramer(
+                        max_frame_length=config.max_line_length
+                    )
+                    line_framer.feed(rest)
+                    decode = codec.decode_frame
+                if not compressed and client.inflate is not None:
+                    # That was COMPRESS; what came after it is
+                    # compressed.
+                    pending = line_framer.take_rest() + pending
+                    break
+
+
+def _command_cost(
+    client: entities.Client, cmd: bytes, args: dict[str, bytes]
+) -> float:
+    cost = config.ratelimit.costs.get(cmd, 1.0)
+    # Only a logged in client can make the channel be looked up, since
+    # that can mean going to the account store.
+    if cmd == b"CHANMSG" and client.user and "TARGET" in args:
+        channel = accounts.directory.channel(args["TARGET"])
+        if channel is not None:
+            cost += (
+                len(channel.broadcast_to)
+                * config.ratelimit.chanmsg_per_member
+            )
+    return cost
+
+
+async def write_loop(
+    client: entities.Client,
+    outbox_recv: trio.MemoryReceiveChannel[bytes],
+) -> None:
+    """
+    Drain the client's outbound queue into its stream.  This is the
+    only task that writes to the stream, so a slow reader only ever
+    holds up itself.  Whatever has piled up in the queue goes out in
+    one write: the lines are referenced where they are until they're
+    joined once for the stream, or fed one by one to the compressor.
+    """
+    async with outbox_recv:
+        try:
+            async for line in outbox_recv:
+                pending = [line]
+                size = len(line)
+                # Not past a switch, since what follows is written
+                # differently.
+                while size < config.outbound.burst_size and not (
+                    _switches_after(client, line)
+                ):
+                    try:
+                        line = outbox_recv.receive_nowait()
+                    except (trio.WouldBlock, trio.EndOfChannel):
+                        break
+                    pending.append(line)
+                    size += len(line)
+                if client.writes_binary:
+                    # Line by line, since those are what's shared
+                    # between clients and cached.
+                    pending = [codec.frames_of(p) for p in pending]
+                    size = sum(map(len, pending))
+                if client.deflate is not None:
+                    metrics.deflated_bytes.inc(size)
+                    if size >= config.compression.thread_bytes:
+                        data = await trio.to_thread.run_sync(
+                            utils.deflate, client, pending
+                        )
+                    else:
+                        data = utils.deflate(client, pending)
+                elif len(pending) > 1:
+                    data = b"".join(pending)
+                else:
+                    data = pending[0]
+                await client.stream.send_all(data)
+                metrics.sent_bytes.inc(len(data))
+                if _switches_after(client, line):
+                    _switch(client, client.switches[0][1])
+                    client.switches = client.switches[1:]
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            utils.disconnect(client)
+
+
+def _switches_after(client: entities.Client, line: bytes) -> bool:
+    return bool(client.switches) and line is client.switches[0][0]
+
+
+def _switch(client: entities.Client, to: str) -> None:
+    """
+    Start writing to the client differently, once the reply to the
+    command that asked for it has been written.
+    """
+    if to == "deflate":
+        client.deflate = zlib.compressobj(
+            config.compression.level,
+            zlib.DEFLATED,
+            config.compression.window_bits,
+            config.compression.mem_level,
+        )
+    elif to == "binary":
+        client.writes_binary = True
 
 
 async def tls_wrapper(s: trio.SocketStream) -> None:
+    assert ctx is not None
+    try:
+        address = s.socket.getpeername()[0]
+    except OSError:
+        # Gone already.
+        await trio.aclose_forcefully(s)
+        return
+    reason = limits.gate.admit(address)
+    if reason is not None:
+        metrics.rejected.inc(reason)
+        minilog.debug("Turned away %s: %s.", address, reason)
+        # Reset rather than close, so that the flood doesn't leave
+        # sockets behind in TIME_WAIT either.
+        s.setsockopt(
+            socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+        )
+        await trio.aclose_forcefully(s)
+        return
+    metrics.connections.inc()
     try:
         await connection_loop(trio.SSLStream(s, ctx, server_side=True))
     except trio.BrokenResourceError:
         minilog.caution("Some client has messed-up TLS.")
+    finally:
+        metrics.connections.dec()
+        limits.gate.release(address)
+
+
+async def sync_loop() -> None:
+    while True:
+        await trio.sleep(config.offline.sync_interval)
+        await offline.store.sync()
+        await history.store.sync()
 
 
 async def main() -> None:
-    await trio.serve_tcp(tls_wrapper, PORT)
+    global ctx
+    ctx = make_ssl_context()
+    if cluster.workers > 1:
+        offline.store = offline.open_store(f".{cluster.worker_id}")
+    else:
+        offline.store = offline.open_store()
+    accounts.directory = accounts.open_directory()
+    history.store = history.open_history()
+    search.index = search.open_index()
+    cluster.local_users = accounts.directory.users
+    timers.wheel = timers.Wheel(config.timeouts.tick)
+    try:
+        async with trio.open_nursery() as nursery:
+            await nursery.start(timers.wheel.run)
+            if config.loopwatch.enabled:
+                loopwatch.watch = loopwatch.LoopWatch(
+                    config.loopwatch.slow_step,
+                    config.loopwatch.report_size,
+                    config.loopwatch.stack_depth,
+                )
+                await nursery.start(
+                    loopwatch.watch.run, config.loopwatch.lag_interval
+                )
+            nursery.start_soon(sync_loop)
+            if search.index is not None:
+                nursery.start_soon(search.index.run)
+            nursery.start_soon(
+                minilog.flush_loop, config.log.flush_interval
+            )
+            if config.metrics.port is not None:
+                nursery.start_soon(
+                    metrics.serve_http,
+                    config.metrics.host,
+                    config.metrics.port + cluster.worker_id,
+                )
+            if cluster.workers > 1:
+                await cluster.connect(nursery)
+                await trio.serve_listeners(
+                    tls_wrapper,
+                    await cluster.reuseport_listeners(
+                        config.listen.port
+                    ),
+                )
+            else:
+                await trio.serve_tcp(tls_wrapper, config.listen.port)
+    finally:
+        offline.store.close()
+        accounts.directory.close()
+        history.store.close()
+        if search.index is not None:
+            search.index.close()
 
 
 def run_i_guess() -> None:
     trio.run(main)
 
 
+def setup_logging() -> None:
+    minilog.configure(
+        level_name=config.log.level,
+        path=config.log.path,
+        max_bytes=config.log.max_bytes,
+        backups=config.log.backups,
+        buffered=config.log.buffered,
+        ring_size=config.log.ring_size,
+        ring_level_name=config.log.ring_level,
+    )
+
+
 if __name__ == "__main__":
+    setup_logging()
     try:
         minilog.note("Definitions complete.  Establishing listener.")
-        trio.run(main)
+        if cluster.workers > 1:
+            cluster.supervise(run_i_guess)
+        else:
+            trio.run(main)
     except KeyboardInterrupt:
         minilog.error("KeyboardInterrupt!")
+    except BaseException:
+        minilog.dump_ring()
+        raise
     finally:
         minilog.note(
-            f"I've ran for {str(time.time() - starttime)} seconds!"
+            "I've ran for %s seconds!", time.time() - starttime
         )
+        minilog.flush()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#
+# Connection limits for the Internet Delay Chat server written in Python
+# Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# Admission control, in front of every TLS handshake.  A new connection
+# is turned away if the server already has admission.max_connections,
+# or admission.max_handshakes still shaking hands, or its address
+# already has admission.max_per_ip, or if it would overdraw the token
+# bucket of new connections, in all or from its address.  That's all
+# decided from the address alone, so a flood costs an accept() and a
+# close() per connection and no TLS.  IPv6 addresses are grouped by
+# their first admission.ipv6_prefix bits, since one host usually has a
+# whole /64.  In cluster mode each worker has its own limits.
+
+from __future__ import annotations
+from typing import Optional
+from dataclasses import dataclass, field
+import socket
+
+import trio
+
+import config
+import entities
+import timers
+
+
+@dataclass(slots=True)
+class TokenBucket:
+    """
+    Allows rate things per second on average, and up to burst at once.
+    """
+
+    rate: float
+    burst: float
+    tokens: float = 0.0
+    stamp: float = 0.0
+
+    def __post_init__(self) -> None:
+        self.tokens = self.burst
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        """
+        Take cost tokens if there are that many.
+        """
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def charge(self, now: float, cost: float) -> float:
+        """
+        Take cost tokens even if that puts the bucket in debt, and
+        return how many seconds it'll take to pay that off.
+        """
+        self.refill(now)
+        self.tokens -= cost
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full_at(self) -> float:
+        """
+        When the bucket will be full again, as of the last refill.
+        """
+        return self.stamp + (self.burst - self.tokens) / self.rate
+
+
+@dataclass(slots=True, eq=False)
+class _Source:
+    bucket: TokenBucket
+    connections: int = 0
+    # Drops the source once it has no connections and a full bucket,
+    # since then it's no different from one never seen.
+    timer: Optional[timers.Timer] = None
+
+
+@dataclass
+class Gate:
+    connections: int = 0
+    handshakes: int = 0
+    bucket: Optional[TokenBucket] = None
+    sources: dict[str, _Source] = field(default_factory=dict)
+
+    def admit(self, address: str) -> Optional[str]:
+        """
+        Count a connection from address in, or return why it's turned
+        away.  Connections let in must be let out with release().
+        """
+        limits = config.admission
+        if self.connections >= limits.max_connections:
+            return "connections"
+        if self.handshakes >= limits.max_handshakes:
+            return "handshakes"
+        key = source_key(address)
+        source = self.sources.get(key)
+        if source is None:
+            source = self.sources[key] = _Source(
+                TokenBucket(limits.per_ip_rate, limits.per_ip_burst)
+            )
+            self._forget_later(key, source)
+        if source.connections >= limits.max_per_ip:
+            return "per_ip"
+        now = trio.current_time()
+        if not source.bucket.take(now):
+            return "per_ip_rate"
+        if self.bucket is None:
+            self.bucket = TokenBucket(limits.rate, limits.burst)
+        if not self.bucket.take(now):
+            source.bucket.tokens += 1
+            return "rate"
+        self.connections += 1
+        source.connections += 1
+        return None
+
+    def release(self, address: str) -> None:
+        key = source_key(address)
+        source = self.sources[key]
+        self.connections -= 1
+        source.connections -= 1
+        if not source.connections:
+            self._forget_later(key, source)
+
+    def _forget_later(self, key: str, source: _Source) -> None:
+        if source.timer is not None:
+            source.timer.cancel()
+        source.bucket.refill(trio.current_time())
+        source.timer = timers.wheel.call_at(
+            source.bucket.full_at(), lambda: self._forget(key, source)
+        )
+
+    def _forget(self, key: str, source: _Source) -> None:
+        source.timer = None
+        if source.connections or self.sources.get(key) is not source:
+            return
+        source.bucket.refill(trio.current_time())
+        if source.bucket.tokens < source.bucket.burst:
+            self._forget_later(key, source)
+        else:
+            del self.sources[key]
+
+
+def charge(client: entities.Client, cost: float) -> float:
+    """
+    Charge a command's cost to the connection and to its user, and
+    return how long the connection should wait before it's read from
+    again (see ratelimit in config.py).
+    """
+    now = trio.current_time()
+    profile = _profile(client.user)
+    rate, burst = profile["connection"]
+    b = client.bucket
+    if b is None or b.rate != rate or b.burst != burst:
+        # New, or the client just logged in as someone with another
+        # profile.
+        b = client.bucket = TokenBucket(rate, burst)
+    delay = b.charge(now, cost)
+    user = client.user
+    if user is not None:
+        if user.bucket is None:
+            user.bucket = TokenBucket(*profile["user"])
+        delay = max(delay, user.bucket.charge(now, cost))
+    return delay
+
+
+def _profile(
+    user: Optional[entities.User],
+) -> dict[str, tuple[float, float]]:
+    profiles = config.ratelimit.profiles
+    if user is not None:
+        # In the order they're configured, not the order of the
+        # user's options, which are a set.
+        for name, profile in profiles.items():
+            if name in user.options:
+                return profile
+    return profiles["default"]
+
+
+def source_key(address: str) -> str:
+    """
+    What connections from address are counted under.
+    """
+    if ":" not in address:
+        return address
+    prefix = config.admission.ipv6_prefix
+    try:
+        packed = socket.inet_pton(
+            socket.AF_INET6, address.partition("%")[0]
+        )
+    except OSError:
+        return address
+    network = int.from_bytes(packed, "big") >> (128 - prefix)
+    return f"{network:x}/{prefix}"
+
+
+gate = Gate()
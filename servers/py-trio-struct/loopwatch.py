@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# Event loop watchdog for the Internet Delay Chat server written in
+# Python Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# Everything runs on one trio loop, so a task step that takes long
+# before it yields (a big fan-out, a slow write to the log, joining a
+# huge reply) holds up every client.  This keeps an eye on that:
+#
+# - Lag: a task sleeps lag_interval seconds at a time and notes how
+#   much later than asked it woke up, which is how long anything that
+#   becomes ready has to wait for the loop.
+# - Slow steps: an Instrument times every task step, from trio
+#   resuming a task to it yielding again.  A watchdog thread looks at
+#   the step in progress every slow_step / 2 seconds and, once it has
+#   run for slow_step, takes the loop thread's stack, so the report
+#   shows where the time is going rather than where the task ended up.
+#   If the thread can't get the GIL in time (C code holding it), the
+#   report has where the task was suspended afterwards instead.
+#
+# Slow steps are logged as cautions, and the newest report_size of
+# them are kept, with the lag, for the LAG command.
+
+from __future__ import annotations
+from typing import Any, Optional
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass
+import math
+import sys
+import threading
+import time
+import traceback
+
+import trio
+import trio.abc
+
+import minilog
+import metrics
+
+# The client (its cid) and command a task is handling, if any.
+handling: ContextVar[tuple[bytes, bytes]] = ContextVar(
+    "handling", default=(b"", b"")
+)
+
+# Lag samples kept for LAG.
+LAG_SAMPLES = 120
+
+
+@dataclass(slots=True)
+class SlowStep:
+    # time.time() when the step ended.
+    when: float
+    seconds: float
+    task: str
+    cid: bytes
+    command: bytes
+    stack: str
+    # Whether the stack was taken during the step.
+    sampled: bool
+
+
+class LoopWatch(trio.abc.Instrument):
+    def __init__(
+        self, slow_step: float, report_size: int, stack_depth: int
+    ) -> None:
+        self.slow_step = slow_step
+        self.stack_depth = stack_depth
+        self.report: deque[SlowStep] = deque(maxlen=report_size)
+        self.lags: deque[float] = deque(maxlen=LAG_SAMPLES)
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+        # The step in progress, written by the loop thread and read by
+        # the watchdog thread.  started is inf between steps.
+        self.steps = 0
+        self.started = math.inf
+        self.task: Optional[trio.lowlevel.Task] = None
+        # (step, stack, what the task was handling) the watchdog took.
+        self.sample: Optional[tuple[int, str, tuple[bytes, bytes]]] = (
+            None
+        )
+
+    def before_task_step(self, task: trio.lowlevel.Task) -> None:
+        self.steps += 1
+        self.task = task
+        self.started = time.perf_counter()
+
+    def after_task_step(self, task: trio.lowlevel.Task) -> None:
+        seconds = time.perf_counter() - self.started
+        self.started = math.inf
+        if seconds >= self.slow_step:
+            self._slow(task, seconds)
+
+    def _slow(self, task: trio.lowlevel.Task, seconds: float) -> None:
+        sample = self.sample
+        if sample is not None and sample[0] == self.steps:
+            _, stack, (cid, command) = sample
+            sampled = True
+        else:
+            summary = traceback.StackSummary.extract(
+                task.iter_await_frames(), limit=self.stack_depth
+            )
+            stack, sampled = "".join(summary.format()), False
+            cid, command = task.context.get(handling, (b"", b""))
+        step = SlowStep(
+            time.time(),
+            seconds,
+            task.name,
+            cid,
+            command,
+            stack,
+            sampled,
+        )
+        self.report.append(step)
+        metrics.slow_steps.inc()
+        where = "in" if sampled else "then suspended at"
+        if command:
+            minilog.caution(
+                "Task %s held up the loop for %.3f seconds handling %r"
+                " from %r, %s:\n%s",
+                task.name,
+                seconds,
+                command,
+                cid,
+                where,
+                stack.rstrip("\n"),
+            )
+        else:
+            minilog.caution(
+                "Task %s held up the loop for %.3f seconds, %s:\n%s",
+                task.name,
+                seconds,
+                where,
+                stack.rstrip("\n"),
+            )
+
+    def _watchdog(self) -> None:
+        while not self.stopped.wait(self.slow_step / 2):
+            steps, started, task = self.steps, self.started, self.task
+            if time.perf_counter() - started < self.slow_step:
+                continue
+            sample = self.sample
+            if sample is not None and sample[0] == steps:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = "".join(
+                traceback.format_stack(frame, limit=self.stack_depth)
+            )
+            del frame
+            if task is None or self.steps != steps:
+                continue
+            # The command is usually done by the time the step is.
+            self.sample = (
+                steps,
+                stack,
+                task.context.get(handling, (b"", b"")),
+            )
+
+    async def run(
+        self,
+        lag_interval: float,
+        task_status: Any = trio.TASK_STATUS_IGNORED,
+    ) -> None:
+        trio.lowlevel.add_instrument(self)
+        thread = threading.Thread(
+            target=self._watchdog, name="loopwatch", daemon=True
+        )
+        thread.start()
+        task_status.started()
+        try:
+            while True:
+                start = trio.current_time()
+                await trio.sleep(lag_interval)
+                lag = trio.current_time() - start - lag_interval
+                self.lags.append(lag)
+                metrics.loop_lag.observe(lag)
+        finally:
+            self.stopped.set()
+            try:
+                trio.lowlevel.remove_instrument(self)
+            except KeyError:
+                # trio drops an instrument that raised.
+                pass
+
+
+# Set up by main() if config.loopwatch.enabled.
+watch: Optional[LoopWatch] = None
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+#
+# Metrics for the Internet Delay Chat server written in Python Trio.
+# Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# Counters, gauges and histograms that are cheap enough to update on
+# every line, read back through the STATS command or as Prometheus text
+# over plain HTTP on localhost.  In cluster mode every worker keeps and
+# serves its own.
+
+from __future__ import annotations
+from typing import Callable, Iterator, Optional, Union
+from bisect import bisect_left
+from dataclasses import dataclass, field
+
+import trio
+
+import minilog
+
+Sample = tuple[str, float]
+
+# Seconds.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+)
+# Recipients.
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_value(v: float) -> str:
+    if v == int(v):
+        return str(int(v))
+    return repr(v)
+
+
+@dataclass
+class Counter:
+    name: str
+    help: str
+    value: float = 0
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, self.value
+
+
+@dataclass
+class LabeledCounter:
+    """
+    One count per value of a single label.  Only use labels with a
+    small, fixed set of values.
+    """
+
+    name: str
+    help: str
+    label: str
+    values: dict[str, float] = field(default_factory=dict)
+
+    def inc(self, value: str, n: float = 1) -> None:
+        self.values[value] = self.values.get(value, 0) + n
+
+    def samples(self) -> Iterator[Sample]:
+        for value, n in sorted(self.values.items()):
+            yield f'{self.name}{{{self.label}="{value}"}}', n
+
+
+@dataclass
+class Gauge:
+    """
+    A value that goes up and down.  If func is set, it's called for the
+    value whenever the gauge is read instead.
+    """
+
+    name: str
+    help: str
+    value: float = 0
+    func: Optional[Callable[[], float]] = None
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def dec(self, n: float = 1) -> None:
+        self.value -= n
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, self.func() if self.func else self.value
+
+
+@dataclass
+class Histogram:
+    name: str
+    help: str
+    buckets: tuple[float, ...]
+    # Label text for every sample, like 'command="PING"'.
+    labels: str = ""
+    # counts[i] is observations <= buckets[i] and > buckets[i - 1];
+    # the last one is everything above the highest bucket.
+    counts: list[int] = field(default_factory=list)
+    sum: float = 0
+    count: int = 0
+
+    def __post_init__(self) -> None:
+        if not self.counts:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def samples(self) -> Iterator[Sample]:
+        sep = "," if self.labels else ""
+        total = 0
+        for le, n in zip(self.buckets, self.counts):
+            total += n
+            yield (
+                f'{self.name}_bucket{{{self.labels}{sep}le="{le}"}}',
+                total,
+            )
+        yield (
+            f'{self.name}_bucket{{{self.labels}{sep}le="+Inf"}}',
+            self.count,
+        )
+        braces = f"{{{self.labels}}}" if self.labels else ""
+        yield f"{self.name}_sum{braces}", self.sum
+        yield f"{self.name}_count{braces}", self.count
+
+
+@dataclass
+class LabeledHistogram:
+    """
+    One Histogram per value of a single label.  Only use labels with a
+    small, fixed set of values.
+    """
+
+    name: str
+    help: str
+    label: str
+    buckets: tuple[float, ...]
+    children: dict[str, Histogram] = field(default_factory=dict)
+
+    def __getitem__(self, value: str) -> Histogram:
+        try:
+            return self.children[value]
+        except KeyError:
+            h = self.children[value] = Histogram(
+                self.name,
+                self.help,
+                self.buckets,
+                f'{self.label}="{value}"',
+            )
+            return h
+
+    def samples(self) -> Iterator[Sample]:
+        for _, h in sorted(self.children.items()):
+            yield from h.samples()
+
+
+Metric = Union[
+    Counter, LabeledCounter, Gauge, Histogram, LabeledHistogram
+]
+
+commands = LabeledHistogram(
+    "idc_command_seconds",
+    "Time spent handling each command; _count is how many were"
+    " handled.",
+    "command",
+    LATENCY_BUCKETS,
+)
+received_bytes = Counter(
+    "idc_received_bytes_total", "Bytes read from clients, after TLS."
+)
+sent_bytes = Counter(
+    "idc_sent_bytes_total", "Bytes written to clients, before TLS."
+)
+chanmsg_fanout = Histogram(
+    "idc_chanmsg_fanout",
+    "Members each CHANMSG was sent to.",
+    FANOUT_BUCKETS,
+)
+connections = Gauge("idc_connections", "Open client connections.")
+outbound_queued = Gauge(
+    "idc_outbound_queued_lines",
+    "Lines waiting in logged in clients' outbound queues.",
+)
+outbound_queued_max = Gauge(
+    "idc_outbound_queued_lines_max",
+    "Lines waiting in the fullest outbound queue.",
+)
+offline_queued = Gauge(
+    "idc_offline_queued_lines",
+    "Lines waiting in this process's offline message store.",
+)
+cached_users = Gauge(
+    "idc_cached_users", "Users held in memory by this process."
+)
+cached_channels = Gauge(
+    "idc_cached_channels", "Channels held in memory by this process."
+)
+account_loads = Counter(
+    "idc_account_loads_total",
+    "Users and channels read in from the account store.",
+)
+search_indexed = Counter(
+    "idc_search_indexed_total", "Messages added to the search index."
+)
+deflated_bytes = Counter(
+    "idc_deflated_bytes_total",
+    "Bytes of lines written to compressed connections, before"
+    " compression.",
+)
+inflated_bytes = Counter(
+    "idc_inflated_bytes_total",
+    "Bytes read from compressed connections, after decompression.",
+)
+reaped = LabeledCounter(
+    "idc_reaped_connections_total",
+    "Connections the server closed for taking too long, by reason:"
+    " handshake or idle.",
+    "reason",
+)
+rejected = LabeledCounter(
+    "idc_rejected_connections_total",
+    "Connections turned away before their TLS handshake, by reason:"
+    " connections, handshakes, per_ip, per_ip_rate or rate.",
+    "reason",
+)
+ratelimit_delays = Counter(
+    "idc_ratelimit_delays_total",
+    "Commands after which a connection was held up for going over its"
+    " rate limit.",
+)
+ratelimit_delay_seconds = Counter(
+    "idc_ratelimit_delay_seconds_total",
+    "Seconds connections were held up for going over their rate limit.",
+)
+loop_lag = Histogram(
+    "idc_loop_lag_seconds",
+    "How much later than asked a task sleeping on the event loop"
+    " woke up.",
+    LATENCY_BUCKETS,
+)
+slow_steps = Counter(
+    "idc_slow_steps_total",
+    "Task steps that held up the event loop for longer than"
+    " loopwatch.slow_step.",
+)
+timers = Gauge("idc_timers", "Timers waiting in the timer wheel.")
+member_lists = LabeledCounter(
+    "idc_member_lists_total",
+    "Channel member lists sent with a JOIN, by whether the encoded list"
+    " was cached: hit or miss.",
+    "result",
+)
+
+registry: list[Metric] = [
+    commands,
+    received_bytes,
+    sent_bytes,
+    chanmsg_fanout,
+    connections,
+    outbound_queued,
+    outbound_queued_max,
+    offline_queued,
+    cached_users,
+    cached_channels,
+    account_loads,
+    search_indexed,
+    deflated_bytes,
+    inflated_bytes,
+    reaped,
+    rejected,
+    ratelimit_delays,
+    ratelimit_delay_seconds,
+    loop_lag,
+    slow_steps,
+    timers,
+    member_lists,
+]
+
+
+def _kind(m: Metric) -> str:
+    if isinstance(m, (Counter, LabeledCounter)):
+        return "counter"
+    elif isinstance(m, Gauge):
+        return "gauge"
+    return "histogram"
+
+
+def samples() -> Iterator[Sample]:
+    for m in registry:
+        yield from m.samples()
+
+
+def exposition() -> str:
+    """
+    Every metric in the Prometheus text format.
+    """
+    lines = []
+    for m in registry:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {_kind(m)}")
+        for name, value in m.samples():
+            lines.append(f"{name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def _http_handler(stream: trio.SocketStream) -> None:
+    request = b""
+    try:
+        with trio.move_on_after(5):
+            while b"\r\n\r\n" not in request and len(request) < 8192:
+                data = await stream.receive_some(4096)
+                if not data:
+                    break
+                request += data
+            target = request.split(b" ", 2)[1:2]
+            if target and target[0].split(b"?")[0] == b"/metrics":
+                body = exposition().encode("utf-8")
+                status = b"200 OK"
+                content_type = (
+                    b"text/plain; version=0.0.4; charset=utf-8"
+                )
+            else:
+                body = b"Try /metrics\n"
+                status = b"404 Not Found"
+                content_type = b"text/plain"
+            await stream.send_all(
+                b"HTTP/1.0 %s\r\nContent-Type: %s\r\n"
+                b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+                % (status, content_type, len(body))
+                + body
+            )
+    except (trio.BrokenResourceError, OSError) as e:
+        # A scraper that hung up on us; anything escaping from here
+        # would take the whole server down with it.
+        minilog.debug("Metrics request failed: %s", str(e))
+    finally:
+        await stream.aclose()
+
+
+async def serve_http(host: str, port: int) -> None:
+    """
+    Answer GET /metrics on host:port, in plain HTTP.  Only ever bind
+    this to localhost; there's no authentication.
+    """
+    try:
+        listeners = await trio.open_tcp_listeners(port, host=host)
+    except OSError as e:
+        # Not worth taking the chat server down over.
+        minilog.error(
+            "Can't serve metrics on %s:%d: %s", host, port, str(e)
+        )
+        return
+    minilog.note("Metrics on http://%s:%d/metrics", host, port)
+    await trio.serve_listeners(_http_handler, listeners)
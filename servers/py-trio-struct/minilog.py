@@ -1,6 +1,14 @@
 #!/usr/bin/env python3
 #
-# Just some simple print-to-stderr logging.
+# Just some simple logging.  Levels can be switched off at runtime, and
+# messages are only %-formatted for levels that are on, so
+#
+#     minilog.debug("%s >>> %r", cid, line)
+#
+# costs next to nothing when debug is off.  Lines go to stdout or to a
+# size-rotated file, either as they're logged or in batches written
+# from a thread, and the most recent ones are also kept in memory so
+# they can be dumped when something crashes.
 #
 # Written by: Andrew <https://www.andrewyu.org>
 #
@@ -28,7 +36,17 @@
 # ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Optional, Protocol, TextIO
+
+import os
 import sys
+import threading
+import time
+
+import trio
 
 
 class textStyle:
@@ -67,48 +85,276 @@ class textStyle:
     bgBrightWhite = "\033[47;1m"
 
 
-def parser(s: str) -> None:
-    print(
-        textStyle.reset + "[P] " + s + textStyle.reset, file=sys.stdout
-    )
+PARSER = 0
+DEBUG = 1
+INFO = 2
+NOTE = 3
+CAUTION = 4
+WARNING = 5
+ERROR = 6
 
+LEVELS = {
+    "parser": PARSER,
+    "debug": DEBUG,
+    "info": INFO,
+    "note": NOTE,
+    "caution": CAUTION,
+    "warning": WARNING,
+    "error": ERROR,
+}
 
-def debug(s: str) -> None:
-    print(
-        textStyle.fgBrightWhite + "[D] " + s + textStyle.reset,
-        file=sys.stdout,
-    )
+_styles = [
+    (textStyle.reset, "[P] "),
+    (textStyle.fgBrightWhite, "[D] "),
+    (textStyle.fgGreen, "[I] "),
+    (textStyle.fgBrightBlue, "[N] "),
+    (textStyle.fgBrightYellow, "[C] "),
+    (textStyle.fgYellow, "[W] "),
+    (textStyle.fgRed, "[E] "),
+]
 
+# When, level, message and its %-arguments.  Arguments are formatted
+# only when the record is written out, which may be later and on
+# another thread, so they should be things that don't change: bytes,
+# str, numbers and the like.  Never pass an exception itself; it holds
+# its traceback and every frame in it for as long as the record lives.
+Record = tuple[float, int, str, tuple[object, ...]]
 
-def info(s: str) -> None:
-    print(
-        textStyle.fgGreen + "[I] " + s + textStyle.reset,
-        file=sys.stdout,
-    )
 
+class Sink(Protocol):
+    def write(self, records: list[Record]) -> None: ...
 
-def note(s: str) -> None:
-    print(
-        textStyle.fgBrightBlue + "[N] " + s + textStyle.reset,
-        file=sys.stdout,
-    )
 
+def _format(msg: str, args: tuple[object, ...]) -> str:
+    if not args:
+        return msg
+    try:
+        return msg % args
+    except (TypeError, ValueError) as e:
+        return f"{msg!r} % {args!r} ({e})"
 
-def caution(s: str) -> None:
-    print(
-        textStyle.fgBrightYellow + "[C] " + s + textStyle.reset,
-        file=sys.stdout,
-    )
 
+def _colored(record: Record) -> str:
+    _, lvl, msg, args = record
+    style, tag = _styles[lvl]
+    return style + tag + _format(msg, args) + textStyle.reset + "\n"
 
-def warning(s: str) -> None:
-    print(
-        textStyle.fgYellow + "[W] " + s + textStyle.reset,
-        file=sys.stdout,
+
+def _plain(record: Record) -> str:
+    when, lvl, msg, args = record
+    return (
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+        + f".{int(when * 1000) % 1000:03d} "
+        + _styles[lvl][1]
+        + _format(msg, args)
+        + "\n"
     )
 
 
-def error(s: str) -> None:
-    print(
-        textStyle.fgRed + "[E] " + s + textStyle.reset, file=sys.stdout
+@dataclass
+class StreamSink:
+    # None is whatever sys.stdout is at the time.
+    file: Optional[TextIO] = None
+    color: bool = True
+
+    def write(self, records: list[Record]) -> None:
+        f = self.file or sys.stdout
+        f.write(
+            "".join(map(_colored if self.color else _plain, records))
+        )
+
+
+@dataclass
+class RotatingFileSink:
+    """
+    Appends to path.  Once it would grow past max_bytes it's renamed to
+    path.1, path.1 to path.2 and so on, keeping backups old files.
+    """
+
+    path: str
+    max_bytes: int = 16 << 20
+    backups: int = 5
+    file: Optional[TextIO] = None
+    size: int = 0
+
+    def _open(self) -> TextIO:
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.size = self.file.tell()
+        return self.file
+
+    def _rotate(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+
+    def write(self, records: list[Record]) -> None:
+        text = "".join(map(_plain, records))
+        f = self.file or self._open()
+        if self.size and self.size + len(text) > self.max_bytes:
+            self._rotate()
+            f = self._open()
+        f.write(text)
+        f.flush()
+        self.size += len(text)
+
+
+@dataclass
+class BufferedSink:
+    """
+    Collects records and hands them to target in batches, from a worker
+    thread while flush_loop() is running, so that neither formatting
+    nor writing happens where the record was logged.  If max_pending
+    records pile up anyway they're written right away.
+    """
+
+    target: Sink
+    max_pending: int = 10000
+    pending: list[Record] = field(default_factory=list)
+    # Batches must reach target in order and never two at once.
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def write(self, records: list[Record]) -> None:
+        self.pending += records
+        if len(self.pending) >= self.max_pending:
+            self.flush()
+
+    def _write_batch(self, batch: list[Record]) -> None:
+        with self.lock:
+            self.target.write(batch)
+
+    def flush(self) -> None:
+        batch, self.pending = self.pending, []
+        if batch:
+            self._write_batch(batch)
+
+    async def flush_loop(self, interval: float) -> None:
+        try:
+            while True:
+                await trio.sleep(interval)
+                batch, self.pending = self.pending, []
+                if batch:
+                    await trio.to_thread.run_sync(
+                        self._write_batch, batch
+                    )
+        finally:
+            self.flush()
+
+
+level = PARSER
+ring_level = DEBUG
+sink: Sink = StreamSink()
+# Recent records at ring_level and above.
+ring: deque[Record] = deque(maxlen=1000)
+# Anything below this is thrown away straight away.
+_threshold = PARSER
+
+
+def configure(
+    level_name: str = "debug",
+    path: Optional[str] = None,
+    max_bytes: int = 16 << 20,
+    backups: int = 5,
+    buffered: bool = False,
+    ring_size: int = 1000,
+    ring_level_name: str = "debug",
+) -> None:
+    global level, ring_level, sink, ring, _threshold
+    flush()
+    level = LEVELS[level_name]
+    ring_level = LEVELS[ring_level_name] if ring_size else ERROR + 1
+    ring = deque(ring, maxlen=ring_size)
+    _threshold = min(level, ring_level)
+    target: Sink = (
+        RotatingFileSink(path, max_bytes, backups)
+        if path
+        else StreamSink()
     )
+    sink = BufferedSink(target) if buffered else target
+
+
+def enabled(lvl: int) -> bool:
+    """
+    Whether something logged at lvl would go anywhere, for callers that
+    need to do work to build their arguments.
+    """
+    return lvl >= _threshold
+
+
+def flush() -> None:
+    if isinstance(sink, BufferedSink):
+        sink.flush()
+
+
+async def flush_loop(interval: float) -> None:
+    """
+    Write buffered records every interval seconds until cancelled.
+    Returns straight away if logging isn't buffered.
+    """
+    if isinstance(sink, BufferedSink):
+        await sink.flush_loop(interval)
+
+
+def dump_ring(file: TextIO = sys.stderr) -> None:
+    """
+    Write out the records in the ring buffer, oldest first.
+    """
+    flush()
+    file.write(f"---- last {len(ring)} log records ----\n")
+    file.write("".join(map(_plain, ring)))
+    file.write("---- end of log records ----\n")
+    file.flush()
+
+
+def _log(lvl: int, msg: str, args: tuple[object, ...]) -> None:
+    record = (time.time(), lvl, msg, args)
+    if lvl >= ring_level:
+        ring.append(record)
+    if lvl >= level:
+        sink.write([record])
+
+
+def log(lvl: int, msg: str, *args: object) -> None:
+    if lvl >= _threshold:
+        _log(lvl, msg, args)
+
+
+def parser(s: str, *args: object) -> None:
+    if PARSER >= _threshold:
+        _log(PARSER, s, args)
+
+
+def debug(s: str, *args: object) -> None:
+    if DEBUG >= _threshold:
+        _log(DEBUG, s, args)
+
+
+def info(s: str, *args: object) -> None:
+    if INFO >= _threshold:
+        _log(INFO, s, args)
+
+
+def note(s: str, *args: object) -> None:
+    if NOTE >= _threshold:
+        _log(NOTE, s, args)
+
+
+def caution(s: str, *args: object) -> None:
+    if CAUTION >= _threshold:
+        _log(CAUTION, s, args)
+
+
+def warning(s: str, *args: object) -> None:
+    if WARNING >= _threshold:
+        _log(WARNING, s, args)
+
+
+def error(s: str, *args: object) -> None:
+    if ERROR >= _threshold:
+        _log(ERROR, s, args)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+#
+# Offline message storage for the Internet Delay Chat server written in
+# Python Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+from __future__ import annotations
+from typing import Protocol
+from collections import deque
+from dataclasses import dataclass, field
+
+import itertools
+import os
+import struct
+
+import trio
+
+import minilog
+import config
+
+
+class OfflineStore(Protocol):
+    def append(self, username: bytes, line: bytes) -> None: ...
+
+    def pending(self, username: bytes) -> int: ...
+
+    def total(self) -> int:
+        """
+        Lines queued for all users together.
+        """
+        ...
+
+    def peek(
+        self, username: bytes, limit: int
+    ) -> tuple[int, list[bytes]]:
+        """
+        Up to limit of the user's queued lines, oldest first, and the
+        position of the first one; the others follow it in order.  The
+        lines stay queued until they're consume()d.
+        """
+        ...
+
+    def consume(self, username: bytes, upto: int) -> None:
+        """
+        Forget the user's lines before position upto.  Positions are
+        never reused, so consuming the same lines twice is harmless.
+        """
+        ...
+
+    async def sync(self) -> None:
+        """
+        Make what has been queued and consumed so far durable.
+        """
+        ...
+
+    def close(self) -> None: ...
+
+
+@dataclass
+class MemoryOfflineStore:
+    queues: dict[bytes, deque[bytes]] = field(default_factory=dict)
+    # Position of each user's oldest queued line.  A user's queue
+    # starts at the number of lines ever appended, which is past every
+    # position its last queue used.
+    heads: dict[bytes, int] = field(default_factory=dict)
+    appended: int = 0
+
+    def append(self, username: bytes, line: bytes) -> None:
+        try:
+            self.queues[username].append(line)
+        except KeyError:
+            self.queues[username] = deque((line,))
+            self.heads[username] = self.appended
+        self.appended += 1
+
+    def pending(self, username: bytes) -> int:
+        q = self.queues.get(username)
+        return len(q) if q else 0
+
+    def total(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def peek(
+        self, username: bytes, limit: int
+    ) -> tuple[int, list[bytes]]:
+        q = self.queues.get(username)
+        if not q:
+            return 0, []
+        return self.heads[username], list(itertools.islice(q, limit))
+
+    def consume(self, username: bytes, upto: int) -> None:
+        q = self.queues.get(username)
+        if not q:
+            return
+        head = self.heads[username]
+        for _ in range(min(upto - head, len(q))):
+            q.popleft()
+            head += 1
+        self.heads[username] = head
+        if not q:
+            del self.queues[username]
+            del self.heads[username]
+
+    async def sync(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# Record header: type, length of username, length of payload.
+#   b"A"  payload is a line appended to the user's queue
+#   b"C"  payload is a big-endian u64: that many of the user's oldest
+#         lines have been consumed
+_header = struct.Struct(">cII")
+_count = struct.Struct(">Q")
+_APPEND = b"A"
+_CONSUMED = b"C"
+
+
+@dataclass
+class SegmentOfflineStore:
+    """
+    Offline queues kept in one append-only segment file.  Only the
+    position of each pending line is held in memory; lines are read
+    back with pread() by peek().  Writes are buffered and written
+    out every sync_every records; sync() fsync()s them in a thread.
+    Once more than half of the file is consumed lines, sync() rewrites
+    it with only the pending ones, also in a thread.
+    """
+
+    path: str
+    sync_every: int = 64
+    compact_min_bytes: int = 1 << 20
+    # Per user: (offset, length) of each pending line's payload.
+    offsets: dict[bytes, deque[tuple[int, int]]] = field(
+        default_factory=dict
+    )
+    # Positions as in MemoryOfflineStore; they're only kept in memory.
+    heads: dict[bytes, int] = field(default_factory=dict)
+    appended: int = 0
+    fd: int = -1
+    size: int = 0
+    wbuf: bytearray = field(default_factory=bytearray)
+    live_bytes: int = 0
+    dead_bytes: int = 0
+    unsynced: int = 0
+    buffered: int = 0
+    compacting: bool = False
+
+    def __post_init__(self) -> None:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._replay()
+
+    def _replay(self) -> None:
+        end = os.fstat(self.fd).st_size
+        pos = 0
+        with open(self.fd, "rb", closefd=False) as f:
+            while pos + _header.size <= end:
+                kind, ulen, dlen = _header.unpack(f.read(_header.size))
+                rlen = _header.size + ulen + dlen
+                if pos + rlen > end or kind not in (_APPEND, _CONSUMED):
+                    break
+                username = f.read(ulen)
+                if kind == _APPEND:
+                    f.seek(dlen, os.SEEK_CUR)
+                    self._queue(
+                        username, pos + _header.size + ulen, dlen
+                    )
+                    self.live_bytes += rlen
+                else:
+                    (n,) = _count.unpack(f.read(dlen))
+                    self._forget(username, n)
+                    self.dead_bytes += rlen
+                pos += rlen
+        if pos != end:
+            minilog.warning(
+                "%s: dropping %d bytes of torn records",
+                self.path,
+                end - pos,
+            )
+            os.ftruncate(self.fd, pos)
+        self.size = pos
+        os.lseek(self.fd, pos, os.SEEK_SET)
+
+    def _queue(
+        self, username: bytes, offset: int, length: int
+    ) -> None:
+        try:
+            self.offsets[username].append((offset, length))
+        except KeyError:
+            self.offsets[username] = deque(((offset, length),))
+            self.heads[username] = self.appended
+        self.appended += 1
+
+    def _forget(self, username: bytes, n: int) -> None:
+        q = self.offsets[username]
+        for _ in range(n):
+            _, dlen = q.popleft()
+            rlen = _header.size + len(username) + dlen
+            self.live_bytes -= rlen
+            self.dead_bytes += rlen
+        self.heads[username] += n
+        if not q:
+            del self.offsets[username]
+            del self.heads[username]
+
+    def _write(
+        self, kind: bytes, username: bytes, payload: bytes
+    ) -> int:
+        """
+        Buffer one record and return the file offset of its payload.
+        """
+        offset = (
+            self.size + len(self.wbuf) + _header.size + len(username)
+        )
+        self.wbuf += _header.pack(kind, len(username), len(payload))
+        self.wbuf += username
+        self.wbuf += payload
+        self.buffered += 1
+        self.unsynced += 1
+        return offset
+
+    def _flush(self) -> None:
+        if self.wbuf:
+            os.write(self.fd, self.wbuf)
+            self.size += len(self.wbuf)
+            del self.wbuf[:]
+            self.buffered = 0
+
+    def append(self, username: bytes, line: bytes) -> None:
+        offset = self._write(_APPEND, username, line)
+        self._queue(username, offset, len(line))
+        self.live_bytes += _header.size + len(username) + len(line)
+        if self.buffered >= self.sync_every:
+            self._flush()
+
+    def pending(self, username: bytes) -> int:
+        q = self.offsets.get(username)
+        return len(q) if q else 0
+
+    def total(self) -> int:
+        return sum(len(q) for q in self.offsets.values())
+
+    def peek(
+        self, username: bytes, limit: int
+    ) -> tuple[int, list[bytes]]:
+        q = self.offsets.get(username)
+        if not q:
+            return 0, []
+        self._flush()
+        return self.heads[username], [
+            os.pread(self.fd, length, offset)
+            for offset, length in itertools.islice(q, limit)
+        ]
+
+    def consume(self, username: bytes, upto: int) -> None:
+        q = self.offsets.get(username)
+        if not q:
+            return
+        n = min(upto - self.heads[username], len(q))
+        if n <= 0:
+            return
+        self._forget(username, n)
+        # Durable at the next sync(); a crash before then delivers
+        # these lines again.
+        self._write(_CONSUMED, username, _count.pack(n))
+        self.dead_bytes += _header.size + len(username) + _count.size
+
+    async def sync(self) -> None:
+        self._flush()
+        if self.unsynced:
+            self.unsynced = 0
+            await trio.to_thread.run_sync(_fsync, os.dup(self.fd))
+        if (
+            not self.compacting
+            and self.dead_bytes > self.compact_min_bytes
+            and self.dead_bytes > self.live_bytes
+        ):
+            self.compacting = True
+            try:
+                await self.compact()
+            finally:
+                self.compacting = False
+
+    async def compact(self) -> None:
+        """
+        Rewrite the file with only the pending lines, then swap it in.
+        The rewrite runs in a thread from a snapshot of the queues;
+        whatever is appended or consumed meanwhile is in the records
+        after the snapshot, which are copied over as they are before
+        the swap.
+        """
+        self._flush()
+        tmp_path = self.path + ".compact"
+        snapshot = [(u, list(q)) for u, q in self.offsets.items()]
+        end = copied = self.size
+        moved, pos = await trio.to_thread.run_sync(
+            _rewrite, os.dup(self.fd), tmp_path, snapshot
+        )
+        # Copy the records written during the rewrite, in a thread
+        # while there are many of them, then the last few right here so
+        # that nothing is written in between.
+        tmp_fd = os.open(tmp_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            while True:
+                self._flush()
+                if self.size - copied < self.compact_min_bytes:
+                    break
+                upto = self.size
+                await trio.to_thread.run_sync(
+                    _copy, os.dup(self.fd), tmp_fd, copied, upto
+                )
+                copied = upto
+            _copy(os.dup(self.fd), tmp_fd, copied, self.size)
+        finally:
+            os.close(tmp_fd)
+        os.replace(tmp_path, self.path)
+        shift = pos - end
+        live = 0
+        for username, q in self.offsets.items():
+            entries = [
+                (moved[o] if o < end else o + shift, n) for o, n in q
+            ]
+            q.clear()
+            q.extend(entries)
+            live += len(q) * (_header.size + len(username))
+            live += sum(n for _, n in entries)
+        os.close(self.fd)
+        self.fd = os.open(self.path, os.O_RDWR, 0o600)
+        minilog.info(
+            "%s: compacted %d bytes down to %d",
+            self.path,
+            self.size,
+            self.size + shift,
+        )
+        self.size += shift
+        os.lseek(self.fd, self.size, os.SEEK_SET)
+        self.live_bytes = live
+        self.dead_bytes = self.size - live
+        # The copied tail hasn't been fsync()ed.
+        self.unsynced += 1
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            self._flush()
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _fsync(fd: int) -> None:
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _rewrite(
+    fd: int,
+    tmp_path: str,
+    snapshot: list[tuple[bytes, list[tuple[int, int]]]],
+) -> tuple[dict[int, int], int]:
+    """
+    Write the snapshotted lines read from fd to a new file at tmp_path
+    and fsync() it.  Return where each payload moved to and the new
+    file's size.
+    """
+    moved: dict[int, int] = {}
+    pos = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for username, entries in snapshot:
+                for offset, length in entries:
+                    line = os.pread(fd, length, offset)
+                    f.write(
+                        _header.pack(_APPEND, len(username), length)
+                    )
+                    f.write(username)
+                    f.write(line)
+                    moved[offset] = pos + _header.size + len(username)
+                    pos += _header.size + len(username) + length
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        os.close(fd)
+    return moved, pos
+
+
+def _copy(fd: int, out_fd: int, start: int, end: int) -> None:
+    """
+    Append bytes start to end of fd to out_fd, then close fd.
+    """
+    try:
+        while start < end:
+            chunk = os.pread(fd, min(end - start, 1 << 20), start)
+            os.write(out_fd, chunk)
+            start += len(chunk)
+    finally:
+        os.close(fd)
+
+
+def open_store(suffix: str = "") -> OfflineStore:
+    if config.offline.store == "segment":
+        return SegmentOfflineStore(
+            path=config.offline.path + suffix,
+            sync_every=config.offline.sync_every,
+            compact_min_bytes=config.offline.compact_min_bytes,
+        )
+    elif config.offline.store == "memory":
+        return MemoryOfflineStore()
+    else:
+        raise ValueError(
+            f"Unknown offline store {config.offline.store!r}"
+        )
+
+
+store: OfflineStore = MemoryOfflineStore()
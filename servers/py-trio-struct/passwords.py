@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+#
+# Password hashing for the Internet Delay Chat server written in Python
+# Trio.  Run this to hash a password for config.py:
+#
+#     python3 passwords.py
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# Stored passwords look like one of
+#
+#     $scrypt$n=16384,r=8,p=1$<base64 salt>$<base64 hash>
+#     $pbkdf2-sha256$i=600000$<base64 salt>$<base64 hash>
+#
+# Anything not starting with "$" is a plaintext password from before
+# hashing; it still works, and gets upgraded on the next good login.
+
+from __future__ import annotations
+from typing import Optional
+
+import base64
+import getpass
+import hashlib
+import hmac
+import os
+
+import trio
+
+import config
+
+_limiter: Optional[trio.CapacityLimiter] = None
+_dummy: Optional[bytes] = None
+
+
+def limiter() -> trio.CapacityLimiter:
+    """
+    Caps how many KDF computations run at once, so a login storm can't
+    take every core away from the event loop's own thread.
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = trio.CapacityLimiter(
+            config.passwords.threads or os.cpu_count() or 1
+        )
+    return _limiter
+
+
+def _b64(b: bytes) -> bytes:
+    return base64.b64encode(b).rstrip(b"=")
+
+
+def _unb64(b: bytes) -> bytes:
+    return base64.b64decode(b + b"=" * (-len(b) % 4))
+
+
+def _params() -> bytes:
+    if config.passwords.scheme == "scrypt":
+        return b"n=%d,r=%d,p=%d" % (
+            config.passwords.scrypt_n,
+            config.passwords.scrypt_r,
+            config.passwords.scrypt_p,
+        )
+    elif config.passwords.scheme == "pbkdf2-sha256":
+        return b"i=%d" % config.passwords.pbkdf2_iterations
+    else:
+        raise ValueError(
+            f"Unknown password scheme {config.passwords.scheme!r}"
+        )
+
+
+def _derive(
+    scheme: bytes, params: bytes, password: bytes, salt: bytes
+) -> bytes:
+    p = dict(kv.split(b"=", 1) for kv in params.split(b","))
+    if scheme == b"scrypt":
+        n, r, par = int(p[b"n"]), int(p[b"r"]), int(p[b"p"])
+        return hashlib.scrypt(
+            password,
+            salt=salt,
+            n=n,
+            r=r,
+            p=par,
+            maxmem=2 * 128 * r * n * par + (1 << 20),
+            dklen=32,
+        )
+    elif scheme == b"pbkdf2-sha256":
+        return hashlib.pbkdf2_hmac(
+            "sha256", password, salt, int(p[b"i"])
+        )
+    else:
+        raise ValueError(f"Unknown password scheme {scheme!r}")
+
+
+def hash_sync(password: bytes) -> bytes:
+    salt = os.urandom(16)
+    scheme = config.passwords.scheme.encode("ascii")
+    params = _params()
+    return b"$".join(
+        [
+            b"",
+            scheme,
+            params,
+            _b64(salt),
+            _b64(_derive(scheme, params, password, salt)),
+        ]
+    )
+
+
+def check_sync(stored: bytes, password: bytes) -> bool:
+    if not stored.startswith(b"$"):
+        return hmac.compare_digest(stored, password)
+    # A stored hash that doesn't parse (or names a scheme this version
+    # doesn't know) matches no password, rather than taking the login
+    # down with it.
+    try:
+        _, scheme, params, salt, digest = stored.split(b"$")
+        return hmac.compare_digest(
+            _unb64(digest),
+            _derive(scheme, params, password, _unb64(salt)),
+        )
+    except (ValueError, KeyError):
+        return False
+
+
+def needs_rehash(stored: bytes) -> bool:
+    """
+    Whether a stored password is plaintext or was hashed with something
+    other than the currently configured scheme and parameters.
+    """
+    if not stored.startswith(b"$"):
+        return True
+    try:
+        _, scheme, params, _, _ = stored.split(b"$")
+    except ValueError:
+        return True
+    return scheme != config.passwords.scheme.encode("ascii") or (
+        params != _params()
+    )
+
+
+async def hash_password(password: bytes) -> bytes:
+    hashed: bytes = await trio.to_thread.run_sync(
+        hash_sync, password, limiter=limiter()
+    )
+    return hashed
+
+
+async def check_password(
+    stored: Optional[bytes], password: bytes
+) -> bool:
+    """
+    Check a password in a worker thread.  Pass stored=None for a user
+    that doesn't exist; a dummy hash is checked instead so that the
+    answer takes just as long.
+    """
+    global _dummy
+    if stored is None:
+        if _dummy is None:
+            _dummy = await hash_password(b"")
+        await trio.to_thread.run_sync(
+            check_sync, _dummy, password, limiter=limiter()
+        )
+        return False
+    ok: bool = await trio.to_thread.run_sync(
+        check_sync, stored, password, limiter=limiter()
+    )
+    return ok
+
+
+if __name__ == "__main__":
+    print(hash_sync(getpass.getpass().encode("utf-8")).decode("ascii"))
@@ -0,0 +1,675 @@
+#!/usr/bin/env python3
+#
+# Full-text message search for the Internet Delay Chat server written in
+# Python Trio.  Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# An inverted index over delivered CHANMSGs and PRIVMSGs.  New messages
+# go into a Memtable; once it's big enough, or old enough, it's written
+# out as an immutable segment file, and runs of small segments are
+# merged into bigger ones in the background.  Each worker writes its
+# own segments, named
+#
+#     <path>/<worker>-<first>-<last>.seg
+#
+# after the range of flushes they hold, and searches read everyone's.
+#
+# Documents (messages) are numbered in the order they were added, which
+# is also message ID order (see cluster.next_id), so a time range, or
+# the messages before a given ID, is a range of document numbers.
+# Message IDs are unique across workers, so they, not timestamps, are
+# what hits are merged and paged by.  Besides the words of the message,
+# each document is indexed under _CHANNEL + channel or _SOURCE +
+# sender, so those filters are just more terms to intersect.
+#
+# A segment is, with every number in native byte order:
+#
+#     header        _seg_header
+#     message IDs   u64 per document
+#     meta offsets  u64 per document, and one for the end
+#     meta          _meta and then target, source and line per document
+#     term offsets  u64 per term, to its entry
+#     term entries  u16 length, term, u32 count, u64 postings offset
+#     postings      u32 document numbers, ascending, per term
+
+from __future__ import annotations
+from typing import AbstractSet, Iterator, Optional, Sequence, Union
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from heapq import merge
+
+import mmap
+import os
+import re
+import struct
+import time
+
+import trio
+
+import minilog
+import metrics
+import config
+import cluster
+
+CHANMSG = 0
+PRIVMSG = 1
+
+_CHANNEL = b"\x01"
+_SOURCE = b"\x02"
+
+_word_re = re.compile(r"\w+")
+MAX_TERM = 64
+
+_MAGIC = b"IDCSRCH2"
+_seg_header = struct.Struct("=8sIIQQQQQ")
+_meta = struct.Struct("=BHHI")
+_term_head = struct.Struct("=H")
+_term_tail = struct.Struct("=IQ")
+
+# Message ID and line.
+Hit = tuple[int, bytes]
+Postings = Union["array[int]", memoryview]
+
+
+def terms_of(text: bytes) -> set[bytes]:
+    """
+    The distinct lowercased words in text.
+    """
+    return {
+        w.encode("utf-8")
+        for w in _word_re.findall(
+            text.decode("utf-8", "replace").lower()
+        )
+        if len(w) <= MAX_TERM
+    }
+
+
+@dataclass
+class Query:
+    terms: list[bytes]
+    # The user searching, and the channels they're in; they only see
+    # those channels' messages and PRIVMSGs to or from them.
+    user: bytes
+    channels: AbstractSet[bytes]
+    channel: Optional[bytes] = None
+    source: Optional[bytes] = None
+    after: Optional[float] = None
+    before: Optional[float] = None
+    # Only messages with a lower ID: the last one of the previous page.
+    before_id: Optional[int] = None
+    limit: int = 20
+
+    def all_terms(self) -> list[bytes]:
+        t = list(self.terms)
+        if self.channel is not None:
+            t.append(_CHANNEL + self.channel)
+        if self.source is not None:
+            t.append(_SOURCE + self.source)
+        return t
+
+    def visible(self, kind: int, target: bytes, source: bytes) -> bool:
+        if kind == CHANMSG:
+            return target in self.channels
+        return self.user == target or self.user == source
+
+
+def _contains(postings: Sequence[int], doc: int) -> bool:
+    i = bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+class _Source(ABC):
+    """
+    What Memtable and Segment have in common, for hits().
+    """
+
+    ids: Sequence[int]
+    meta_offs: Sequence[int]
+    meta: Union[bytes, bytearray, memoryview]
+
+    @abstractmethod
+    def postings(self, term: bytes) -> Optional[Sequence[int]]:
+        """
+        The documents with term, in order, or None if there are none.
+        """
+
+    def doc(self, d: int) -> tuple[int, bytes, bytes, bytes]:
+        off = self.meta_offs[d]
+        kind, tlen, slen, llen = _meta.unpack_from(self.meta, off)
+        off += _meta.size
+        target = bytes(self.meta[off : off + tlen])
+        off += tlen
+        source = bytes(self.meta[off : off + slen])
+        off += slen
+        return kind, target, source, bytes(self.meta[off : off + llen])
+
+    def hits(self, q: Query) -> Iterator[Hit]:
+        """
+        Documents matching q, newest first.
+        """
+        lists = []
+        for term in q.all_terms():
+            p = self.postings(term)
+            if not p:
+                return
+            lists.append(p)
+        lists.sort(key=len)
+        shortest, rest = lists[0], lists[1:]
+        lo = 0
+        if q.after is not None:
+            lo = bisect_right(self.ids, q.after, key=cluster.id_ts)
+        hi = len(self.ids)
+        if q.before is not None:
+            hi = bisect_left(self.ids, q.before, key=cluster.id_ts)
+        if q.before_id is not None:
+            hi = min(hi, bisect_left(self.ids, q.before_id))
+        start = bisect_left(shortest, lo)
+        for i in range(bisect_left(shortest, hi) - 1, start - 1, -1):
+            d = shortest[i]
+            if not all(_contains(p, d) for p in rest):
+                continue
+            kind, target, source, line = self.doc(d)
+            if q.visible(kind, target, source):
+                yield self.ids[d], line
+
+
+@dataclass
+class Memtable(_Source):
+    ids: array[int] = field(default_factory=lambda: array("Q"))
+    meta_offs: array[int] = field(
+        default_factory=lambda: array("Q", [0])
+    )
+    meta: bytearray = field(default_factory=bytearray)
+    terms: dict[bytes, array[int]] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(
+        self,
+        kind: int,
+        target: bytes,
+        source: bytes,
+        message_id: int,
+        line: bytes,
+        text: bytes,
+    ) -> None:
+        d = len(self.ids)
+        self.ids.append(message_id)
+        self.meta += _meta.pack(
+            kind, len(target), len(source), len(line)
+        )
+        self.meta += target
+        self.meta += source
+        self.meta += line
+        self.meta_offs.append(len(self.meta))
+        terms = terms_of(text)
+        if kind == CHANMSG:
+            terms.add(_CHANNEL + target)
+        terms.add(_SOURCE + source)
+        for term in terms:
+            try:
+                self.terms[term].append(d)
+            except KeyError:
+                self.terms[term] = array("I", (d,))
+
+    def postings(self, term: bytes) -> Optional[Sequence[int]]:
+        return self.terms.get(term)
+
+
+@dataclass
+class Segment(_Source):
+    path: str
+    worker: int = 0
+    first: int = 0
+    last: int = 0
+    map: Optional[mmap.mmap] = None
+    view: memoryview = field(default_factory=lambda: memoryview(b""))
+    ids: Sequence[int] = ()
+    meta_offs: Sequence[int] = ()
+    meta: Union[bytes, bytearray, memoryview] = b""
+    term_offs: Sequence[int] = ()
+
+    def __post_init__(self) -> None:
+        name = os.path.basename(self.path)[: -len(".seg")]
+        self.worker, self.first, self.last = map(int, name.split("-"))
+        with open(self.path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        v = self.view = memoryview(self.map)
+        (
+            magic,
+            n_docs,
+            n_terms,
+            ids_off,
+            meta_offs_off,
+            meta_off,
+            term_offs_off,
+            _,
+        ) = _seg_header.unpack_from(v)
+        if magic != _MAGIC:
+            raise ValueError(f"{self.path} isn't a search segment")
+        self.ids = v[ids_off:meta_offs_off].cast("Q")
+        self.meta_offs = v[meta_offs_off:meta_off].cast("Q")
+        self.meta = v[meta_off : meta_off + self.meta_offs[-1]]
+        self.term_offs = v[
+            term_offs_off : term_offs_off + 8 * n_terms
+        ].cast("Q")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _term(self, i: int) -> bytes:
+        off = self.term_offs[i]
+        (n,) = _term_head.unpack_from(self.view, off)
+        return bytes(self.view[off + 2 : off + 2 + n])
+
+    def _entry(self, i: int) -> tuple[bytes, memoryview]:
+        off = self.term_offs[i]
+        (n,) = _term_head.unpack_from(self.view, off)
+        term = bytes(self.view[off + 2 : off + 2 + n])
+        count, p = _term_tail.unpack_from(self.view, off + 2 + n)
+        return term, self.view[p : p + 4 * count].cast("I")
+
+    def postings(self, term: bytes) -> Optional[Sequence[int]]:
+        lo, hi = 0, len(self.term_offs)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_offs):
+            found, postings = self._entry(lo)
+            if found == term:
+                return postings
+        return None
+
+    def entries(self) -> Iterator[tuple[bytes, memoryview]]:
+        for i in range(len(self.term_offs)):
+            yield self._entry(i)
+
+    def close(self) -> None:
+        # Views into the map have to go before it can be closed.
+        self.ids = self.meta_offs = self.term_offs = ()
+        self.meta = b""
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def write_segment(
+    path: str,
+    ids: Sequence[int],
+    meta_offs: Sequence[int],
+    meta: Union[bytes, bytearray],
+    entries: Iterator[tuple[bytes, Postings]],
+) -> None:
+    """
+    Write a segment to path, with entries in ascending term order.
+    """
+    n_docs = len(ids)
+    ids_off = _seg_header.size
+    meta_offs_off = ids_off + 8 * n_docs
+    meta_off = meta_offs_off + 8 * (n_docs + 1)
+    term_offs_off = meta_off + len(meta)
+    # The entries can only be written once the postings' offsets are
+    # known, so they're gathered up first.
+    table = bytearray()
+    term_offs = array("Q")
+    tails = []
+    postings = []
+    postings_size = 0
+    for term, p in entries:
+        term_offs.append(len(table))
+        table += _term_head.pack(len(term))
+        table += term
+        tails.append(len(table))
+        table += _term_tail.pack(len(p), postings_size)
+        postings.append(p)
+        postings_size += 4 * len(p)
+    table_off = term_offs_off + 8 * len(term_offs)
+    postings_off = table_off + len(table)
+    for i, tail in enumerate(tails):
+        term_offs[i] += table_off
+        count, rel = _term_tail.unpack_from(table, tail)
+        _term_tail.pack_into(table, tail, count, rel + postings_off)
+
+    with open(path + ".tmp", "wb") as f:
+        f.write(
+            _seg_header.pack(
+                _MAGIC,
+                n_docs,
+                len(term_offs),
+                ids_off,
+                meta_offs_off,
+                meta_off,
+                term_offs_off,
+                postings_off,
+            )
+        )
+        f.write(array("Q", ids))
+        f.write(array("Q", meta_offs))
+        f.write(meta)
+        f.write(term_offs)
+        f.write(table)
+        for p in postings:
+            f.write(p)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _numbered(
+    i: int, segment: Segment
+) -> Iterator[tuple[bytes, int, memoryview]]:
+    for term, p in segment.entries():
+        yield term, i, p
+
+
+def merge_segments(path: str, segments: list[Segment]) -> None:
+    """
+    Write the documents of consecutive segments, in order, as one.
+    """
+    ids = array("Q")
+    meta_offs = array("Q", [0])
+    meta = bytearray()
+    bases = []
+    for s in segments:
+        bases.append(len(ids))
+        base = len(meta)
+        ids.extend(s.ids)
+        meta_offs.extend(o + base for o in s.meta_offs[1:])
+        meta += s.meta
+
+    def entries() -> Iterator[tuple[bytes, Postings]]:
+        streams = [_numbered(i, s) for i, s in enumerate(segments)]
+        current: Optional[bytes] = None
+        combined = array("I")
+        for term, i, p in merge(*streams):
+            if term != current:
+                if current is not None:
+                    yield current, combined
+                current, combined = term, array("I")
+            if bases[i]:
+                combined.extend(d + bases[i] for d in p)
+            else:
+                combined.frombytes(p.cast("B"))
+        if current is not None:
+            yield current, combined
+
+    write_segment(path, ids, meta_offs, meta, entries())
+
+
+@dataclass
+class Index:
+    """
+    This worker's memtable and segments, plus every other worker's
+    segments for searching.
+    """
+
+    path: str
+    flush_docs: int = 50000
+    flush_interval: float = 10.0
+    merge_factor: int = 8
+    memtable: Memtable = field(default_factory=Memtable)
+    # Memtables being written out; still searched until they're on
+    # disk.
+    flushing: list[Memtable] = field(default_factory=list)
+    # Every worker's segments, by file name.
+    segments: dict[str, Segment] = field(default_factory=dict)
+    # This worker's, oldest first.
+    own: list[Segment] = field(default_factory=list)
+    next_flush: int = 0
+    last_id: int = 0
+    wakeup: trio.Event = field(default_factory=trio.Event)
+
+    def __post_init__(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                # Left behind by a crash in the middle of writing.
+                os.unlink(os.path.join(self.path, name))
+        self._refresh()
+        self.own = sorted(
+            (
+                s
+                for s in self.segments.values()
+                if s.worker == cluster.worker_id
+            ),
+            key=lambda s: s.first,
+        )
+        if self.own:
+            self.next_flush = self.own[-1].last + 1
+            self.last_id = (
+                self.own[-1].ids[-1] if len(self.own[-1]) else 0
+            )
+
+    def _name(self, first: int, last: int) -> str:
+        return f"{cluster.worker_id:03d}-{first:010d}-{last:010d}.seg"
+
+    def _refresh(self) -> None:
+        """
+        Pick up segments other workers wrote or merged, and drop ones
+        that have been merged away.
+        """
+        names = {n for n in os.listdir(self.path) if n.endswith(".seg")}
+        for name in list(self.segments):
+            if name not in names:
+                self.segments.pop(name).close()
+        for name in names - self.segments.keys():
+            try:
+                self.segments[name] = Segment(
+                    os.path.join(self.path, name)
+                )
+            except (OSError, ValueError) as exc:
+                minilog.caution(
+                    "Skipping search segment %s: %s", name, str(exc)
+                )
+
+    def _live(self) -> list[Segment]:
+        """
+        Segments to search: a merged segment and the ones it was merged
+        from are briefly both there, so leave out any whose flushes
+        another one covers.
+        """
+        live = []
+        for s in self.segments.values():
+            if not any(
+                o is not s
+                and o.worker == s.worker
+                and o.first <= s.first
+                and s.last <= o.last
+                and (o.first, o.last) != (s.first, s.last)
+                for o in self.segments.values()
+            ):
+                live.append(s)
+        return live
+
+    def add(
+        self,
+        kind: int,
+        target: bytes,
+        source: bytes,
+        message_id: int,
+        line: bytes,
+        text: bytes,
+    ) -> None:
+        # Documents have to be in ID order.  This worker hands out
+        # IDs in order, but one from before a restart can be higher.
+        if message_id <= self.last_id:
+            message_id = cluster.next_id(self.last_id)
+        self.last_id = message_id
+        self.memtable.add(kind, target, source, message_id, line, text)
+        metrics.search_indexed.inc()
+        if len(self.memtable) >= self.flush_docs:
+            self.wakeup.set()
+
+    def search(self, q: Query) -> list[Hit]:
+        """
+        Up to q.limit hits, newest first.
+        """
+        self._refresh()
+        sources: list[_Source] = [self.memtable, *self.flushing]
+        sources += self._live()
+        found = []
+        for hit in merge(
+            *(s.hits(q) for s in sources),
+            key=lambda h: h[0],
+            reverse=True,
+        ):
+            found.append(hit)
+            if len(found) >= q.limit:
+                break
+        return found
+
+    async def flush(self) -> None:
+        if not len(self.memtable):
+            return
+        m = self.memtable
+        self.memtable = Memtable()
+        self.flushing.append(m)
+        n = self.next_flush
+        self.next_flush += 1
+        path = os.path.join(self.path, self._name(n, n))
+        try:
+            await trio.to_thread.run_sync(
+                write_segment,
+                path,
+                m.ids,
+                m.meta_offs,
+                m.meta,
+                iter(sorted(m.terms.items())),
+            )
+            # No checkpoint from here on, so no search sees the
+            # documents both in the memtable and on disk.
+            os.rename(path + ".tmp", path)
+            segment = self.segments[os.path.basename(path)] = Segment(
+                path
+            )
+            self.own.append(segment)
+        finally:
+            self.flushing.remove(m)
+
+    def _pick_merge(self) -> Optional[list[Segment]]:
+        """
+        The run of merge_factor consecutive segments with the fewest
+        documents, once there are more than merge_factor of them.
+        """
+        k = self.merge_factor
+        if len(self.own) <= k:
+            return None
+        sizes = [len(s) for s in self.own]
+        best = min(
+            range(len(sizes) - k + 1),
+            key=lambda i: sum(sizes[i : i + k]),
+        )
+        return self.own[best : best + k]
+
+    async def merge(self) -> None:
+        run = self._pick_merge()
+        if run is None:
+            return
+        path = os.path.join(
+            self.path, self._name(run[0].first, run[-1].last)
+        )
+        started = time.perf_counter()
+        await trio.to_thread.run_sync(merge_segments, path, run)
+        os.rename(path + ".tmp", path)
+        merged = Segment(path)
+        i = self.own.index(run[0])
+        self.own[i : i + len(run)] = [merged]
+        self.segments[os.path.basename(path)] = merged
+        for s in run:
+            os.unlink(s.path)
+            self.segments.pop(os.path.basename(s.path)).close()
+        minilog.info(
+            "Merged %d search segments (%d messages) in %.2fs.",
+            len(run),
+            len(merged),
+            time.perf_counter() - started,
+        )
+
+    async def run(self) -> None:
+        """
+        Write the memtable out whenever it's full or flush_interval
+        has passed, and merge segments after that.
+        """
+        while True:
+            with trio.move_on_after(self.flush_interval):
+                await self.wakeup.wait()
+            self.wakeup = trio.Event()
+            try:
+                await self.flush()
+                await self.merge()
+            except OSError as exc:
+                # The messages were still delivered; they just won't
+                # turn up in SEARCH.
+                minilog.error(
+                    "Writing the search index failed: %s", str(exc)
+                )
+
+    def close(self) -> None:
+        # Whatever is still in memory is written out right here; this
+        # is only called on the way out.
+        if len(self.memtable):
+            n = self.next_flush
+            path = os.path.join(self.path, self._name(n, n))
+            write_segment(
+                path,
+                self.memtable.ids,
+                self.memtable.meta_offs,
+                self.memtable.meta,
+                iter(sorted(self.memtable.terms.items())),
+            )
+            os.rename(path + ".tmp", path)
+            self.memtable = Memtable()
+            self.next_flush += 1
+        for s in self.segments.values():
+            s.close()
+        self.segments.clear()
+        self.own.clear()
+
+
+def open_index() -> Optional[Index]:
+    if config.search.path is None:
+        return None
+    return Index(
+        path=config.search.path,
+        flush_docs=config.search.flush_docs,
+        flush_interval=config.search.flush_interval,
+        merge_factor=config.search.merge_factor,
+    )
+
+
+index: Optional[Index] = None
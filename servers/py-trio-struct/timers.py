@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#
+# Timers for the Internet Delay Chat server written in Python Trio.
+# Don't run this.
+#
+# Written by: Andrew <https://www.andrewyu.org>
+#             luk3yx <https://luk3yx.github.io>
+#
+# This is free and unencumbered software released into the public
+# domain.
+#
+# Anyone is free to copy, modify, publish, use, compile, sell, or
+# distribute this software, either in source code form or as a compiled
+# binary, for any purpose, commercial or non-commercial, and by any
+# means.
+#
+# In jurisdictions that recognize copyright laws, the author or authors
+# of this software dedicate any and all copyright interest in the
+# software to the public domain. We make this dedication for the benefit
+# of the public at large and to the detriment of our heirs and
+# successors. We intend this dedication to be an overt act of
+# relinquishment in perpetuity of all present and future rights to this
+# software under copyright law.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+#
+
+
+# One task keeps the timers of every connection: keepalive PINGs, idle
+# disconnects and TLS handshake deadlines, instead of each connection
+# sleeping in a task of its own.  Timers live in a hierarchical wheel
+# of LEVELS levels with SLOTS slots each, where a slot on level n spans
+# SLOTS ** n ticks.  A timer goes in the lowest level that reaches far
+# enough, and whenever a level comes round to its next slot, that slot
+# of the level above is emptied into the levels below.  Scheduling and
+# cancelling are O(1), and a timer is moved at most LEVELS - 1 times
+# before it fires.
+#
+# Callbacks run on the wheel's task, so they mustn't block; to do
+# anything slow, have them cancel a scope or put something in a queue.
+
+from __future__ import annotations
+from typing import Any, Callable, Optional
+from dataclasses import dataclass, field
+import math
+
+import trio
+
+import minilog
+
+_BITS = 6
+SLOTS = 1 << _BITS
+LEVELS = 4
+_MASK = SLOTS - 1
+
+
+@dataclass(slots=True, eq=False)
+class Timer:
+    # Tick it's due on.
+    when: int
+    callback: Callable[[], None]
+    wheel: Wheel
+    # The slot it's in, or None once it has fired or been cancelled.
+    slot: Optional[set[Timer]] = None
+
+    def cancel(self) -> None:
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+def _slots() -> list[list[set[Timer]]]:
+    return [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+
+
+@dataclass
+class Wheel:
+    # Seconds per tick; timers fire up to this late.
+    tick: float
+    # The last tick that was run, once run() has started.
+    now: int = 0
+    # Timers waiting.
+    count: int = 0
+    levels: list[list[set[Timer]]] = field(default_factory=_slots)
+
+    def call_at(
+        self, deadline: float, callback: Callable[[], None]
+    ) -> Timer:
+        """
+        Call callback at trio.current_time() deadline, rounded up to
+        the next tick.
+        """
+        when = max(math.ceil(deadline / self.tick), self.now + 1)
+        t = Timer(when, callback, self)
+        self._place(t)
+        self.count += 1
+        return t
+
+    def call_later(
+        self, delay: float, callback: Callable[[], None]
+    ) -> Timer:
+        return self.call_at(trio.current_time() + delay, callback)
+
+    def _place(self, t: Timer) -> None:
+        delta = t.when - self.now
+        for level in range(LEVELS):
+            if delta < 1 << (_BITS * (level + 1)):
+                when = t.when
+                break
+        else:
+            # Further off than the wheel reaches; park it in the last
+            # slot it does, and it's placed again from there.
+            when = self.now + (1 << (_BITS * LEVELS)) - 1
+        slot = self.levels[level][(when >> (_BITS * level)) & _MASK]
+        slot.add(t)
+        t.slot = slot
+
+    def advance(self, to: int) -> None:
+        """
+        Run every tick up to and including tick to.
+        """
+        while self.now < to:
+            self.now = now = self.now + 1
+            top = 1
+            while top < LEVELS and not now & ((1 << (_BITS * top)) - 1):
+                top += 1
+            for level in range(top - 1, 0, -1):
+                self._cascade(level, (now >> (_BITS * level)) & _MASK)
+            i = now & _MASK
+            due = self.levels[0][i]
+            if not due:
+                continue
+            self.levels[0][i] = set()
+            self.count -= len(due)
+            for t in due:
+                t.slot = None
+                try:
+                    t.callback()
+                except Exception as exc:
+                    minilog.warning(
+                        "Timer callback %s failed: %s",
+                        repr(t.callback),
+                        repr(exc),
+                    )
+
+    def _cascade(self, level: int, i: int) -> None:
+        timers = self.levels[level][i]
+        if timers:
+            self.levels[level][i] = set()
+            for t in timers:
+                self._place(t)
+
+    async def run(
+        self, task_status: Any = trio.TASK_STATUS_IGNORED
+    ) -> None:
+        self.now = math.floor(trio.current_time() / self.tick)
+        task_status.started()
+        while True:
+            await trio.sleep_until((self.now + 1) * self.tick)
+            self.advance(math.floor(trio.current_time() / self.tick))
+
+
+# Replaced with one ticking every timeouts.tick seconds at startup.
+wheel = Wheel(tick=1.0)
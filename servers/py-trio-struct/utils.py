@@ -36,16 +36,24 @@
 #
 
 from __future__ import annotations
-from typing import TypeVar, Iterator, Optional, Union, List
+from typing import TypeVar, Optional, Union, List
+from dataclasses import dataclass, field
 
-import pprint
 import sys
-import re
 import time
+import zlib
+
+import trio
 
 import minilog
 import exceptions
 import entities
+import codec
+import config
+import offline
+import cluster
+import metrics
+
 
 def ts() -> bytes:
     """
@@ -53,100 +61,6 @@ def ts() -> bytes:
     """
     return str(time.time()).encode("ascii")
 
-_esc_re = re.compile(rb"\\(.)")
-_idc_escapes = {
-    b"\\": b"\\\\",
-    b"r": b"\r",
-    b"n": b"\n",
-    b"t": b"\t",
-}
-
-
-def _get_idc_args(
-    command: bytes, kwdict: dict[str, Optional[bytes]]
-) -> Iterator[bytes]:
-    yield command.upper()
-    seen = set()
-    for key, value in kwdict.items():
-        if key != key.upper():
-            raise exceptions.IdiotError(
-                "Why are you using lowercase keys in the code?"
-            )
-        if key in seen:
-            raise exceptions.KeyCollisionError(
-                key.encode("ascii")
-                + b" was already seen in the arguments."
-            )
-        seen.add(key)
-        if value is not None:
-            for escape_char, char in _idc_escapes.items():
-                value = value.replace(char, b"\\" + escape_char)
-            yield key.encode("ascii") + b"=" + value
-
-
-def stdToBytes(command: bytes, **kwargs: Optional[bytes]) -> bytes:
-    """
-    Turns a standard tuple into a raw IDC message, adding the final
-    CR-LF.
-        "Hey!  Saw that underscore?  Why are you even looking at this?"
-    """
-    r = b"\t".join(_get_idc_args(command, kwargs)) + b"\r\n"
-    return r
-
-
-def bytesToStd(msg: bytes) -> tuple[bytes, dict[str, bytes]]:
-    """
-    Parses a raw IDC message into the command and key/value pairs.
-    The message MUST contain the CR-LF.
-    Example: PRIVMSG TARGET:yay MESSAGE:Hi
-    (b'PRIVMSG', {b'TARGET': b'yay', b'MESSAGE': b'Hi'})
-    """
-    if msg.endswith(b"\n"):
-        msg = msg[:-1]
-    if msg.endswith(b"\r"):
-        msg = msg[:-1]
-    cmd = b""
-    args = {}
-    for arg in msg.split(b"\t"):
-        if b"=" in arg:
-            key, value = arg.split(b"=", 1)
-            key = key.upper()
-
-            try:
-                key_str = key.decode("ascii")
-            except UnicodeDecodeError:
-                raise exceptions.NonAlphaKeyError(
-                    b"Argument keys must be ASCII alphabet sequences.  (decode error)"
-                )
-            else:
-                if not key_str.isalpha():
-                    raise exceptions.NonAlphaKeyError(
-                        b"Argument keys must be ASCII alphabet sequences. (not isalpha)"
-                    )
-
-            def s(m: re.Match[bytes]) -> bytes:
-                try:
-                    return _idc_escapes[m.group(1)]
-                except KeyError:
-                    raise exceptions.EscapeSequenceError(
-                        b"\\"
-                        + m.group(1)
-                        + b"is an invalid escape sequence."
-                    )
-
-            args[key_str] = _esc_re.sub(
-                s,
-                value,
-            )
-        elif cmd != b"":
-            raise exceptions.MultiCommandError(
-                b"You can't use multiple commands inside one line!"
-            )
-        else:
-            cmd = arg
-    return cmd, args
-
-
 
 T = TypeVar("T")
 U = TypeVar("U")
@@ -188,44 +102,285 @@ V = Union[
 ]
 
 
-async def send(
-    recver: V,
-    command: bytes,
-    delayable: bool = True,
-    **kwargs: Optional[bytes],
-) -> None:
-#    rs = kwargs.get("RSTS", None)
-#    if rs is None:
-#        kwargs.insert(0, ("RSTS", ts()))
-    kwargs["RSTS"] = kwargs.get("RSTS", ts())
+@dataclass
+class Recipients:
+    # Clients connected to this process.
+    clients: list[entities.Client] = field(default_factory=list)
+    # Users that are offline everywhere and get the line queued.
+    offline_users: list[entities.User] = field(default_factory=list)
+    # Worker ID -> usernames connected to that worker; only used when
+    # running as several processes, see cluster.py.
+    remote: dict[int, list[bytes]] = field(default_factory=dict)
+
+
+def resolve_recipients(recver: V, delayable: bool = True) -> Recipients:
+    """
+    Flatten a recipient (client, user, channel or a list of those) into
+    the clients that are connected right now and the users that are
+    offline and should get the line queued.  Raises TargetOfflineError
+    before anything is delivered if an offline user can't take delayed
+    messages.
+    """
+    r = Recipients()
+    _resolve_into(recver, delayable, r)
+    return r
+
+
+def _resolve_into(recver: V, delayable: bool, r: Recipients) -> None:
     if isinstance(recver, list):
         for t in recver:
-            await send(t, command, delayable, **kwargs)
+            _resolve_into(t, delayable, r)
     elif isinstance(recver, entities.Client):
-        b = stdToBytes(command, **kwargs)
-        minilog.debug(f"{recver.cid.decode('ascii')} <<< {b!r}")
-        await recver.stream.send_all(b)
+        r.clients.append(recver)
     elif isinstance(recver, entities.User):
-        if recver.connected_clients:
-            for c in recver.connected_clients:
-                await send(c, command, delayable, **kwargs)
-        elif delayable:
-            recver.queue.append(stdToBytes(command, **kwargs))
-        else:
-            raise exceptions.TargetOfflineError(
-                recver.username
-                + b" is offline and this action requires them to be online."
-            )
+        _resolve_user(recver, delayable, r)
     elif isinstance(recver, entities.Channel):
-        for t in recver.broadcast_to:
-            await send(t, command, delayable, **kwargs)
-
+        for u in recver.broadcast_to:
+            _resolve_user(u, delayable, r)
     else:
         raise Exception("1")
 
 
+def _resolve_user(
+    user: entities.User, delayable: bool, r: Recipients
+) -> None:
+    if user.connected_clients:
+        r.clients.extend(user.connected_clients)
+    # Other workers this user is connected to, if any.
+    workers = cluster.routes.get(user.username)
+    if workers:
+        for w in workers:
+            try:
+                r.remote[w].append(user.username)
+            except KeyError:
+                r.remote[w] = [user.username]
+    if user.connected_clients or workers:
+        return
+    if delayable:
+        r.offline_users.append(user)
+    else:
+        raise exceptions.TargetOfflineError(
+            user.username
+            + b" is offline and this action requires them to be online."
+        )
+
+
+def encode(command: bytes, **kwargs: Optional[bytes]) -> bytes:
+    """
+    Encode a line the way send() would, stamping RSTS if it's missing.
+    """
+    kwargs["RSTS"] = kwargs.get("RSTS", ts())
+    return codec.encode_line(command, kwargs)
+
+
+def send(
+    recver: V,
+    command: bytes,
+    delayable: bool = True,
+    **kwargs: Optional[bytes],
+) -> None:
+    """
+    Encode a line once and deliver() it to every recipient.  Like
+    deliver(), this never blocks.
+    """
+    deliver(
+        encode(command, **kwargs),
+        resolve_recipients(recver, delayable),
+        droppable=command in config.outbound.droppable_commands,
+    )
+
+
+def deliver(
+    line: bytes, r: Recipients, droppable: bool = False
+) -> None:
+    """
+    Hand one already encoded line to every recipient.  Every client and
+    offline queue gets the very same bytes object.  This never blocks;
+    clients that can't keep up are dealt with by enqueue().
+    """
+    if r.clients and minilog.enabled(minilog.DEBUG):
+        cids = ",".join(c.cid.decode("ascii") for c in r.clients)
+        minilog.debug("%s <<< %r", cids, line)
+    for c in r.clients:
+        enqueue(c, line, droppable)
+    for u in r.offline_users:
+        store_offline(u.username, line)
+    for w, usernames in r.remote.items():
+        cluster.forward(w, usernames, line)
+
+
+def store_offline(username: bytes, line: bytes) -> None:
+    """
+    Queue a line for an offline user, in this process's store or, in
+    cluster mode, in the store of the worker that owns the user.
+    """
+    if cluster.is_home(username):
+        offline.store.append(username, line)
+    else:
+        cluster.forward_offline(username, line)
+
+
+def enqueue(
+    client: entities.Client, line: bytes, droppable: bool = False
+) -> None:
+    """
+    Put a line in a client's outbound queue, applying
+    config.outbound.slow_consumer_policy if the queue is full.
+    """
+    assert client.outbox is not None
+    try:
+        client.outbox.send_nowait(line)
+    except trio.WouldBlock:
+        pass
+    except (trio.ClosedResourceError, trio.BrokenResourceError):
+        # The connection is already on its way out: either it closed
+        # its outbox, or its writer is gone and cancellation of the
+        # rest just hasn't reached the reader yet.
+        return
+    else:
+        return
+
+    policy = config.outbound.slow_consumer_policy
+    if policy == "drop" and droppable:
+        return
+    if policy == "spill" and client.user is not None:
+        _spill(client, line)
+    scope = client.cancel_scope
+    if scope is not None and scope.cancel_called:
+        # Already being disconnected.
+        return
+    minilog.caution(
+        "%s: outbound queue full, disconnecting.",
+        client.cid.decode("ascii"),
+    )
+    disconnect(client)
+
+
+# The line spilled last and the users it was spilled for.  deliver()
+# hands the same bytes object to every client, so this is enough to
+# queue a line only once for a user whose clients all overflow on it.
+_spilled: tuple[bytes, set[bytes]] = (b"", set())
+
+
+def _spill(client: entities.Client, line: bytes) -> None:
+    """
+    Queue a line that didn't fit in a client's outbound queue for the
+    user's next LOGIN, unless another of their clients, here or on
+    another worker, is still there to get it.  Clients that are being
+    disconnected don't count.
+    """
+    global _spilled
+    assert client.user is not None
+    username = client.user.username
+    for c in client.user.connected_clients:
+        if c is not client and not (
+            c.cancel_scope is not None and c.cancel_scope.cancel_called
+        ):
+            return
+    if cluster.routes.get(username):
+        return
+    if _spilled[0] is not line:
+        _spilled = (line, set())
+    if username not in _spilled[1]:
+        _spilled[1].add(username)
+        store_offline(username, line)
+
+
+def disconnect(client: entities.Client) -> None:
+    if client.cancel_scope is not None:
+        client.cancel_scope.cancel()
+
+
 async def quote(c: entities.Client, line: bytes) -> None:
-    await c.stream.send_all(line)
+    """
+    Send a raw line to a client, waiting for room in its outbound queue
+    rather than applying the slow consumer policy.  Use this when the
+    client itself asked for a lot of output, like its offline messages.
+    """
+    assert c.outbox is not None
+    try:
+        await c.outbox.send(line)
+    except (trio.ClosedResourceError, trio.BrokenResourceError):
+        pass
+
+
+def member_list(channel: entities.Channel) -> bytes:
+    """
+    The channel's members as the space-separated USERS value of a JOIN.
+    The encoded list is cached on the channel and reused until
+    join_channel() bumps members_version.
+    """
+    cache = channel.members_cache
+    if cache is not None and cache[0] == channel.members_version:
+        metrics.member_lists.inc("hit")
+        return cache[1]
+    metrics.member_lists.inc("miss")
+    users = b" ".join([u.username for u in channel.broadcast_to])
+    channel.members_cache = (channel.members_version, users)
+    return users
+
+
+def join_channel(
+    user: entities.User, channel: entities.Channel
+) -> None:
+    if user not in channel.broadcast_to:
+        if isinstance(channel.broadcast_to, set):
+            channel.broadcast_to.add(user)
+        else:
+            channel.broadcast_to = {user}
+        channel.members_version += 1
+    if channel not in user.in_channels:
+        user.in_channels += (channel,)
+
+
+@dataclass
+class Burst:
+    """
+    Collects lines for one client and hands them over in chunks of at
+    least `limit` bytes, so that a long reply like the LOGIN burst
+    costs a handful of writes instead of one per line.  A limit of 0
+    sends every line on its own.  Don't forget the final flush().
+    """
+
+    client: entities.Client
+    limit: int
+    buf: list[bytes] = field(default_factory=list)
+    size: int = 0
+
+    async def send(
+        self, command: bytes, **kwargs: Optional[bytes]
+    ) -> None:
+        await self.quote(encode(command, **kwargs))
+
+    async def quote(self, line: bytes) -> None:
+        self.buf.append(line)
+        self.size += len(line)
+        if self.size >= self.limit:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.buf:
+            return
+        chunk = b"".join(self.buf) if len(self.buf) > 1 else self.buf[0]
+        self.buf.clear()
+        self.size = 0
+        minilog.debug(
+            "%s <<< %r", self.client.cid.decode("ascii"), chunk
+        )
+        await quote(self.client, chunk)
+
+
+def deflate(client: entities.Client, chunks: list[bytes]) -> bytes:
+    """
+    Compress chunks for a client that has sent COMPRESS, ending with a
+    sync flush so that the client can read all of it right away.  The
+    chunks are fed in one by one rather than joined first.
+    """
+    d = client.deflate
+    assert d is not None
+    out = [d.compress(chunk) for chunk in chunks]
+    out.append(d.flush(zlib.Z_SYNC_FLUSH))
+    return b"".join(out)
 
 
 def exit(i: int) -> None: